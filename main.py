@@ -24,6 +24,7 @@ import os
 from PyQt4 import QtCore, QtGui
 
 import pyzui.tilemanager as TileManager
+import pyzui.conversionmanager as ConversionManager
 from pyzui.mainwindow import MainWindow
 
 def main():
@@ -33,6 +34,7 @@ def main():
 
     logging.basicConfig(level=logging.DEBUG)
     TileManager.init()
+    ConversionManager.init()
 
     app = QtGui.QApplication(sys.argv)
     app.setWindowIcon(QtGui.QIcon(os.path.join("data", "icon.png")))
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+## PyZUI 0.1 - Python Zooming User Interface
+## Copyright (C) 2009  David Roberts <d@vidr.cc>
+##
+## This program is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License
+## as published by the Free Software Foundation; either version 2
+## of the License, or (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+## 02110-1301, USA.
+
+"""
+Tile media ahead of time without a GUI, so that it opens instantly in PyZUI
+USAGE
+  pretile.py [options] file|directory ...
+e.g.:
+  ./pretile.py -j 4 --summary summary.json images/
+"""
+
+import logging
+import sys
+import os
+import json
+import multiprocessing
+from optparse import OptionParser
+
+import pyzui.tilestore as TileStore
+from pyzui.pretiler import find_media, pretile
+
+def main():
+    parser = OptionParser(
+        usage="%prog [options] file|directory ...",
+        description="Convert and tile the given media (searching "
+            "directories recursively) into the tilestore, skipping any "
+            "media which has already been tiled.")
+    parser.add_option('-j', '--jobs', type='int',
+        default=multiprocessing.cpu_count(),
+        help="number of media to tile at once [default: %default]")
+    parser.add_option('-w', '--workers', type='int', default=1,
+        help="number of worker processes used to tile each media "
+            "[default: %default]")
+    parser.add_option('--tilesize', type='int', default=256,
+        help="dimensions of the tiles [default: %default]")
+    parser.add_option('--format', dest='filext',
+        help="format to save tiles in, e.g. jpg or png [default: jpg for "
+            "JPEG media, png otherwise]")
+    parser.add_option('--downsample', choices=['qt', 'box', 'lanczos'],
+        default='qt',
+        help="filter used to build each tilelevel: qt, box or lanczos "
+            "[default: %default]")
+    parser.add_option('--max-memory', type='int',
+        help="bytes of memory to tile each media within")
+    parser.add_option('--packed', action='store_true', default=False,
+        help="store the tiles of each media in a single pack file")
+    parser.add_option('--raw', action='store_true', default=False,
+        help="also store each tilelevel as raw pixels")
+    parser.add_option('--dedup', action='store_true',
+        default=TileStore.deduplicate,
+        help="store tiles with identical content in a single shared file")
+    parser.add_option('--resume', action='store_true', default=False,
+        help="checkpoint tiling so that it can be resumed if interrupted")
+    parser.add_option('--tile-dir',
+        help="location of the tilestore [default: %s]" % TileStore.tile_dir)
+    parser.add_option('--identity', choices=['path', 'content', 'sampled'],
+        default=TileStore.media_identity,
+        help="identify media by its path, a hash of its contents, or a "
+            "hash of samples of its contents [default: %default]")
+    parser.add_option('-f', '--force', action='store_true', default=False,
+        help="retile media which has already been tiled")
+    parser.add_option('--summary', metavar='FILE',
+        help="write a JSON summary of throughput and failures to FILE")
+    parser.add_option('-v', '--verbose', action='count', default=0,
+        help="log progress (repeat for debugging output)")
+
+    options, args = parser.parse_args()
+    if not args:
+        parser.error("no media given")
+
+    if options.verbose >= 2:
+        logging.basicConfig(level=logging.DEBUG)
+    elif options.verbose == 1:
+        logging.basicConfig(level=logging.INFO)
+    else:
+        logging.basicConfig(level=logging.WARNING)
+
+    if options.tile_dir:
+        TileStore.tile_dir = os.path.abspath(options.tile_dir)
+    TileStore.media_identity = options.identity
+    TileStore.deduplicate = options.dedup
+
+    tiler_options = {
+        'workers': options.workers,
+        'tilesize': options.tilesize,
+        'max_memory': options.max_memory,
+        'resume': options.resume,
+        'packed': options.packed,
+        'raw': options.raw,
+    }
+    if options.filext:
+        tiler_options['filext'] = options.filext
+    if options.downsample != 'qt':
+        tiler_options['downsample'] = options.downsample
+
+    media = find_media(args)
+    summary = pretile(media, options.jobs, options.force, tiler_options)
+
+    print "%d tiled, %d skipped, %d failed in %.2fs" % \
+        (summary['tiled'], summary['skipped'], summary['failed'],
+        summary['elapsed'])
+    print "%d tiles, %.1f tiles/s, %.2fMB/s" % (summary['tiles'],
+        summary['tiles_per_second'], summary['bytes_per_second'] * 1e-6)
+    for media_id, error in sorted(summary['failures'].iteritems()):
+        print "FAILED %s: %s" % (media_id, error)
+
+    if options.summary:
+        f = open(options.summary, 'w')
+        try:
+            json.dump(summary, f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+
+    if summary['failed']:
+        sys.exit(1)
+if __name__ == '__main__': main()
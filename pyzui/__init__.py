@@ -52,7 +52,14 @@ __all__ = [
         'webkitconverter',
     'tilestore',
     'tiler',
+    'tilewriter',
+    'tilepack',
+    'tilingstats',
+    'tilingjob',
+    'conversionmanager',
+    'pretiler',
     'ppm',
+    'imagetiler',
     'tile',
     'tilecache',
     'tileprovider',
@@ -62,6 +69,7 @@ __all__ = [
             'globalmosaictileprovider',
             'mandeltileprovider',
             'ferntileprovider',
+            'pdftileprovider',
     'tilemanager',
     'physicalobject',
         'mediaobject',
@@ -0,0 +1,216 @@
+## PyZUI 0.1 - Python Zooming User Interface
+## Copyright (C) 2009  David Roberts <d@vidr.cc>
+##
+## This program is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License
+## as published by the Free Software Foundation; either version 2
+## of the License, or (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+## 02110-1301, USA.
+
+"""The ConversionManager is responsible for converting and tiling media on
+behalf of MediaObjects.
+
+Only one TilingJob is created for each media, no matter how many objects
+request it, and the jobs are run by a fixed pool of worker threads. Waiting
+jobs are run in order of priority, where the priority of a job is the highest
+priority given to it by any of the objects subscribed to it (such as the area
+of the screen the object occupies), so that visible media is tiled first.
+"""
+
+from __future__ import with_statement
+
+from threading import Thread, Condition, Lock
+import multiprocessing
+import weakref
+import itertools
+import logging
+
+import tilestore as TileStore
+from tilingjob import TilingJob
+
+__cond = Condition()
+
+## jobs which are either waiting or running, indexed by where the media is
+## stored in the TileStore (so media with the same contents shares a job),
+## or by media_id where that isn't known yet (see `__job_key`)
+__jobs = {}
+
+## the key of the job for each media_id in __jobs
+__keys = {}
+
+## the entries of __jobs which are waiting to be run
+__pending = []
+
+## locks held by the workers whilst checking whether media has been tiled
+## and then running its job, indexed by where the media is stored, so that
+## jobs which were given different keys (see `__job_key`) aren't both run
+## for the same media (TileStore.disk_access can't be held for this, as
+## converters running in threads of their own also acquire it)
+__media_locks = {}
+__media_locks_lock = Lock()
+
+__workers = []
+__numworkers = None
+__tiler_options = {}
+__order = itertools.count()
+
+__logger = logging.getLogger("ConversionManager")
+
+def init(workers=None, tiler_options={}):
+    """Initialise the ConversionManager, with a pool of `workers` threads
+    (defaulting to one per processor). `tiler_options` are passed to each
+    TilingJob.
+
+    If this is not called before the first request, then the defaults will
+    be used.
+
+    init([int[, dict]]) -> None
+    """
+    global __numworkers, __tiler_options
+
+    with __cond:
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        __numworkers = max(1, workers)
+        __tiler_options = dict(tiler_options)
+
+        while len(__workers) < __numworkers:
+            worker = Thread(target=__run_worker)
+            worker.setDaemon(True)
+            worker.start()
+            __workers.append(worker)
+
+
+def __job_key(media_id):
+    """Return the key of the job for the media identified by `media_id`,
+    which is where it is stored in the TileStore if that can be found
+    without hashing the media (which is left to the worker threads, rather
+    than blocking the GUI thread), and its media_id otherwise.
+
+    __job_key(string) -> string
+    """
+    if TileStore.identity_known(media_id):
+        return TileStore.get_media_path(media_id)
+    else:
+        return media_id
+
+
+def request(media_id, subscriber=None):
+    """Return the TilingJob converting and tiling the media identified by
+    `media_id`, creating it if there isn't one already waiting or running
+    for it (or for other media stored in the same place in the TileStore).
+
+    If a `subscriber` is given then it will be able to set the priority of
+    the job with `set_priority`. Only a weak reference to the subscriber is
+    kept.
+
+    request(string[, object]) -> TilingJob
+    """
+    if __numworkers is None:
+        init()
+
+    key = __job_key(media_id)
+    with __cond:
+        ## keep using the key the job was created with, even if the media's
+        ## contents have been hashed since
+        key = __keys.get(media_id, key)
+        entry = __jobs.get(key)
+        if entry is None:
+            __logger.info("new job for %s", media_id)
+            job = TilingJob(media_id, __tiler_options)
+            ## webpages must begin converting in the thread that owns the
+            ## QApplication, which is the one that requests them
+            job.begin_conversion()
+            entry = {
+                'job': job,
+                'key': key,
+                'order': __order.next(),
+                'subscribers': weakref.WeakKeyDictionary(),
+            }
+            __jobs[key] = entry
+            __pending.append(entry)
+            __cond.notify()
+        __keys[media_id] = key
+
+        if subscriber is not None and subscriber not in entry['subscribers']:
+            entry['subscribers'][subscriber] = 0.0
+
+        return entry['job']
+
+
+def set_priority(media_id, subscriber, priority):
+    """Set the priority that `subscriber` gives to the job for the media
+    identified by `media_id`, which will be run ahead of jobs with a lower
+    priority if it is still waiting.
+
+    This has no effect if there is no such job, or `subscriber` hasn't
+    requested it.
+
+    set_priority(string, object, float) -> None
+    """
+    with __cond:
+        entry = __jobs.get(__keys.get(media_id))
+        if entry is not None and subscriber in entry['subscribers']:
+            entry['subscribers'][subscriber] = priority
+
+
+def __priority(entry):
+    """Return the priority of the job in the given entry, which is the highest
+    of the priorities given to it by its subscribers.
+
+    Precondition: __cond is held
+
+    __priority(dict) -> float
+    """
+    return max([0.0] + entry['subscribers'].values())
+
+
+def __run_worker():
+    """Repeatedly run the highest-priority waiting job (or the oldest of
+    them, if there are several), waiting for one if there are none.
+
+    __run_worker() -> None
+    """
+    while True:
+        with __cond:
+            while not __pending:
+                __cond.wait()
+            entry = max(__pending,
+                key=lambda e: (__priority(e), -e['order']))
+            __pending.remove(entry)
+
+        job = entry['job']
+        try:
+            ## hash the media now if it wasn't known where it is stored when
+            ## the job was requested, which may reveal that another copy of
+            ## it has already been tiled
+            media_path = TileStore.get_media_path(job.media_id)
+            with __media_locks_lock:
+                if media_path not in __media_locks:
+                    __media_locks[media_path] = Lock()
+                media_lock = __media_locks[media_path]
+
+            with media_lock:
+                if TileStore.tiled(job.media_id):
+                    __logger.info("%s has already been tiled", job.media_id)
+                    job.skip()
+                else:
+                    __logger.info("running %s", job)
+                    job.run()
+        finally:
+            with __cond:
+                ## a later request may retry the job if it failed
+                if __jobs.get(entry['key']) is entry:
+                    del __jobs[entry['key']]
+                    for media_id, key in __keys.items():
+                        if key == entry['key']:
+                            del __keys[media_id]
@@ -50,16 +50,56 @@ class DynamicTileProvider(TileProvider):
         pass
 
 
+    def _get_tile_path(self, tile_id, mkdirp=False):
+        """Return the path that the tile identified by `tile_id` is stored at
+        once it has been loaded, as per `TileStore.get_tile_path`.
+
+        Derived classes may override this to store their tiles elsewhere.
+
+        _get_tile_path(tuple<string,int,int,int>[, bool]) -> string
+        """
+        return TileStore.get_tile_path(tile_id, mkdirp, filext=self.filext)
+
+
+    def _content_key(self, tile_id):
+        return TileStore.get_content_key(self._get_tile_path(tile_id))
+
+
+    @property
+    def _shared_on_load(self):
+        ## tiles are only linked to shared blobs once they have been retrieved
+        return TileStore.deduplicate
+
+
     def _load(self, tile_id):
-        filename = TileStore.get_tile_path(
-            tile_id, True, filext=self.filext)
+        filename = self._get_tile_path(tile_id, True)
 
         if not os.path.exists(filename):
             ## tile has not been retrieved yet
             self._load_dynamic(tile_id, filename)
+            if TileStore.deduplicate and os.path.exists(filename):
+                TileStore.deduplicate_file(filename, self.filext)
+
+        if not os.path.exists(filename):
+            ## the tile could not be retrieved
+            return None
 
         try:
-            return QtGui.QImage(filename)
+            f = open(filename, 'rb')
+            try:
+                data = f.read()
+            finally:
+                f.close()
+            image = QtGui.QImage()
+            if not image.loadFromData(data):
+                return None
+
+            if self._keep_encoded:
+                ## keep the encoded tile, which is far smaller than its
+                ## pixels
+                image.encoded = data
+
+            return image
         except Exception:
             self._logger.exception("error loading tile, "
                 "assuming it is unavailable")
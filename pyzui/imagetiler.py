@@ -0,0 +1,201 @@
+## PyZUI 0.1 - Python Zooming User Interface
+## Copyright (C) 2009  David Roberts <d@vidr.cc>
+##
+## This program is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License
+## as published by the Free Software Foundation; either version 2
+## of the License, or (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+## 02110-1301, USA.
+
+"""Module for tiling images which can be decoded natively by PIL."""
+
+import numpy
+import Image
+
+from tiler import Tiler
+
+## image formats which can be tiled directly, anything else will need to be
+## converted to PPM first
+formats = ('JPEG', 'PNG', 'TIFF')
+
+## image modes which can be converted to RGB by PIL
+modes = ('1', 'L', 'P', 'RGB', 'RGBA', 'RGBX', 'CMYK', 'YCbCr')
+
+## the whole image must be decoded into memory before it can be tiled, so
+## images with more pixels than this are left to be converted to PPM (which
+## can be streamed into the tiler) instead
+max_pixels = 32 * 1024 * 1024
+
+## bytes per pixel of the decoded image in each mode (PIL stores each pixel
+## of the other modes, including RGB, in 4 bytes)
+_mode_bytes = {'1': 1, 'L': 1, 'P': 1}
+
+def open_image(infile):
+    """Open the image given by `infile`, without decoding its pixel data.
+
+    Raises `IOError` if the image is not in one of `formats`, or has a mode
+    which cannot be converted to RGB.
+
+    open_image(string) -> Image
+    """
+    image = Image.open(infile)
+
+    if image.format not in formats:
+        raise IOError("unable to natively tile %s images" % image.format)
+    if image.mode not in modes:
+        raise IOError("unable to natively tile %s images with mode %s" %
+            (image.format, image.mode))
+
+    return image
+
+
+def decode_memory(image):
+    """Return the number of bytes of memory required to decode the given
+    image (opened by `open_image`) and convert it to RGB.
+
+    decode_memory(Image) -> int
+    """
+    width, height = image.size
+    memory = 4 * width * height
+    if image.mode != 'RGB':
+        ## the image is decoded in its own mode before being converted
+        memory += _mode_bytes.get(image.mode, 4) * width * height
+    return memory
+
+
+def supported(infile, max_memory=None):
+    """Return True iff the image given by `infile` can be tiled by an
+    ImageTiler, which requires it to have no more than `max_pixels` pixels,
+    and to be small enough to decode within `max_memory` bytes (if given).
+
+    supported(string[, int]) -> bool
+    """
+    try:
+        image = open_image(infile)
+    except Exception:
+        ## not only IOError, as Pillow refuses to open very large images
+        ## with a DecompressionBombError, which can still be converted
+        return False
+
+    width, height = image.size
+    if width * height > max_pixels:
+        return False
+    if max_memory and decode_memory(image) > max_memory:
+        return False
+    return True
+
+
+## the image most recently decoded by a worker process, as (infile, Image)
+_shared_image = None
+
+class ImageTiler(Tiler):
+    """ImageTiler objects are used for tiling JPEG, PNG and TIFF images
+    directly, rather than first converting them to PPM.
+
+    The image is decoded into memory the first time that pixels are requested
+    from it, and bands are then cropped from the decoded image. When tiling in
+    parallel, each worker process decodes the image once and keeps it for all
+    of the bands it is given. The decoded image is included in the memory
+    budget (see `Tiler`), but large images should be checked with `supported`
+    first.
+
+    Constructor:
+      ImageTiler(string[, string[, string[, int[, int[, int[, bool[,
+                 string[, int[, bool[, bool]]]]]]]]]])
+    """
+    def __init__(self, infile, media_id=None, filext='jpg', tilesize=256,
+                 workers=1, max_memory=None, resume=False, downsample=None,
+                 writers=2, packed=False, raw=False):
+        Tiler.__init__(self, infile, media_id, filext, tilesize, workers,
+            max_memory, resume, downsample, writers, packed, raw)
+
+        self.__image = open_image(self._infile)
+        self.__decoded = None
+        self.__shared = False
+
+        self._width, self._height = self.__image.size
+        self._bytes_per_pixel = 3
+
+        ## the next row to be returned from the decoded image
+        self.__row = 0
+
+
+    _seekable = True
+
+    def _decode_memory(self):
+        if self.__image is None:
+            ## already decoded
+            width, height = self.__decoded.size
+            return 4 * width * height
+        return decode_memory(self.__image)
+
+
+    def __decode(self):
+        """Return the decoded RGB image, decoding it if this has not already
+        been done.
+
+        __decode() -> Image
+        """
+        global _shared_image
+
+        if self.__decoded is not None:
+            return self.__decoded
+
+        if self.__shared and _shared_image and \
+           _shared_image[0] == self._infile:
+            self.__decoded = _shared_image[1]
+            return self.__decoded
+
+        ## release any previously shared image before decoding another
+        _shared_image = None
+
+        image = self.__image
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        image.load()
+
+        self.__image = None
+        self.__decoded = image
+        if self.__shared:
+            _shared_image = (self._infile, image)
+
+        return image
+
+
+    def _scanline(self):
+        if self.__row >= self._height:
+            return ''
+        return self._band(1).tostring()
+
+
+    def _band(self, height, x=0, width=None):
+        if width is None:
+            width = self._width - x
+
+        image = self.__decode()
+        if self.__row + height > self._height:
+            raise IOError("less data in image than reported by the header")
+
+        band = image.crop((x, self.__row, x + width, self.__row + height))
+        self.__row += height
+        return numpy.asarray(band)
+
+
+    def _seek(self, row):
+        self.__row = row
+
+
+    def _tile_band(self, tilelevel, row, col, numcols):
+        ## this is only called within worker processes, which will be given
+        ## further bands of the same image
+        self.__shared = True
+        return Tiler._tile_band(self, tilelevel, row, col, numcols)
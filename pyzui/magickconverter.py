@@ -23,6 +23,7 @@ from __future__ import with_statement
 import subprocess
 import os
 import sys
+from threading import Event
 
 from converter import Converter
 import tilestore as TileStore
@@ -32,7 +33,11 @@ class MagickConverter(Converter):
     For a list of supported image formats see
     <http://imagemagick.org/script/formats.php>
 
-    Constructor: MagickConverter(string, string)
+    If `outfile` is None, then the media will be converted to PPM and streamed
+    through a pipe (see `output`) rather than written to disk, so that it can
+    be consumed (e.g. by a PPMTiler) whilst the conversion is still running.
+
+    Constructor: MagickConverter(string, string or None)
     """
     def __init__(self, infile, outfile):
         Converter.__init__(self, infile, outfile)
@@ -40,14 +45,34 @@ class MagickConverter(Converter):
         ## since PPMTiler only supports 8-bit images
         self.bitdepth = 8
 
+        self.__output = None
+        self.__started = Event()
+
+
+    def output(self):
+        """Wait for the conversion to start, and then return a file object
+        from which the converted PPM can be read. Returns None if the
+        converter is not streaming or the conversion failed to start.
+
+        output() -> file or None
+        """
+        if self._outfile is not None:
+            return None
+        self.__started.wait()
+        return self.__output
+
 
     def run(self):
         if sys.platform == 'win32':
             convert_exe = 'imconvert'
         else:
             convert_exe = 'convert'
+
+        if self._outfile is None:
+            self.__run_streaming(convert_exe)
+            return
         
-        with TileStore.disk_lock:
+        with TileStore.disk_access(self._infile):
             self._logger.debug("calling convert")
             process = subprocess.Popen([convert_exe,
                 '-depth', str(self.bitdepth),
@@ -63,12 +88,49 @@ class MagickConverter(Converter):
             try:
                 os.unlink(self._outfile)
             except:
-                self.__logger.exception("unable to unlink temporary file "
+                self._logger.exception("unable to unlink temporary file "
                     "'%s'" % self._outfile)
 
         self._progress = 1.0
 
 
+    def __run_streaming(self, convert_exe):
+        """Run convert with its output piped to `self.__output`.
+
+        The disk is not locked here, as the reader of the output is expected to
+        do so for the duration of the conversion.
+
+        __run_streaming(string) -> None
+        """
+        self._logger.debug("calling convert")
+        try:
+            process = subprocess.Popen([convert_exe,
+                '-depth', str(self.bitdepth),
+                self._infile, 'ppm:-'],
+                bufsize=-1,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE)
+        except OSError, e:
+            self.error = "unable to run convert: %s" % e
+            self._logger.error(self.error)
+            self._progress = 1.0
+            self.__started.set()
+            return
+
+        self.__output = process.stdout
+        self.__started.set()
+
+        stderr = process.stderr.read()
+        process.wait()
+
+        if process.returncode != 0:
+            self.error = "conversion failed with return code " \
+                "%d:\n%s" % (process.returncode, stderr)
+            self._logger.error(self.error)
+
+        self._progress = 1.0
+
+
     def __str__(self):
         return "MagickConverter(%s, %s)" %  (self._infile, self._outfile)
 
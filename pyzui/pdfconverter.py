@@ -23,12 +23,22 @@ from __future__ import with_statement
 import subprocess
 import tempfile
 import os
+import re
 import shutil
+import multiprocessing
+from threading import Thread, Condition
 
 from converter import Converter
 from ppm import read_ppm_header
 import tilestore as TileStore
 
+## line of pdfinfo output giving the number of pages
+_pages_line = re.compile(r'^Pages:\s+(\d+)')
+
+## format of the PPM header, with the dimensions padded so that they can be
+## filled in once all of the pages have been appended
+_header = "P6\n%-20d %-20d\n255\n"
+
 class PDFConverter(Converter):
     """PDFConverter objects are used for rasterizing PDFs.
 
@@ -36,85 +46,228 @@ class PDFConverter(Converter):
     the output file. If another output format is required then PDFConverter
     should be used in conjunction with MagickConverter.
 
+    Pages are rasterized by up to `processes` instances of pdftoppm at once
+    (one per page), and are appended to the output file in order as they are
+    completed.
+
     Constructor: PDFConverter(string, string)
     """
     def __init__(self, infile, outfile):
         Converter.__init__(self, infile, outfile)
 
         self.resolution = 300
+        self.processes = multiprocessing.cpu_count()
+
+        ## pages which have been rasterized, mapped to a list of the
+        ## resulting files or to the error which occurred
+        self.__rasterized = {}
+        self.__rasterized_cond = Condition()
+
+
+    def __count_pages(self):
+        """Return the number of pages in the PDF according to pdfinfo, or None
+        if this cannot be determined.
+
+        __count_pages() -> int or None
+        """
+        try:
+            process = subprocess.Popen(['pdfinfo', self._infile],
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        except OSError, e:
+            self._logger.warning("unable to run pdfinfo: %s", e)
+            return None
+
+        stdout = process.communicate()[0]
+        if process.returncode == 0:
+            for line in stdout.splitlines():
+                match = _pages_line.match(line)
+                if match:
+                    return int(match.group(1))
+
+        self._logger.warning("unable to determine the number of pages")
+        return None
+
+
+    def __rasterize(self, tmpdir, first, last=None):
+        """Rasterize pages `first` to `last` (or to the end of the document if
+        `last` is None) into PPM files in `tmpdir`, and return the filenames
+        in page order.
+
+        Raises `IOError` if pdftoppm fails.
+
+        __rasterize(string, int[, int]) -> list<string>
+        """
+        args = ['pdftoppm', '-r', str(self.resolution), '-f', str(first)]
+        if last is not None:
+            args += ['-l', str(last)]
+        process = subprocess.Popen(
+            args + [self._infile, os.path.join(tmpdir, 'page')],
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        stdout = process.communicate()[0]
+
+        if process.returncode != 0:
+            raise IOError("conversion failed with return code %d:\n%s" %
+                (process.returncode, stdout))
+
+        ## output files don't have a consistent format, so we need to
+        ## determine which files are for which page
+        ## filename[5:-4] extracts '1234' from 'page-1234.ppm'
+        pages = sorted((int(filename[5:-4]), filename)
+                       for filename in os.listdir(tmpdir))
+        return [os.path.join(tmpdir, filename) for page, filename in pages]
+
+
+    def __rasterize_pages(self, tmpdir, pages, window):
+        """Rasterize each of the given pages in turn, into a subdirectory of
+        `tmpdir` each, recording the results in `self.__rasterized`.
+
+        No page will be started more than `window` pages ahead of the last
+        page collected by `__collect`.
+
+        __rasterize_pages(string, iterator<int>, int) -> None
+        """
+        while True:
+            with self.__rasterized_cond:
+                try:
+                    page = pages.next()
+                except StopIteration:
+                    return
+                while page > self.__collected + window and \
+                      not self.__cancelled:
+                    self.__rasterized_cond.wait()
+                if self.__cancelled:
+                    return
+
+            pagedir = os.path.join(tmpdir, str(page))
+            os.mkdir(pagedir)
+            try:
+                result = self.__rasterize(pagedir, page, page)
+            except Exception, e:
+                result = e
 
+            with self.__rasterized_cond:
+                self.__rasterized[page] = result
+                self.__rasterized_cond.notifyAll()
 
-    def __merge(self, tmpdir):
-        """Merge the PPM pages located in tmpdir.
 
-        __merge(string) -> None
+    def __collect(self, page):
+        """Wait for the given page to be rasterized, and return the files
+        produced for it.
+
+        Raises the error encountered whilst rasterizing the page, if any.
+
+        __collect(int) -> list<string>
         """
-        self._logger.info("merging pages")
-        self._progress = 0.5
+        with self.__rasterized_cond:
+            while page not in self.__rasterized:
+                self.__rasterized_cond.wait()
+            result = self.__rasterized.pop(page)
+            self.__collected = page
+            self.__rasterized_cond.notifyAll()
 
-        total_width = 0
-        total_height = 0
+        if isinstance(result, Exception):
+            raise result
+        return result
 
-        page_filename = {}
-        for filename in os.listdir(tmpdir):
-            ## output files don't have a consistent format, so we need to
-            ## determine which files are for which page
-            ## filename[5:-4] extracts '1234' from 'page-1234.ppm'
-            page_filename[int(filename[5:-4])] = filename
-        num_pages = len(page_filename)
-        f = []
 
-        for i in xrange(num_pages):
-            ## open files and process headers
-            f.append(open(os.path.join(tmpdir, page_filename[i+1]), 'rb'))
+    def __append(self, fout, filename, width):
+        """Append the pixels of the PPM page `filename` to `fout`, and return
+        the height of the page, and its width (which must equal `width`,
+        unless `width` is None).
 
+        __append(file, string, int or None) -> tuple<int,int>
+        """
+        f = open(filename, 'rb')
+        try:
             try:
-                width, height = read_ppm_header(f[i])
+                page_width, page_height = read_ppm_header(f)
             except IOError, e:
                 raise IOError("error loading PPM images "
                     "produced by pdftoppm: %s" % e)
 
-            total_height += height
-            if total_width == 0:
-                total_width = width
-            elif total_width != width:
+            if width is not None and page_width != width:
                 raise IOError("all pages must have the same width")
 
+            shutil.copyfileobj(f, fout)
+        finally:
+            f.close()
+        os.unlink(filename)
+
+        return page_width, page_height
+
+
+    def __convert(self, tmpdir):
+        """Rasterize the pages and concatenate them into the output file.
+
+        __convert(string) -> None
+        """
+        numpages = self.__count_pages()
+
+        self.__collected = 0
+        self.__cancelled = False
+        threads = []
+
+        if numpages is None:
+            ## fall back to rasterizing the whole document in one go
+            self._logger.info("calling pdftoppm")
+            self.__rasterized[1] = self.__rasterize(tmpdir, 1)
+            numpages = 1
+        else:
+            self._logger.info("calling pdftoppm for %d pages with %d "
+                "processes", numpages, self.processes)
+            pages = iter(xrange(1, numpages+1))
+            numthreads = max(1, min(self.processes, numpages))
+            for i in xrange(numthreads):
+                thread = Thread(target=self.__rasterize_pages,
+                    args=(tmpdir, pages, 2 * numthreads))
+                thread.setDaemon(True)
+                thread.start()
+                threads.append(thread)
+
         fout = open(self._outfile, 'wb')
-        fout.write("P6\n%d %d\n255\n" % (total_width, total_height))
+        try:
+            width = None
+            total_height = 0
+            for page in xrange(1, numpages+1):
+                for filename in self.__collect(page):
+                    if width is None:
+                        ## leave space for the header
+                        fout.write(_header % (0, 0))
+                    width, height = self.__append(fout, filename, width)
+                    total_height += height
 
-        for i in xrange(num_pages):
-            ## concatenate pixel data into output file
-            shutil.copyfileobj(f[i], fout)
+                ## the last step is reserved for finishing the output file,
+                ## as a progress of 1.0 indicates that conversion has finished
+                self._progress = float(page) / (numpages + 1)
 
-        fout.close()
+            if width is None:
+                raise IOError("no pages were produced by pdftoppm")
+
+            fout.seek(0)
+            fout.write(_header % (width, total_height))
+        finally:
+            fout.close()
+
+            with self.__rasterized_cond:
+                self.__cancelled = True
+                self.__rasterized_cond.notifyAll()
+            for thread in threads:
+                thread.join()
 
 
     def run(self):
-        with TileStore.disk_lock:
+        with TileStore.disk_access(self._infile):
             tmpdir = tempfile.mkdtemp()
-            self._logger.info("calling pdftoppm")
-            process = subprocess.Popen(['pdftoppm',
-                '-r', str(self.resolution),
-                self._infile, os.path.join(tmpdir, 'page')],
-                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-            stdout = process.communicate()[0]
-
-            if process.returncode == 0:
-                try:
-                    self.__merge(tmpdir)
-                except Exception, e:
-                    self.error = str(e)
-                    self._logger.error(self.error)
-                    try:
-                        os.unlink(self._outfile)
-                    except:
-                        self.__logger.exception("unable to unlink temporary "
-                            "file '%s'" % self._outfile)
-            else:
-                self.error = "conversion failed with return code %d:\n%s" % \
-                    (process.returncode, stdout)
+            try:
+                self.__convert(tmpdir)
+            except Exception, e:
+                self.error = str(e)
                 self._logger.error(self.error)
+                try:
+                    os.unlink(self._outfile)
+                except:
+                    self._logger.exception("unable to unlink temporary "
+                        "file '%s'" % self._outfile)
 
             shutil.rmtree(tmpdir, ignore_errors=True)
             self._progress = 1.0
@@ -0,0 +1,384 @@
+## PyZUI 0.1 - Python Zooming User Interface
+## Copyright (C) 2009  David Roberts <d@vidr.cc>
+##
+## This program is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License
+## as published by the Free Software Foundation; either version 2
+## of the License, or (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+## 02110-1301, USA.
+
+"""Dynamic tile provider for rendering regions of PDFs on demand."""
+
+from __future__ import with_statement
+
+import subprocess
+import tempfile
+import os
+import re
+import math
+import shutil
+from threading import Lock
+
+import numpy
+
+from dynamictileprovider import DynamicTileProvider
+import tilestore as TileStore
+import tile as Tile
+from ppm import read_ppm_header
+
+## lines of pdfinfo output giving the number of pages, and the size (in
+## points) and rotation of each page
+_pages_line = re.compile(r'^Pages:\s+(\d+)')
+_size_line = re.compile(r'^Page\s+(\d+)\s+size:\s+([\d.]+)\s+x\s+([\d.]+)')
+_rot_line = re.compile(r'^Page\s+(\d+)\s+rot:\s+(\d+)')
+
+## passed to pdfinfo as the last page, so that every page is listed
+_max_pages = 1000000
+
+class PDFTileProvider(DynamicTileProvider):
+    """PDFTileProvider objects are used for rendering tiles of PDFs with
+    Poppler's pdftoppm as they are requested, rather than rasterizing the
+    whole document before it can be viewed.
+
+    The pages are laid out one above the other (as by PDFConverter), and each
+    tile is rendered at the resolution implied by its tilelevel, such that the
+    longest side of the document spans 2**tilelevel tiles. Only the parts of
+    the pages lying within the tile are rendered, so there is no limit to how
+    far the document can be zoomed into.
+
+    Rendered tiles are cached in the TileStore, and are discarded if the PDF
+    is modified.
+
+    Constructor: PDFTileProvider(TileCache)
+    """
+    def __init__(self, tilecache):
+        DynamicTileProvider.__init__(self, tilecache)
+
+        self.__layouts = {}
+        self.__layouts_lock = Lock()
+
+
+    filext = 'png'
+    tilesize = 256
+    aspect_ratio = None ## differs between documents, see get_aspect_ratio
+
+    ## colour of the parts of tiles that aren't covered by a page
+    background = (255, 255, 255)
+
+    ## pages which would be rendered fewer than this many pixels tall are
+    ## drawn as blocks of `page_colour` instead, as there would be nothing
+    ## to see of them (e.g. at the coarsest tilelevels of long documents)
+    min_page_height = 4
+    page_colour = (255, 255, 255)
+
+    ## maximum number of pages to render with a single call to pdftoppm
+    max_pages_per_render = 16
+
+    def __pdfinfo(self, media_id, *args):
+        """Run pdfinfo on the given PDF with the given arguments, and return
+        its output.
+
+        Raises `IOError` if pdfinfo fails.
+
+        __pdfinfo(string, string...) -> string
+        """
+        try:
+            process = subprocess.Popen(
+                ['pdfinfo'] + list(args) + [media_id],
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        except OSError, e:
+            raise IOError("unable to run pdfinfo: %s" % e)
+
+        stdout = process.communicate()[0]
+        if process.returncode != 0:
+            raise IOError("pdfinfo failed with return code %d:\n%s" %
+                (process.returncode, stdout))
+        return stdout
+
+
+    def __load_layout(self, media_id):
+        """Read the dimensions of each page of the given PDF, and return the
+        layout of the document as a tuple containing its width and height (in
+        points), and a list of the top, width and height of each page.
+
+        Any cached tiles are discarded if the PDF has been modified since they
+        were rendered.
+
+        Raises `IOError` or `OSError` if the PDF cannot be read.
+
+        __load_layout(string) -> tuple<float,float,list<tuple<float,float,
+                                                              float>>>
+        """
+        st = os.stat(media_id)
+
+        ## pdfinfo clamps the last page to the number of pages in the
+        ## document, so the sizes of all of the pages can be read at once
+        numpages = None
+        sizes = {}
+        rotations = {}
+        for line in self.__pdfinfo(media_id,
+            '-f', '1', '-l', str(_max_pages)).splitlines():
+            match = _pages_line.match(line)
+            if match:
+                numpages = int(match.group(1))
+            match = _size_line.match(line)
+            if match:
+                sizes[int(match.group(1))] = \
+                    (float(match.group(2)), float(match.group(3)))
+            match = _rot_line.match(line)
+            if match:
+                rotations[int(match.group(1))] = int(match.group(2))
+        if not numpages:
+            raise IOError("unable to determine the number of pages")
+
+        pages = []
+        top = 0.0
+        for number in xrange(1, numpages+1):
+            if number not in sizes:
+                raise IOError("unable to determine the size of page %d" %
+                    number)
+            width, height = sizes[number]
+            if rotations.get(number, 0) % 180 == 90:
+                ## pdftoppm renders the page rotated
+                width, height = height, width
+            pages.append((top, width, height))
+            top += height
+
+        width = max(page[1] for page in pages)
+        height = top
+
+        ## discard cached tiles rendered from a different version of the PDF
+        cache_path = self.__cache_path(media_id)
+        stamp = "%r %d" % (st.st_mtime, st.st_size)
+        stamp_file = os.path.join(cache_path, "source")
+        try:
+            f = open(stamp_file)
+            try:
+                valid = f.read() == stamp
+            finally:
+                f.close()
+        except IOError:
+            valid = False
+        if not valid:
+            shutil.rmtree(cache_path, ignore_errors=True)
+            if TileStore.deduplicate:
+                TileStore.clean_blobs()
+            os.makedirs(cache_path)
+            f = open(stamp_file, 'w')
+            f.write(stamp)
+            f.close()
+
+        return width, height, pages
+
+
+    def __get_layout(self, media_id):
+        """Return the layout of the given PDF (see `__load_layout`), or None
+        if it cannot be read, reading it if this has not already been done.
+
+        This runs pdfinfo, so should only be called from the provider's own
+        thread.
+
+        __get_layout(string) -> tuple<float,float,list<tuple<float,float,
+                                                            float>>> or None
+        """
+        with self.__layouts_lock:
+            if media_id in self.__layouts:
+                return self.__layouts[media_id]
+
+        ## pdfinfo may take a while, so don't hold the lock whilst it runs
+        try:
+            layout = self.__load_layout(media_id)
+        except EnvironmentError, e:
+            self._logger.error("unable to read layout of %s: %s",
+                media_id, e)
+            layout = None
+
+        with self.__layouts_lock:
+            self.__layouts[media_id] = layout
+        return layout
+
+
+    def get_aspect_ratio(self, media_id):
+        """Return the aspect ratio (width / height) of the given PDF, or None
+        if it cannot be read or its layout has not been read yet.
+
+        The layout is read when the first tile of the PDF is loaded, so this
+        never blocks the calling thread.
+
+        get_aspect_ratio(string) -> float or None
+        """
+        with self.__layouts_lock:
+            layout = self.__layouts.get(media_id)
+        if layout is None:
+            return None
+        width, height, pages = layout
+        return width / height
+
+
+    def purge(self, media_id=None):
+        DynamicTileProvider.purge(self, media_id)
+
+        ## re-read the layout next time, in case the PDF has been modified
+        with self.__layouts_lock:
+            if media_id:
+                self.__layouts.pop(media_id, None)
+            else:
+                self.__layouts.clear()
+
+
+    def __cache_path(self, media_id):
+        """Return the path to the directory in which rendered tiles of the
+        given PDF are cached, which is kept apart from any tiles of it made by
+        a Tiler.
+
+        __cache_path(string) -> string
+        """
+        return os.path.join(TileStore.get_media_path(media_id), "dynamic")
+
+
+    def _get_tile_path(self, tile_id, mkdirp=False):
+        ## the cache must be validated before anything is stored in it
+        self.__get_layout(tile_id[0])
+        return TileStore.get_tile_path(tile_id, mkdirp,
+            self.__cache_path(tile_id[0]), self.filext)
+
+
+    def __render(self, media_id, first, last, resolution, x, y, w, h):
+        """Render the region of pages `first` to `last` of the given PDF at
+        the given `resolution` (in DPI) which is `w`x`h` pixels in size, and
+        offset by (`x`,`y`) pixels from the top-left corner of each page.
+
+        Returns a dict mapping page numbers to arrays of RGB pixels. The
+        arrays may be smaller than requested where the region extends beyond
+        the edge of a page.
+
+        Raises `IOError` if pdftoppm fails.
+
+        __render(string, int, int, float, int, int, int, int)
+        -> dict<int,numpy.ndarray>
+        """
+        tmpdir = tempfile.mkdtemp()
+        try:
+            try:
+                process = subprocess.Popen(['pdftoppm',
+                    '-f', str(first), '-l', str(last),
+                    '-r', "%f" % resolution,
+                    '-x', str(x), '-y', str(y), '-W', str(w), '-H', str(h),
+                    media_id, os.path.join(tmpdir, 'page')],
+                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            except OSError, e:
+                raise IOError("unable to run pdftoppm: %s" % e)
+
+            stdout = process.communicate()[0]
+            if process.returncode != 0:
+                raise IOError("pdftoppm failed with return code %d:\n%s" %
+                    (process.returncode, stdout))
+
+            pages = {}
+            for filename in os.listdir(tmpdir):
+                f = open(os.path.join(tmpdir, filename), 'rb')
+                try:
+                    width, height = read_ppm_header(f)
+                    pixels = numpy.frombuffer(f.read(width * height * 3),
+                        numpy.uint8)
+                finally:
+                    f.close()
+                if len(pixels) < width * height * 3:
+                    raise IOError("less data in page rendered by pdftoppm "
+                        "than reported by the header")
+                ## filename[5:-4] extracts '1234' from 'page-1234.ppm'
+                pages[int(filename[5:-4])] = \
+                    pixels.reshape(height, width, 3)
+            return pages
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+    def _load_dynamic(self, tile_id, outfile):
+        media_id, tilelevel, row, col = tile_id
+
+        if tilelevel < 0 or row < 0 or col < 0:
+            return
+
+        layout = self.__get_layout(media_id)
+        if layout is None:
+            return
+        doc_width, doc_height, pages = layout
+
+        ## pixels per point at this tilelevel
+        scale = float(self.tilesize * 2**tilelevel) / \
+            max(doc_width, doc_height)
+        resolution = 72.0 * scale
+
+        x = col * self.tilesize
+        y = row * self.tilesize
+        w = min(self.tilesize, int(math.ceil(doc_width * scale)) - x)
+        h = min(self.tilesize, int(math.ceil(doc_height * scale)) - y)
+        if w <= 0 or h <= 0:
+            ## row,col out of range
+            return
+
+        tile = numpy.empty((h, w, 3), numpy.uint8)
+        tile[:] = self.background
+
+        def paste(pixels, offset):
+            ## copy the rendered pixels into the tile, `offset` rows down
+            pixels = pixels[:h-offset, :w]
+            tile[offset : offset + pixels.shape[0], :pixels.shape[1]] = \
+                pixels
+
+        ## pages lying entirely within the tile, which are rendered below
+        whole_pages = []
+        for number, (page_top, page_width, page_height) in \
+            enumerate(pages):
+            top = int(round(page_top * scale))
+            bottom = top + int(math.ceil(page_height * scale))
+            if top >= y + h:
+                break
+            elif bottom <= y or x >= int(math.ceil(page_width * scale)):
+                continue
+            elif bottom - top < self.min_page_height:
+                page_right = int(math.ceil(page_width * scale))
+                tile[max(y, top) - y : min(y + h, bottom) - y,
+                     :page_right - x] = self.page_colour
+            elif top >= y and bottom <= y + h:
+                whole_pages.append((number+1, top - y, bottom - top))
+            else:
+                ## render only the part of the page within the tile
+                crop_y = max(y, top) - top
+                crop_h = min(y + h, bottom) - max(y, top)
+                rendered = self.__render(media_id, number+1, number+1,
+                    resolution, x, crop_y, w, crop_h)
+                if number+1 in rendered:
+                    paste(rendered[number+1], max(y, top) - y)
+
+        ## render consecutive runs of whole pages together, a limited number
+        ## at a time
+        runs = []
+        for page in whole_pages:
+            if runs and page[0] == runs[-1][-1][0] + 1 and \
+               len(runs[-1]) < self.max_pages_per_render:
+                runs[-1].append(page)
+            else:
+                runs.append([page])
+        for run in runs:
+            rendered = self.__render(media_id, run[0][0], run[-1][0],
+                resolution, x, 0, w, max(page[2] for page in run))
+            for number, offset, height in run:
+                if number in rendered:
+                    paste(rendered[number], offset)
+
+        ## save to a temporary file first, so that an interrupted save is
+        ## never mistaken for a rendered tile
+        tmpfile = outfile + ".tmp." + self.filext
+        Tile.fromarray(tile).save(tmpfile)
+        os.rename(tmpfile, outfile)
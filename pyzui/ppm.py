@@ -18,6 +18,8 @@
 
 """Module for reading PPM images."""
 
+import numpy
+
 from tiler import Tiler
 
 def read_ppm_header(f):
@@ -59,24 +61,143 @@ def read_ppm_header(f):
 class PPMTiler(Tiler):
     """PPMTiler objects are used for tiling PPM images.
 
-    Constructor: PPMTiler(string[, string[, string[, int]]])
+    Where possible the pixel data is memory-mapped, so that rows and bands are
+    served as views onto the file without being copied. Otherwise (e.g. if the
+    file is shorter than its header claims) it is read sequentially.
+
+    `infile` may also be a file object such as a pipe, which will be read
+    sequentially as the data arrives. In this case the header is not read
+    until the tiler is run, so that creating the tiler does not block.
+
+    Constructor:
+      PPMTiler(string[, string[, string[, int[, int[, int[, bool[,
+               string[, int[, bool[, bool]]]]]]]]]])
     """
-    def __init__(self, infile, media_id=None, filext='jpg', tilesize=256):
-        Tiler.__init__(self, infile, media_id, filext, tilesize)
+    def __init__(self, infile, media_id=None, filext='jpg', tilesize=256,
+                 workers=1, max_memory=None, resume=False, downsample=None,
+                 writers=2, packed=False, raw=False):
+        Tiler.__init__(self, infile, media_id, filext, tilesize, workers,
+            max_memory, resume, downsample, writers, packed, raw)
 
-        try:
-            self.__ppm_fileobj = open(self._infile, 'rb')
-        except IOError:
-            raise
+        self._bytes_per_pixel = 3
+        self.__pixels = None
+
+        ## the next row to be returned from the memory-mapped pixels
+        self.__row = 0
+
+        if isinstance(self._infile, basestring):
+            try:
+                self.__ppm_fileobj = open(self._infile, 'rb')
+            except IOError:
+                raise
 
+            self.__read_header()
+
+            try:
+                self.__pixels = numpy.memmap(self.__ppm_fileobj, numpy.uint8,
+                    'r', self.__data_offset,
+                    (self._height, self._width, self._bytes_per_pixel))
+            except (EnvironmentError, ValueError):
+                ## the file cannot be mapped, so fall back to reading it
+                self.__ppm_fileobj.seek(self.__data_offset)
+        else:
+            self.__ppm_fileobj = self._infile
+            self._seekable = False
+            self._width = self._height = None
+
+
+    def __read_header(self):
+        """Read the PPM header and set the dimensions of the image.
+
+        __read_header() -> None
+        """
         self._width, self._height = read_ppm_header(self.__ppm_fileobj)
+        if self._seekable:
+            self.__data_offset = self.__ppm_fileobj.tell()
 
-        self._bytes_per_pixel = 3
 
+    _seekable = True
 
     def _scanline(self):
-        return self.__ppm_fileobj.read(self._bytes_per_pixel * self._width)
+        if self.__pixels is None:
+            return self.__ppm_fileobj.read(
+                self._bytes_per_pixel * self._width)
+
+        if self.__row >= self._height:
+            return ''
+        scanline = self.__pixels[self.__row].data
+        self.__row += 1
+        return scanline
+
+
+    def _band(self, height, x=0, width=None):
+        if width is None:
+            width = self._width - x
+        bpp = self._bytes_per_pixel
+
+        if self.__pixels is not None:
+            band = self.__pixels[self.__row : self.__row + height,
+                                 x : x + width]
+            self.__row += height
+            if len(band) < height:
+                raise IOError("less data in image than "
+                    "reported by the header")
+            return band
+
+        rowbytes = self._width * bpp
+        if width == self._width or not self._seekable:
+            ## read whole rows, discarding any columns outside of the band
+            data = self.__ppm_fileobj.read(height * rowbytes)
+            if len(data) < height * rowbytes:
+                ## we've gone past the end of the file
+                raise IOError("less data in image than "
+                    "reported by the header")
+            band = numpy.frombuffer(data, numpy.uint8).reshape(
+                (height, self._width, bpp))
+            return band[:, x : x + width]
+
+        ## read only the columns within the band, so that no more than the
+        ## band is held in memory
+        band = numpy.empty((height, width, bpp), numpy.uint8)
+        start = self.__ppm_fileobj.tell()
+        for pixrow in xrange(height):
+            self.__ppm_fileobj.seek(start + pixrow * rowbytes + x * bpp)
+            data = self.__ppm_fileobj.read(width * bpp)
+            if len(data) < width * bpp:
+                raise IOError("less data in image than "
+                    "reported by the header")
+            band[pixrow].flat = numpy.frombuffer(data, numpy.uint8)
+        self.__ppm_fileobj.seek(start + height * rowbytes)
+        return band
+
+
+    def _seek(self, row):
+        if self.__pixels is not None:
+            self.__row = row
+        else:
+            self.__ppm_fileobj.seek(self.__data_offset
+                + row * self._bytes_per_pixel * self._width)
+
+
+    def run(self):
+        if self._seekable:
+            Tiler.run(self)
+            return
+
+        try:
+            try:
+                self.__read_header()
+            except IOError, e:
+                self.error = str(e)
+            else:
+                Tiler.run(self)
+        finally:
+            ## close the stream so that the writer doesn't block if the
+            ## tiler finished early due to an error
+            self.__ppm_fileobj.close()
 
 
     def __del__(self):
+        ## unmap the file before closing it (reqd to unlink on Windows)
+        self.__pixels = None
         self.__ppm_fileobj.close()
@@ -0,0 +1,170 @@
+## PyZUI 0.1 - Python Zooming User Interface
+## Copyright (C) 2009  David Roberts <d@vidr.cc>
+##
+## This program is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License
+## as published by the Free Software Foundation; either version 2
+## of the License, or (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+## 02110-1301, USA.
+
+"""Bulk tiling of media ahead of time, without a GUI."""
+
+from __future__ import with_statement
+
+from threading import Thread, Lock
+from Queue import Queue, Empty
+import os
+import time
+import logging
+
+import tilestore as TileStore
+from tilingjob import TilingJob
+import tilingstats
+
+_logger = logging.getLogger("pretiler")
+
+## extensions of the files which are tiled when searching directories (other
+## files, including SVG and webpages which aren't tiled without a GUI, are
+## ignored)
+extensions = ('.jpg', '.jpeg', '.png', '.tif', '.tiff', '.gif', '.bmp',
+              '.ppm', '.pgm', '.pbm', '.pnm', '.pdf', '.ps', '.eps')
+
+def find_media(paths):
+    """Return the media_ids of the media given by `paths`, searching any
+    directories recursively. Within directories, hidden files and files
+    without one of `extensions` are ignored.
+
+    find_media(list<string>) -> list<string>
+    """
+    media = []
+    for path in paths:
+        if path.startswith('http://'):
+            media.append(path)
+        elif os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                ## don't descend into hidden directories
+                dirnames[:] = sorted(d for d in dirnames
+                                     if not d.startswith('.'))
+                for filename in sorted(filenames):
+                    if filename.startswith('.') or \
+                       os.path.splitext(filename)[1].lower() \
+                       not in extensions:
+                        continue
+                    media.append(os.path.abspath(
+                        os.path.join(dirpath, filename)))
+        else:
+            media.append(os.path.abspath(path))
+    return media
+
+
+def pretile(media, jobs=1, force=False, tiler_options={}):
+    """Convert and tile each of the given `media` (unless it has already been
+    tiled, or `force` is True), running up to `jobs` TilingJobs at once.
+
+    `tiler_options` are passed to each TilingJob.
+
+    Returns a summary containing the number of media which were 'tiled',
+    'skipped' and 'failed', the 'elapsed' time, the totals of `Tiler.stats`
+    over all of the tiled media along with the overall throughput, the
+    'failures' as a dict mapping media_id to error, and the outcome of each
+    job under 'media'.
+
+    pretile(list<string>[, int[, bool[, dict]]]) -> dict
+    """
+    start_time = time.time()
+
+    queue = Queue()
+    for media_id in media:
+        queue.put(media_id)
+
+    results = []
+    results_lock = Lock()
+
+    def worker():
+        while True:
+            try:
+                media_id = queue.get_nowait()
+            except Empty:
+                return
+
+            if not force and TileStore.tiled(media_id):
+                _logger.info("skipping %s: already tiled", media_id)
+                result = {'media_id': media_id, 'status': 'skipped'}
+            else:
+                _logger.info("tiling %s", media_id)
+                job = TilingJob(media_id, tiler_options)
+                job.run()
+                result = {
+                    'media_id': media_id,
+                    'elapsed': job.elapsed,
+                    'stats': job.stats,
+                }
+                if job.error:
+                    ## the error has already been logged by the job
+                    result['status'] = 'failed'
+                    result['error'] = job.error
+                else:
+                    _logger.info("tiled %s in %.2fs", media_id, job.elapsed)
+                    result['status'] = 'tiled'
+
+            with results_lock:
+                results.append(result)
+
+    threads = []
+    for i in xrange(max(1, min(jobs, len(media)))):
+        thread = Thread(target=worker)
+        thread.setDaemon(True)
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+
+    return _summarise(results, time.time() - start_time)
+
+
+def _summarise(results, elapsed):
+    """Return the summary returned by `pretile` for the given job `results`
+    and `elapsed` time.
+
+    _summarise(list<dict>, float) -> dict
+    """
+    summary = {
+        'elapsed': elapsed,
+        'tiled': 0,
+        'skipped': 0,
+        'failed': 0,
+        'failures': {},
+        'stages': dict.fromkeys(tilingstats.stages, 0.0),
+        'media': sorted(results, key=lambda result: result['media_id']),
+    }
+    for counter in tilingstats.counters:
+        summary[counter] = 0
+
+    for result in results:
+        summary[result['status']] += 1
+        if result['status'] == 'failed':
+            summary['failures'][result['media_id']] = result['error']
+
+        stats = result.get('stats')
+        if stats:
+            for counter in tilingstats.counters:
+                summary[counter] += stats[counter]
+            for stage, seconds in stats['stages'].iteritems():
+                summary['stages'][stage] += seconds
+
+    if elapsed > 0:
+        summary['tiles_per_second'] = summary['tiles'] / elapsed
+        summary['bytes_per_second'] = summary['bytes_read'] / elapsed
+    else:
+        summary['tiles_per_second'] = summary['bytes_per_second'] = 0.0
+
+    return summary
@@ -19,8 +19,12 @@
 """Class for loading tiles from the local tilestore."""
 
 import os
+from cStringIO import StringIO
 
+import numpy
 import Image
+from PyQt4 import QtGui
+import sip
 
 from tileprovider import TileProvider
 import tilestore as TileStore
@@ -35,6 +39,14 @@ class StaticTileProvider(TileProvider):
         TileProvider.__init__(self, tilecache)
 
 
+    def _content_key(self, tile_id):
+        media_id, tilelevel, row, col = tile_id
+        if TileStore.get_raw_level(media_id, tilelevel) is not None or \
+           TileStore.get_pack(media_id):
+            return None
+        return TileStore.get_content_key(TileStore.get_tile_path(tile_id))
+
+
     def _load(self, tile_id):
         media_id, tilelevel, row, col = tile_id
 
@@ -42,10 +54,68 @@ class StaticTileProvider(TileProvider):
         if tilelevel > maxtilelevel:
             return None
 
-        filename = TileStore.get_tile_path(tile_id)
+        raw = TileStore.get_raw_level(media_id, tilelevel)
+        if raw is not None:
+            return self.__load_raw(raw, row, col,
+                TileStore.get_metadata(media_id, 'tilesize'))
+
+        pack = TileStore.get_pack(media_id)
         try:
-            tile = Image.open(filename)
+            if pack:
+                data = pack.read(tilelevel, row, col)
+                if data is None:
+                    return None
+            else:
+                f = open(TileStore.get_tile_path(tile_id), 'rb')
+                try:
+                    data = f.read()
+                finally:
+                    f.close()
+            tile = Image.open(StringIO(data))
             tile.load()
+
+            if self._keep_encoded:
+                ## keep the encoded tile, which is far smaller than its
+                ## pixels
+                tile.encoded = data
+
             return tile
         except IOError:
             return None
+
+
+    def __load_raw(self, raw, row, col, tilesize):
+        """Return the tile at (`row`,`col`) of the given raw plane as a QImage
+        which refers directly to the memory-mapped pixels, or None if there
+        is no such tile.
+
+        QImage requires 32-bit aligned scanlines, so where the width of the
+        plane is not a multiple of 4 pixels the tile has to be copied instead
+        (costing a copy of its pixels for every load, although this is still
+        much cheaper than decoding it).
+
+        __load_raw(numpy.memmap, int, int, int) -> QImage or None
+        """
+        pixels = raw[row*tilesize : (row+1)*tilesize,
+                     col*tilesize : (col+1)*tilesize]
+        height, width = pixels.shape[:2]
+        if width <= 0 or height <= 0:
+            return None
+
+        bytes_per_line = pixels.strides[0]
+        if bytes_per_line % 4 or pixels.ctypes.data % 4:
+            ## QImage requires each scanline to be 32-bit aligned, so the
+            ## pixels need to be copied into an aligned array
+            bytes_per_line = (3*width + 3) // 4 * 4
+            aligned = numpy.empty((height, bytes_per_line), numpy.uint8)
+            aligned[:, :3*width] = pixels.reshape(height, 3*width)
+            pixels = aligned
+
+        image = QtGui.QImage(sip.voidptr(pixels.ctypes.data), width, height,
+            bytes_per_line, QtGui.QImage.Format_RGB888)
+
+        ## the QImage does not own the pixels, so keep them alive for as long
+        ## as it is
+        image.pixels = pixels
+
+        return image
@@ -18,6 +18,10 @@
 
 """Class for representing image tiles."""
 
+import hashlib
+import zlib
+
+import numpy
 import Image
 from ImageQt import ImageQt
 from PyQt4 import QtCore, QtGui
@@ -25,14 +29,21 @@ from PyQt4 import QtCore, QtGui
 class Tile(object):
     """Tile objects allow storage and manipulation of image tiles.
 
-    Constructor: Tile(Image or QImage)
+    Constructor: Tile(Image or QImage[, string])
     """
-    def __init__(self, image):
-        """Create a new tile with the given image."""
+    def __init__(self, image, encoded=None):
+        """Create a new tile with the given image.
+
+        If the image was decoded from a file, then the contents of the file
+        may be given as `encoded`, to be kept for restoring the tile from a
+        CompressedTile. They count towards `nbytes`, so should only be given
+        if the tile may be compressed (i.e. there is an l2 TileCache).
+        """
         if image.__class__ is ImageQt or type(image) is QtGui.QImage:
             self.__image = image
         else:
             self.__image = ImageQt(image)
+        self.__encoded = encoded
 
 
     def crop(self, bbox):
@@ -65,6 +76,30 @@ class Tile(object):
         self.__image.save(filename)
 
 
+    def digest(self):
+        """Return a hash of the dimensions and pixels of the tile, which is
+        the same for any tiles with identical content.
+
+        digest() -> string
+        """
+        image = self.__image.convertToFormat(QtGui.QImage.Format_RGB32)
+        content_hash = hashlib.sha1("%dx%d:" % self.size)
+        content_hash.update(image.bits().asstring(image.numBytes()))
+        return content_hash.hexdigest()
+
+
+    def encode(self, filext):
+        """Return the tile encoded in the format indicated by `filext`, as
+        it would be saved to a file with that extension.
+
+        encode(string) -> string
+        """
+        buf = QtCore.QBuffer()
+        buf.open(QtCore.QIODevice.WriteOnly)
+        self.__image.save(buf, filext.upper())
+        return str(buf.data())
+
+
     def draw(self, painter, x, y):
         """Draw the tile on the given `painter` at the given position.
 
@@ -73,12 +108,95 @@ class Tile(object):
         painter.drawImage(x, y, self.__image)
 
 
+    def toarray(self):
+        """Return the pixels of the tile as an array of RGB values with shape
+        (height, width, 3).
+
+        toarray() -> numpy.ndarray
+        """
+        image = self.__image.convertToFormat(QtGui.QImage.Format_RGB32)
+        width, height = self.size
+
+        ## each pixel is stored as a 32-bit integer of the form 0xffRRGGBB
+        pixels = numpy.frombuffer(image.bits().asstring(image.numBytes()),
+            numpy.uint32).reshape(height, image.bytesPerLine()//4)[:,:width]
+
+        array = numpy.empty((height, width, 3), numpy.uint8)
+        array[:,:,0] = pixels >> 16
+        array[:,:,1] = pixels >> 8
+        array[:,:,2] = pixels
+        return array
+
+
     @property
     def size(self):
         """The dimensions of the tile."""
         return (self.__image.width(), self.__image.height())
 
 
+    @property
+    def encoded(self):
+        """The contents of the file the tile was decoded from, or None if it
+        is not known."""
+        return self.__encoded
+
+
+    @property
+    def nbytes(self):
+        """The number of bytes of memory occupied by the pixels of the tile,
+        along with the contents of the file it was decoded from (if kept)."""
+        nbytes = self.__image.numBytes()
+        if self.__encoded is not None:
+            nbytes += len(self.__encoded)
+        return nbytes
+
+
+
+class CompressedTile(object):
+    """CompressedTile objects hold a tile in compressed form, so that it
+    occupies much less memory but can be restored without loading it again.
+
+    The tile is kept as the contents of the file it was decoded from where
+    they are known, and otherwise its pixels are compressed with a fast
+    codec.
+
+    Constructor: CompressedTile(Tile)
+    """
+    def __init__(self, tile):
+        """Create a new CompressedTile holding the contents of `tile`."""
+        self.__size = tile.size
+        self.__encoded = tile.encoded
+        if self.__encoded is None:
+            self.__data = zlib.compress(tile.toarray().tostring(), 1)
+        else:
+            self.__data = self.__encoded
+
+
+    def decompress(self):
+        """Return the tile.
+
+        Raises `IOError` if the tile cannot be decoded.
+
+        decompress() -> Tile
+        """
+        if self.__encoded is not None:
+            return fromencoded(self.__encoded)
+        width, height = self.__size
+        return fromstring(zlib.decompress(self.__data), width, height)
+
+
+    @property
+    def size(self):
+        """The dimensions of the tile."""
+        return self.__size
+
+
+    @property
+    def nbytes(self):
+        """The number of bytes of memory occupied by the compressed pixels."""
+        return len(self.__data)
+
+
 
 def new(width, height):
     """Create a new tile with the given dimensions.
@@ -97,6 +215,32 @@ def fromstring(string, width, height):
     return Tile(Image.fromstring('RGB', (width, height), string))
 
 
+def fromencoded(data):
+    """Create a new tile from the contents of an image file, which are kept
+    with it (see `Tile.encoded`).
+
+    Raises `IOError` if the image cannot be decoded.
+
+    fromencoded(string) -> Tile
+    """
+    image = QtGui.QImage()
+    if not image.loadFromData(data):
+        raise IOError("unable to decode tile")
+    return Tile(image, data)
+
+
+def fromarray(array):
+    """Create a new tile from an `array` of raw RGB pixels with shape
+    (height, width, 3).
+
+    The array may be a non-contiguous view (such as a region of a larger
+    array), in which case the pixels will be copied exactly once.
+
+    fromarray(numpy.ndarray) -> Tile
+    """
+    return Tile(Image.fromarray(array, 'RGB'))
+
+
 def merged(t1, t2, t3, t4):
     """Merge the given tiles into a single tile.
 
@@ -20,19 +20,23 @@
 
 from __future__ import with_statement
 
-from threading import RLock, Thread
-from collections import deque
+from threading import RLock
 import time
 
+from tile import CompressedTile
+
+## a time that will never be reached
+_never = float('inf')
+
 class TileCache(object):
     """TileCache objects are used for caching tiles in memory.
 
     Tiles can be accessed in much that same way as `dict` objects:
     `tilecache[tile_id]` holds the tile identified by the given `tile_id`.
 
-    Constructor: TileCache(int, int)
+    Constructor: TileCache(int[, int[, int[, TileCache]]])
     """
-    def __init__(self, maxsize=256, maxage=60):
+    def __init__(self, maxsize=256, maxage=60, maxbytes=0, l2=None):
         """Create a new TileCache object.
 
         The maximum number of tiles to store is set by `maxsize`. There will be
@@ -41,24 +45,105 @@ class TileCache(object):
         The maximum age of the tiles (in seconds) allowed before they are
         discarded is set by `maxsize`. There will be no limit if `maxage` <= 0.
 
+        The maximum number of bytes of pixels to store is set by `maxbytes`.
+        There will be no limit if `maxbytes` <= 0.
+
+        Tiles are discarded for being too old whenever the cache is accessed,
+        so no tile older than `maxage` will ever be returned.
+
         None tiles and (0,0,0) tiles do not count towards the number of stored
-        tiles and will therefore not be automatically discarded.
+        tiles and will therefore not be automatically discarded. The pixels of
+        (0,0,0) tiles are included in `nbytes`, but only other tiles will be
+        discarded to keep within `maxbytes`. A tile object stored under
+        several tile_ids (such as tiles with identical content shared by a
+        TileProvider) only counts towards `nbytes` once.
+
+        If a second-tier TileCache is given as `l2`, then tiles discarded for
+        being least recently used or too old are kept in it as
+        CompressedTiles (so it should be limited by `maxbytes`) once
+        `flush_evicted` is called, and can be restored from it with
+        `restore`.
         """
         self.__maxsize = maxsize
         self.__maxage = maxage
+        self.__maxbytes = maxbytes
+        self.__l2 = l2
+
+        ## tiles discarded to the l2 cache, which are compressed once the
+        ## lock has been released
+        self.__evicted = []
 
         self.__d = {}
         self.__atime = {}
         self.__anum = {}
         self.__maxaccesses = {}
-        self.__discard_queue = deque()
         self.__num_tiles = 0
+        self.__nbytes = 0
+        ## number of tile_ids each tile object is stored under and the bytes
+        ## it was counted as, indexed by its id, so that its pixels are only
+        ## counted once
+        self.__tile_refs = {}
+        self.__init_discard_queue()
+
+        ## no tile will be old enough to expire before this time
+        self.__next_expiry = _never
+
+        ## counters for `stats`
+        self.__hits = 0
+        self.__misses = 0
+        self.__insertions = 0
+        self.__none_insertions = 0
+        self.__l2_hits = 0
+        self.__evictions = dict.fromkeys(('lru', 'maxage', 'maxaccesses'), 0)
+        ## hits, misses, tiles and bytes for each media
+        self.__media_stats = {}
 
         self.__lock = RLock()
 
-        self.__periodic_clean_thread = Thread(target=self.__periodic_clean)
-        self.__periodic_clean_thread.setDaemon(True)
-        self.__periodic_clean_thread.start()
+
+    def __init_discard_queue(self):
+        """Empty the discard queue, which holds the mortal tiles in order from
+        least to most recently used.
+
+        The queue is a circular doubly linked list of [prev, next, tile_id]
+        links (indexed by tile_id), so that tiles can be moved to the back of
+        it in constant time.
+
+        __init_discard_queue() -> None
+        """
+        self.__discard_root = root = []
+        root[:] = [root, root, None]
+        self.__discard_links = {}
+
+
+    def __discard_append(self, tile_id):
+        """Add the given tile to the back of the discard queue.
+
+        __discard_append(tuple<string,int,int,int>) -> None
+        """
+        root = self.__discard_root
+        last = root[0]
+        link = [last, root, tile_id]
+        last[1] = root[0] = self.__discard_links[tile_id] = link
+
+
+    def __discard_remove(self, tile_id):
+        """Remove the given tile from the discard queue.
+
+        __discard_remove(tuple<string,int,int,int>) -> None
+        """
+        prev, next, tile_id = self.__discard_links.pop(tile_id)
+        prev[1] = next
+        next[0] = prev
+
+
+    def __discard_first(self):
+        """Return the tile_id at the front of the discard queue (the least
+        recently used tile), or None if the queue is empty.
+
+        __discard_first() -> tuple<string,int,int,int> or None
+        """
+        return self.__discard_root[1][2]
 
 
     def insert(self, tile_id, tile, maxaccesses=0):
@@ -71,7 +156,7 @@ class TileCache(object):
         insert(tuple<string,int,int,int>, object, int) -> None
         """
         with self.__lock:
-            self[tile_id] = tile
+            self.__set(tile_id, tile)
             if maxaccesses > 0:
                 self.__maxaccesses[tile_id] = maxaccesses
 
@@ -111,59 +196,240 @@ class TileCache(object):
         return tile is not None and tile_id[1] != 0
 
 
+    def __tile_nbytes(self, tile):
+        """Return the number of bytes of memory occupied by the pixels of the
+        given tile (which is 0 for None tiles).
+
+        __tile_nbytes(object) -> int
+        """
+        return getattr(tile, 'nbytes', 0)
+
+
+    def __add_ref(self, tile):
+        """Count another tile_id that the given tile is stored under, and
+        return the number of bytes this adds to `nbytes` (which is 0 unless
+        it is the first).
+
+        Precondition: self.__lock is held
+
+        __add_ref(object) -> int
+        """
+        if tile is None:
+            return 0
+        ref = self.__tile_refs.get(id(tile))
+        if ref:
+            ref[0] += 1
+            return 0
+        nbytes = self.__tile_nbytes(tile)
+        self.__tile_refs[id(tile)] = [1, nbytes]
+        return nbytes
+
+
+    def __release_ref(self, tile):
+        """Count one fewer tile_id that the given tile is stored under, and
+        return the number of bytes this frees from `nbytes` (which is 0
+        unless it was the last).
+
+        Precondition: self.__lock is held
+
+        __release_ref(object) -> int
+        """
+        if tile is None:
+            return 0
+        ref = self.__tile_refs[id(tile)]
+        ref[0] -= 1
+        if ref[0]:
+            return 0
+        del self.__tile_refs[id(tile)]
+        return ref[1]
+
+
+    def __get_media_stats(self, media_id):
+        """Return the list of counters [hits, misses, tiles, bytes] for the
+        given media.
+
+        __get_media_stats(string) -> list<int>
+        """
+        try:
+            return self.__media_stats[media_id]
+        except KeyError:
+            media_stats = self.__media_stats[media_id] = [0, 0, 0, 0]
+            return media_stats
+
+
+    def __evict(self, tile_id, reason):
+        """Remove the given tile from the cache, counting it as an eviction
+        for the given reason ('lru', 'maxage', or 'maxaccesses').
+
+        __evict(tuple<string,int,int,int>, string) -> None
+        """
+        self.__evictions[reason] += 1
+        if self.__l2 is not None and reason != 'maxaccesses':
+            self.__evicted.append((tile_id, self.__d[tile_id]))
+        del self[tile_id]
+
+
+    def flush_evicted(self):
+        """Compress the tiles which have been discarded to the l2 cache, and
+        store them in it.
+
+        Tiles are discarded by any access to the cache, including lookups
+        from the thread painting them, so they are only compressed when this
+        is called (by a TileProvider, after each tile it loads). It should
+        be called without holding the lock, so that the compression doesn't
+        hold up other threads.
+
+        flush_evicted() -> None
+        """
+        if not self.__evicted:
+            return
+        with self.__lock:
+            evicted = self.__evicted
+            self.__evicted = []
+        for tile_id, tile in evicted:
+            self.__l2[tile_id] = CompressedTile(tile)
+
+
     def __getitem__(self, tile_id):
+        return self.__get(tile_id)
+
+
+    def __get(self, tile_id):
+        """Return the tile with the given `tile_id`.
+
+        Raises `KeyError` if the tile is not in the cache (even if it is in
+        the l2 cache, as it isn't restored from there here, see `restore`).
+
+        __get(tuple<string,int,int,int>) -> object
+        """
         with self.__lock:
+            now = time.time()
+            if now > self.__next_expiry:
+                self.__expire(now)
             if tile_id in self.__d:
                 tile = self.__d[tile_id]
+                self.__hits += 1
+                self.__get_media_stats(tile_id[0])[0] += 1
 
                 if self.__mortal(tile_id, tile):
                     ## move this tile to the back of the discard queue
-                    self.__discard_queue.remove(tile_id)
-                    self.__discard_queue.append(tile_id)
-                    self.__atime[tile_id] = int(time.time())
+                    self.__discard_remove(tile_id)
+                    self.__discard_append(tile_id)
+                    self.__atime[tile_id] = now
 
                 self.__anum[tile_id] = self.__anum.get(tile_id, 0) + 1
                 if tile_id in self.__maxaccesses and \
                    self.__anum[tile_id] >= self.__maxaccesses[tile_id]:
                     ## tile has expired
-                    del self[tile_id]
+                    self.__evict(tile_id, 'maxaccesses')
 
                 return tile
             else:
+                self.__misses += 1
+                self.__get_media_stats(tile_id[0])[1] += 1
                 raise KeyError
 
 
-    def __periodic_clean(self):
-        """Periodically remove old tiles based on maxage.
+    def restore(self, tile_id):
+        """Restore the tile with the given `tile_id` from the l2 cache, if it
+        is there (or has been discarded but not compressed yet, see
+        `flush_evicted`). Returns True iff it was restored.
 
-        __periodic_clean() -> infinite loop
+        Decompressing the tile takes a while, so this should be called by the
+        thread which would otherwise load the tile (i.e. a TileProvider)
+        rather than by one which is painting it. A tile which can't be
+        decompressed is discarded.
+
+        restore(tuple<string,int,int,int>) -> bool
         """
-        while True:
-            ## make sure the age of tiles never exceeds 4/3 maxage
-            time.sleep(self.__maxage/3)
+        if self.__l2 is None:
+            return False
 
-            with self.__lock:
-                while self.__maxage > 0 and self.__discard_queue and \
-                      time.time() - self.__atime[self.__discard_queue[0]] \
-                        > self.__maxage:
-                    tile_id = self.__discard_queue[0]
-                    del self[tile_id]
+        with self.__lock:
+            for i, (evicted_id, tile) in enumerate(self.__evicted):
+                if evicted_id == tile_id:
+                    ## discarded but not compressed yet
+                    del self.__evicted[i]
+                    self.__l2_hits += 1
+                    if tile_id not in self.__d:
+                        self.__set(tile_id, tile)
+                    return True
+
+        try:
+            compressed = self.__l2[tile_id]
+            del self.__l2[tile_id]
+        except KeyError:
+            ## not in the l2 cache, or another thread has already restored it
+            return False
+
+        ## decompress without holding the lock
+        try:
+            tile = compressed.decompress()
+        except IOError:
+            return False
+
+        with self.__lock:
+            self.__l2_hits += 1
+            if tile_id not in self.__d:
+                self.__set(tile_id, tile)
+        return True
+
+
+    def __expire(self, now=None):
+        """Remove the tiles which are older than maxage at the time `now`
+        (defaulting to the current time).
+
+        The discard queue is in order of access time, so only the tiles at the
+        front of it need to be checked, and nothing needs to be done until the
+        tile at the front is old enough to expire.
+
+        Precondition: self.__lock is held
+
+        __expire([float]) -> None
+        """
+        if now is None:
+            now = time.time()
+        if now <= self.__next_expiry:
+            return
+
+        while self.__discard_links and \
+              now - self.__atime[self.__discard_first()] > self.__maxage:
+            self.__evict(self.__discard_first(), 'maxage')
+
+        if self.__discard_links:
+            self.__next_expiry = \
+                self.__atime[self.__discard_first()] + self.__maxage
+        else:
+            self.__next_expiry = _never
 
 
     def __clean(self):
-        """Remove the least recently used tiles based on maxsize.
+        """Remove the least recently used tiles based on maxsize and
+        maxbytes.
 
         __clean() -> None
         """
         with self.__lock:
             while self.__maxsize > 0 and self.__num_tiles > self.__maxsize:
-                tile_id = self.__discard_queue[0]
-                del self[tile_id]
+                self.__evict(self.__discard_first(), 'lru')
+            while self.__maxbytes > 0 and self.__nbytes > self.__maxbytes \
+                  and self.__discard_links:
+                self.__evict(self.__discard_first(), 'lru')
 
 
     def __setitem__(self, tile_id, tile):
         with self.__lock:
-            if tile_id in self:
+            self.__set(tile_id, tile)
+
+
+    def __set(self, tile_id, tile):
+        """Store the `tile` with the given `tile_id`.
+
+        __set(tuple<string,int,int,int>, object) -> None
+        """
+        with self.__lock:
+            self.__expire()
+            if tile_id in self.__d:
                 if tile is None:
                     ## don't replace an existing tile with a None tile
                     return
@@ -171,25 +437,48 @@ class TileCache(object):
                     del self[tile_id]
 
             self.__d[tile_id] = tile
+            self.__nbytes += self.__add_ref(tile)
+            nbytes = self.__tile_nbytes(tile)
+
+            if tile is None:
+                self.__none_insertions += 1
+            else:
+                self.__insertions += 1
+                media_stats = self.__get_media_stats(tile_id[0])
+                media_stats[2] += 1
+                media_stats[3] += nbytes
 
             if self.__mortal(tile_id, tile):
-                self.__discard_queue.append(tile_id)
-                self.__atime[tile_id] = int(time.time())
+                self.__discard_append(tile_id)
+                self.__atime[tile_id] = time.time()
                 self.__num_tiles += 1
 
-                self.__clean()
+                if self.__maxage > 0:
+                    self.__next_expiry = min(self.__next_expiry,
+                        self.__atime[tile_id] + self.__maxage)
 
             elif tile_id not in self.__d:
                 self.__d[tile_id] = None
 
+            ## immortal tiles may take other tiles over the byte limit
+            self.__clean()
+
 
     def __delitem__(self, tile_id):
         with self.__lock:
             if self.__mortal(tile_id, self.__d[tile_id]):
-                self.__discard_queue.remove(tile_id)
+                self.__discard_remove(tile_id)
                 del self.__atime[tile_id]
                 self.__num_tiles -= 1
 
+            tile = self.__d[tile_id]
+            self.__nbytes -= self.__release_ref(tile)
+            nbytes = self.__tile_nbytes(tile)
+            if tile is not None:
+                media_stats = self.__get_media_stats(tile_id[0])
+                media_stats[2] -= 1
+                media_stats[3] -= nbytes
+
             if tile_id in self.__maxaccesses:
                 del self.__maxaccesses[tile_id]
 
@@ -198,6 +487,7 @@ class TileCache(object):
 
     def __contains__(self, tile_id):
         with self.__lock:
+            self.__expire()
             return tile_id in self.__d
 
 
@@ -210,5 +500,73 @@ class TileCache(object):
         self.__atime = {}
         self.__anum = {}
         self.__maxaccesses = {}
-        self.__discard_queue = deque()
         self.__num_tiles = 0
+        self.__nbytes = 0
+        self.__tile_refs = {}
+        self.__init_discard_queue()
+        self.__next_expiry = _never
+        self.__evicted = []
+        if self.__l2 is not None:
+            self.__l2.purge()
+        for media_stats in self.__media_stats.itervalues():
+            media_stats[2] = media_stats[3] = 0
+
+
+    def stats(self):
+        """Return a snapshot of the cache's statistics as a dict containing:
+
+        hits, misses         the number of tiles which were or weren't found
+        l2_hits              the number of misses which were restored from
+                             the l2 cache
+        insertions           the number of (non-None) tiles stored
+        none_insertions      the number of None tiles stored
+        evictions            a dict of the number of tiles discarded because
+                             of 'lru' (maxsize or maxbytes), 'maxage', or
+                             'maxaccesses'
+        tiles, bytes         the number of (non-None) tiles currently stored,
+                             and the bytes occupied by their pixels (counting
+                             shared tiles once)
+        maxsize, maxbytes    the limits of the cache
+        media                a dict mapping each media_id to a dict of its
+                             hits, misses, tiles and bytes (where tiles
+                             shared between media count towards each)
+
+        stats() -> dict
+        """
+        with self.__lock:
+            self.__expire()
+            media = {}
+            for media_id, (hits, misses, tiles, nbytes) in \
+                self.__media_stats.iteritems():
+                media[media_id] = {
+                    'hits': hits,
+                    'misses': misses,
+                    'tiles': tiles,
+                    'bytes': nbytes,
+                }
+            return {
+                'hits': self.__hits,
+                'misses': self.__misses,
+                'l2_hits': self.__l2_hits,
+                'insertions': self.__insertions,
+                'none_insertions': self.__none_insertions,
+                'evictions': dict(self.__evictions),
+                'tiles': sum(m['tiles'] for m in media.itervalues()),
+                'bytes': self.__nbytes,
+                'maxsize': self.__maxsize,
+                'maxbytes': self.__maxbytes,
+                'media': media,
+            }
+
+
+    @property
+    def nbytes(self):
+        """The number of bytes of memory occupied by the pixels of the tiles
+        in the cache."""
+        return self.__nbytes
+
+
+    @property
+    def l2(self):
+        """The second-tier TileCache, or None if there isn't one."""
+        return self.__l2
@@ -18,8 +18,6 @@
 
 """Tiled media to be displayed in the ZUI."""
 
-import tempfile
-import os
 import math
 import logging
 
@@ -28,10 +26,7 @@ from ImageQt import ImageQt
 
 from mediaobject import MediaObject, LoadError, RenderMode
 import tilemanager as TileManager
-from ppm import PPMTiler
-from webkitconverter import  WebKitConverter
-from pdfconverter import PDFConverter
-from magickconverter import MagickConverter
+import conversionmanager as ConversionManager
 
 class TiledMediaObject(MediaObject):
     """TiledMediaObject objects are used to represent tiled media that can be
@@ -49,10 +44,9 @@ class TiledMediaObject(MediaObject):
 
         self.__loaded = False
 
-        self.__tmpfile = None
-
-        self.__converter = None
-        self.__tiler = None
+        ## the job converting and tiling the media, which may be shared with
+        ## other objects for the same media
+        self.__job = None
 
         self.__logger = logging.getLogger(str(self))
 
@@ -70,30 +64,7 @@ class TiledMediaObject(MediaObject):
             TileManager.load_tile((self._media_id, 0, 0, 0))
         else:
             self.__logger.info("need to tile media")
-            fd, self.__tmpfile = tempfile.mkstemp('.ppm')
-            os.close(fd)
-            if self._media_id.startswith('http://') or \
-               self._media_id.lower().endswith('.html') or \
-               self._media_id.lower().endswith('.htm'):
-                self.__converter = WebKitConverter(
-                    self._media_id, self.__tmpfile)
-                self.__ppmfile = self.__tmpfile
-                self.__converter.start()
-            elif self._media_id.lower().endswith('.pdf'):
-                self.__converter = PDFConverter(
-                    self._media_id, self.__tmpfile)
-                self.__ppmfile = self.__tmpfile
-                self.__converter.start()
-            elif self._media_id.lower().endswith('.ppm'):
-                ## assume media_id is a local PPM file
-                self.__logger.info(
-                    "assuming media is a local PPM file")
-                self.__ppmfile = self._media_id
-            else:
-                self.__converter = MagickConverter(
-                    self._media_id, self.__tmpfile)
-                self.__ppmfile = self.__tmpfile
-                self.__converter.start()
+            self.__job = ConversionManager.request(self._media_id, self)
 
 
     transparent = False
@@ -107,14 +78,10 @@ class TiledMediaObject(MediaObject):
 
     @property
     def __progress(self):
-        if self.__converter is None and self.__tiler is None:
+        if self.__job is None:
             return 0.0
-        elif self.__converter is None:
-            return self.__tiler.progress
-        elif self.__tiler is None:
-            return 0.5 * self.__converter.progress
         else:
-            return 0.5 * (self.__converter.progress + self.__tiler.progress)
+            return self.__job.progress
 
 
     def __pixpos2rowcol(self, pixpos, tilescale):
@@ -140,10 +107,12 @@ class TiledMediaObject(MediaObject):
             if self.__aspect_ratio >= 1.0:
                 ## width >= height
                 col_bound = 2**tilelevel - 1
-                row_bound = int((2**tilelevel)/self.__aspect_ratio) - 1
+                row_bound = int(math.ceil(
+                    (2**tilelevel)/self.__aspect_ratio)) - 1
             else:
                 ## height > width
-                col_bound = int((2**tilelevel)*self.__aspect_ratio) - 1
+                col_bound = int(math.ceil(
+                    (2**tilelevel)*self.__aspect_ratio)) - 1
                 row_bound = 2**tilelevel - 1
         else:
             tile_pixsize = self.__tilesize \
@@ -211,6 +180,16 @@ class TiledMediaObject(MediaObject):
         return tileblock
 
 
+    def __release_tileblock(self):
+        """Release the cached tileblock, so that objects which aren't being
+        drawn don't hold on to memory outside of the TileManager's caches.
+
+        __release_tileblock() -> None
+        """
+        self.__tileblock = None
+        self.__tileblock_id = None
+
+
     def __render_media(self, painter, mode):
         """Render the media using the given painter and render mode.
 
@@ -222,6 +201,7 @@ class TiledMediaObject(MediaObject):
         if min(self.onscreen_size) <= 1 or mode == RenderMode.Invisible:
             ## don't bother rendering if the image is too
             ## small to be seen, or invisible mode is set
+            self.__release_tileblock()
             return
         if mode == RenderMode.Draft:
             transform_mode = QtCore.Qt.FastTransformation
@@ -246,6 +226,7 @@ class TiledMediaObject(MediaObject):
 
         if row_max < row_min or col_max < col_min:
             ## the image does not fall within the viewport
+            self.__release_tileblock()
             return
 
         tileblock_id = (tilelevel, row_min, col_min, row_max, col_max)
@@ -323,17 +304,7 @@ class TiledMediaObject(MediaObject):
         else:
             self.__logger.info("media loaded")
             self.__loaded = True
-
-            if self.__tiler:
-                ## destory tiler to close tmpfile (reqd to unlink on Windows)
-                self.__tiler = None
-
-            if self.__tmpfile:
-                try:
-                    os.unlink(self.__tmpfile)
-                except:
-                    self.__logger.exception("unable to unlink temporary file "
-                        "'%s'" % self.__tmpfile)
+            self.__job = None
 
             old_x1, old_y1 = self.topleft
             old_x2, old_y2 = self.bottomright
@@ -356,41 +327,28 @@ class TiledMediaObject(MediaObject):
                 self.centre = old_centre
 
 
-    def __run_tiler(self):
-        """Run the tiler (after checking that there is an image to run
-        the tiler on).
+    def __visible_area(self, mode):
+        """Return the area (in pixels) of the viewport occupied by the
+        object when rendered in the given mode.
 
-        __run_tiler() -> None
+        __visible_area(int) -> float
         """
-        if not os.path.exists(self.__ppmfile):
-            ## there was a problem converting, or the input file
-            ## never actually existed
-            if self.__converter and self.__converter.error:
-                raise LoadError(self.__converter.error)
-            else:
-                raise LoadError("there was a problem "
-                    "converting and/or loading the input file")
-
-        if self._media_id.lower().endswith('.jpg'):
-            filext = 'jpg'
-        else:
-            filext = 'png'
-
-        try:
-            self.__tiler = PPMTiler(
-                self.__ppmfile, self._media_id, filext)
-            self.__tiler.start()
-        except IOError, e:
-            raise LoadError("there was an error creating the tiler: %s" % e)
+        if mode == RenderMode.Invisible:
+            return 0.0
+        x1, y1 = self.topleft
+        x2, y2 = self.bottomright
+        viewport_w, viewport_h = self._scene.viewport_size
+        w = min(x2, viewport_w) - max(x1, 0)
+        h = min(y2, viewport_h) - max(y1, 0)
+        return max(w, 0) * max(h, 0)
 
 
     def render(self, painter, mode):
         if self.__loaded:
             self.__render_media(painter, mode)
 
-        elif self.__tiler and self.__tiler.error:
-            raise LoadError("an error ocurred during "
-                "the tiling process: %s" % self.__tiler.error)
+        elif self.__job and self.__job.error:
+            raise LoadError(self.__job.error)
 
         elif TileManager.tiled(self._media_id):
             self.__try_load()
@@ -399,15 +357,10 @@ class TiledMediaObject(MediaObject):
             else:
                 self.__render_placeholder(painter)
 
-        elif self.__tiler is None and \
-             (self.__converter is None or self.__converter.progress == 1.0):
-            ## the tiler has not been run yet and either
-            ## it was assumed that media_id is a local PPM
-            ## file or the converter has just finished
-            self.__run_tiler()
-            self.__render_placeholder(painter)
-
         else:
+            ## tile the media that can be seen first
+            ConversionManager.set_priority(self._media_id, self,
+                self.__visible_area(mode))
             self.__render_placeholder(painter)
 
 
@@ -25,6 +25,7 @@ no tiles of the requested resolution are available.
 """
 
 import logging
+import re
 
 import Image
 from PyQt4 import QtCore, QtGui
@@ -36,17 +37,74 @@ from osmtileprovider import OSMTileProvider
 from globalmosaictileprovider import GlobalMosaicTileProvider
 from mandeltileprovider import MandelTileProvider
 from ferntileprovider import FernTileProvider
+from pdftileprovider import PDFTileProvider
 
-def init(total_cache_size=192):
+## suffixes of memory sizes, and the number of bytes they stand for
+__memory_units = {
+    '':  1,
+    'K': 1024,
+    'M': 1024**2,
+    'G': 1024**3,
+    'T': 1024**4,
+}
+
+def __parse_memory_limit(memory_limit):
+    """Return the number of bytes given by `memory_limit`, which is either a
+    number of bytes (such as 2e9) or a string such as '512MB' or '2G'.
+
+    Raises `ValueError` if `memory_limit` cannot be parsed.
+
+    __parse_memory_limit(number or string) -> int
+    """
+    if not isinstance(memory_limit, basestring):
+        return int(memory_limit)
+
+    match = re.match(r'^\s*([\d.]+)\s*([KMGT]?)I?B?\s*$',
+        memory_limit.upper())
+    if not match:
+        raise ValueError("invalid memory limit %r" % memory_limit)
+    return int(float(match.group(1)) * __memory_units[match.group(2)])
+
+
+def init(total_cache_size=192, dynamic_pdf=False, memory_limit=None,
+         l2_memory_limit=None):
     """Initialise the TileManager. This **must** be called before any other
     functions are called.
 
-    init() -> None
+    The tile caches hold up to `total_cache_size` tiles, unless a
+    `memory_limit` is given, in which case they are limited by the memory
+    occupied by the pixels of their tiles instead. This may be a number of
+    bytes, or a string such as '512MB' or '2GB'.
+
+    If `l2_memory_limit` is given (in the same form as `memory_limit`), then
+    tiles discarded from the tile cache are kept compressed in a second-tier
+    cache of that size, from which they can be restored much more quickly
+    than by loading them again.
+
+    If `dynamic_pdf` is True, then PDFs which have not already been tiled will
+    have their tiles rendered on demand by a PDFTileProvider, rather than
+    being converted and tiled in full before they can be viewed. By default
+    PDFs are converted and tiled in full as before.
+
+    init([int[, bool[, number or string[, number or string]]]]) -> None
     """
-    global __tilecache, __temptilecache, __tp_static, __tp_dynamic, __logger
+    global __tilecache, __temptilecache, __l2tilecache, __tp_static, \
+        __tp_dynamic, __tp_pdf, __dynamic_pdfs, __logger
 
-    __tilecache =     TileCache(0.8 * total_cache_size)
-    __temptilecache = TileCache(0.2 * total_cache_size)
+    if l2_memory_limit is None:
+        __l2tilecache = None
+    else:
+        __l2tilecache = TileCache(0, 0,
+            maxbytes=__parse_memory_limit(l2_memory_limit))
+
+    if memory_limit is None:
+        __tilecache =     TileCache(0.8 * total_cache_size, l2=__l2tilecache)
+        __temptilecache = TileCache(0.2 * total_cache_size)
+    else:
+        memory_limit = __parse_memory_limit(memory_limit)
+        __tilecache =     TileCache(0, maxbytes=0.8 * memory_limit,
+                                    l2=__l2tilecache)
+        __temptilecache = TileCache(0, maxbytes=0.2 * memory_limit)
 
     __tp_static = StaticTileProvider(__tilecache)
     __tp_static.start()
@@ -60,8 +118,37 @@ def init(total_cache_size=192):
     for tp in __tp_dynamic.itervalues():
         tp.start()
 
+    if dynamic_pdf:
+        __tp_pdf = PDFTileProvider(__tilecache)
+        __tp_pdf.start()
+    else:
+        __tp_pdf = None
+    __dynamic_pdfs = set()
+
     __logger = logging.getLogger("TileManager")
 
+
+def __is_dynamic_pdf(media_id):
+    """Return True iff the media identified by `media_id` is a PDF whose
+    tiles are rendered on demand by the PDFTileProvider.
+
+    __is_dynamic_pdf(string) -> bool
+    """
+    if media_id in __dynamic_pdfs:
+        return True
+    elif __tp_pdf is None or not media_id.lower().endswith('.pdf') or \
+         (TileStore.identity_known(media_id) and TileStore.tiled(media_id)):
+        ## prefer tiles that have already been made by a Tiler (unless
+        ## finding them would mean hashing the PDF, see `tiled`)
+        return False
+    else:
+        ## the PDF isn't read until its first tile is loaded by the
+        ## PDFTileProvider, so that this never blocks the GUI thread (if it
+        ## can't be read, then no tiles will be available for it)
+        __dynamic_pdfs.add(media_id)
+        return True
+
+
 def load_tile(tile_id):
     """Request that the tile identified by `tile_id` be loaded into the
     tilecache.
@@ -73,6 +160,8 @@ def load_tile(tile_id):
 
     if media_id in __tp_dynamic:
         __tp_dynamic[media_id].request(tile_id)
+    elif __is_dynamic_pdf(media_id):
+        __tp_pdf.request(tile_id)
     else:
         __tp_static.request(tile_id)
 
@@ -198,11 +287,20 @@ def get_tile_robust(tile_id):
 def tiled(media_id):
     """Returns True iff the media identified by `media_id` has been tiled.
 
-    Will always return True for dynamic media.
+    Will always return True for dynamic media, including PDFs rendered on
+    demand. Returns False for media whose contents haven't been hashed yet
+    (see `TileStore.media_identity`), as this is called from the GUI thread;
+    it is hashed by the ConversionManager instead, which finds any existing
+    tiles before tiling it.
 
     tiled(string) -> bool
     """
-    return media_id.startswith('dynamic:') or TileStore.tiled(media_id)
+    if media_id.startswith('dynamic:'):
+        return True
+    elif not TileStore.identity_known(media_id):
+        return __is_dynamic_pdf(media_id)
+    else:
+        return TileStore.tiled(media_id) or __is_dynamic_pdf(media_id)
 
 
 def get_metadata(media_id, key):
@@ -217,13 +315,36 @@ def get_metadata(media_id, key):
         elif key == 'tilesize':     return tp.tilesize
         elif key == 'aspect_ratio': return tp.aspect_ratio
         else: return None
+    elif __is_dynamic_pdf(media_id):
+        if   key == 'filext':       return __tp_pdf.filext
+        elif key == 'tilesize':     return __tp_pdf.tilesize
+        elif key == 'aspect_ratio':
+            return __tp_pdf.get_aspect_ratio(media_id)
+        else: return None
     else:
         return TileStore.get_metadata(media_id, key)
 
 
+def get_cache_stats():
+    """Return snapshots of the statistics (see `TileCache.stats`) of the
+    'main' tile cache, the 'temp' cache of temporary cut tiles, and the 'l2'
+    cache of compressed tiles (if there is one).
+
+    get_cache_stats() -> dict<string,dict>
+    """
+    stats = {
+        'main': __tilecache.stats(),
+        'temp': __temptilecache.stats(),
+    }
+    if __l2tilecache is not None:
+        stats['l2'] = __l2tilecache.stats()
+    return stats
+
+
 def purge(media_id=None):
-    """Purge the specified `media_id` from the `TileProvider`s. If `media_id`
-    is omitted then all media will be purged.
+    """Purge the specified `media_id` from the `TileProvider`s, and close any
+    files held open for it by the TileStore. If `media_id` is omitted then all
+    media will be purged.
 
     purge([string]) -> None
 
@@ -233,6 +354,9 @@ def purge(media_id=None):
     __tp_static.purge(media_id)
     for tp in __tp_dynamic.itervalues():
         tp.purge(media_id)
+    if __tp_pdf:
+        __tp_pdf.purge(media_id)
+    TileStore.close_media(media_id)
 
 
 class MediaNotTiled(Exception):
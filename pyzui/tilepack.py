@@ -0,0 +1,306 @@
+## PyZUI 0.1 - Python Zooming User Interface
+## Copyright (C) 2009  David Roberts <d@vidr.cc>
+##
+## This program is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License
+## as published by the Free Software Foundation; either version 2
+## of the License, or (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+## 02110-1301, USA.
+
+"""Single-file container for storing all of the tiles of a media.
+
+A pack file consists of a header, followed by a record for each tile (the
+tile_id and length of the encoded tile, followed by the encoded tile itself),
+followed by an index of the offsets of the records and a footer locating the
+index. Records are only ever appended, and the index is added once all of
+the tiles have been written.
+
+Appending from several processes to the same file is only atomic on POSIX
+systems, so each process writing tiles in parallel appends them to a part
+file of its own instead (see `start_part`), and the records of the parts are
+appended to the pack file by `finish`.
+"""
+
+from __future__ import with_statement
+
+import os
+import struct
+from threading import Lock
+
+## identifies a pack file
+header_magic = "PYZUIPK1"
+
+## identifies the footer of a completed pack file
+footer_magic = "PYZUIIX1"
+
+## tilelevel, row, col, length of tile
+_record = struct.Struct('<HIII')
+
+## tilelevel, row, col, offset of tile, length of tile
+_index_entry = struct.Struct('<HIIQI')
+
+## offset of index, number of index entries, footer_magic
+_footer = struct.Struct('<QI8s')
+
+def _scan(f):
+    """Scan the records of the pack file `f` and return the index built from
+    them, along with the offset of the end of the last complete record.
+
+    Where a tile has been written more than once, the last record is used.
+
+    _scan(file) -> tuple<dict<tuple<int,int,int>,tuple<long,int>>,long>
+    """
+    f.seek(0)
+    if f.read(len(header_magic)) != header_magic:
+        raise IOError("not a tile pack file")
+
+    size = os.fstat(f.fileno()).st_size
+    index = {}
+    end = f.tell()
+    while True:
+        record = f.read(_record.size)
+        if len(record) < _record.size:
+            break
+        tilelevel, row, col, length = _record.unpack(record)
+        offset = end + _record.size
+        if offset + length > size:
+            ## the record was only partially written
+            break
+        index[(tilelevel, row, col)] = (offset, length)
+        end = offset + length
+        f.seek(end)
+
+    return index, end
+
+
+def _part_files(filename):
+    """Return the paths of the part files of the pack file `filename` (see
+    `start_part`).
+
+    _part_files(string) -> list<string>
+    """
+    dirname, basename = os.path.split(filename)
+    prefix = basename + "."
+    return [os.path.join(dirname, name)
+            for name in sorted(os.listdir(dirname or os.curdir))
+            if name.startswith(prefix) and name[len(prefix):].isdigit()]
+
+
+def _merge_parts(f, filename):
+    """Append the complete records of each part file of the pack file
+    `filename` to `f` (which is open on it), removing the part files.
+
+    Returns the offset of the end of the last complete record in `f`.
+
+    _merge_parts(file, string) -> long
+    """
+    end = _scan(f)[1]
+    for path in _part_files(filename):
+        part = open(path, 'rb')
+        try:
+            try:
+                part_end = _scan(part)[1]
+            except IOError:
+                ## the header was never written, so there are no records
+                part_end = None
+            if part_end is not None:
+                part.seek(len(header_magic))
+                f.seek(end)
+                remaining = part_end - len(header_magic)
+                while remaining > 0:
+                    data = part.read(min(remaining, 1024 * 1024))
+                    if not data:
+                        break
+                    f.write(data)
+                    remaining -= len(data)
+                end = f.tell()
+        finally:
+            part.close()
+        os.unlink(path)
+    f.truncate(end)
+    return end
+
+
+def start(filename, resume=False):
+    """Create the pack file `filename` ready for records to be appended by
+    `TilePackWriter`s.
+
+    If `resume` is True and the file already exists, then the records already
+    in it (and in its part files) will be kept, less any incomplete records.
+    Otherwise any part files are removed.
+
+    start(string[, bool]) -> None
+    """
+    if resume and os.path.exists(filename):
+        f = open(filename, 'r+b')
+        try:
+            _merge_parts(f, filename)
+        finally:
+            f.close()
+    else:
+        for path in _part_files(filename):
+            os.unlink(path)
+        f = open(filename, 'wb')
+        f.write(header_magic)
+        f.close()
+
+
+def start_part(filename):
+    """Return the path of the part file of the pack file `filename` for the
+    current process, creating it if necessary, so that records can be
+    appended to it by `TilePackWriter`s whilst other processes append to
+    their own.
+
+    start_part(string) -> string
+    """
+    path = "%s.%d" % (filename, os.getpid())
+    if not os.path.exists(path):
+        f = open(path, 'wb')
+        f.write(header_magic)
+        f.close()
+    return path
+
+
+def finish(filename, packfile):
+    """Append the records of any part files and then the index to the pack
+    file `filename`, and then move it to `packfile`, after which no more
+    records may be added.
+
+    finish(string, string) -> None
+    """
+    f = open(filename, 'r+b')
+    try:
+        _merge_parts(f, filename)
+        index, end = _scan(f)
+        f.seek(end)
+        f.truncate()
+        for (tilelevel, row, col), (offset, length) in \
+            sorted(index.iteritems()):
+            f.write(_index_entry.pack(tilelevel, row, col, offset, length))
+        f.write(_footer.pack(end, len(index), footer_magic))
+    finally:
+        f.close()
+
+    if os.path.exists(packfile):
+        ## required on Windows
+        os.unlink(packfile)
+    os.rename(filename, packfile)
+
+
+class TilePackWriter(object):
+    """TilePackWriter objects are used for appending tiles to a pack file
+    which has been created by `start`.
+
+    Each tile is written with a single unbuffered write to a file opened for
+    appending, so any number of threads may share a writer. Other processes
+    should write to part files of their own (see `start_part`).
+
+    Constructor: TilePackWriter(string)
+    """
+    def __init__(self, filename):
+        flags = os.O_WRONLY | os.O_APPEND | getattr(os, 'O_BINARY', 0)
+        self.__fd = os.open(filename, flags)
+
+        ## appending isn't atomic everywhere (e.g. on Windows)
+        self.__lock = Lock()
+
+
+    def write(self, tile_id, data):
+        """Append the encoded tile `data` for the tile identified by `tile_id`.
+
+        write(tuple<string,int,int,int>, string) -> None
+        """
+        media_id, tilelevel, row, col = tile_id
+        record = _record.pack(tilelevel, row, col, len(data)) + data
+        with self.__lock:
+            written = os.write(self.__fd, record)
+        if written != len(record):
+            raise IOError("unable to write tile to pack file")
+
+
+    def close(self):
+        """Close the pack file.
+
+        close() -> None
+        """
+        if self.__fd is not None:
+            os.close(self.__fd)
+            self.__fd = None
+
+
+    def __del__(self):
+        self.close()
+
+
+class TilePack(object):
+    """TilePack objects are used for reading tiles from a completed pack file,
+    requiring a single seek and read for each tile.
+
+    Raises `IOError` if the pack file is invalid.
+
+    Constructor: TilePack(string)
+    """
+    def __init__(self, filename):
+        self.__file = open(filename, 'rb')
+        self.__lock = Lock()
+
+        try:
+            self.__file.seek(-_footer.size, 2)
+            index_offset, numentries, magic = \
+                _footer.unpack(self.__file.read(_footer.size))
+            if magic != footer_magic:
+                raise IOError("tile pack file has no index")
+
+            self.__file.seek(index_offset)
+            data = self.__file.read(numentries * _index_entry.size)
+            if len(data) < numentries * _index_entry.size:
+                raise IOError("tile pack index is truncated")
+        except:
+            self.__file.close()
+            raise
+
+        self.__index = {}
+        for i in xrange(numentries):
+            tilelevel, row, col, offset, length = _index_entry.unpack_from(
+                data, i * _index_entry.size)
+            self.__index[(tilelevel, row, col)] = (offset, length)
+
+
+    def read(self, tilelevel, row, col):
+        """Return the encoded tile at the given position, or None if there is
+        no such tile in the pack.
+
+        read(int, int, int) -> string or None
+        """
+        try:
+            offset, length = self.__index[(tilelevel, row, col)]
+        except KeyError:
+            return None
+
+        with self.__lock:
+            if self.__file.closed:
+                return None
+            self.__file.seek(offset)
+            return self.__file.read(length)
+
+
+    def __contains__(self, position):
+        return position in self.__index
+
+
+    def close(self):
+        """Close the pack file, after which no more tiles can be read from it.
+
+        close() -> None
+        """
+        with self.__lock:
+            self.__file.close()
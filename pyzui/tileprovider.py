@@ -20,8 +20,9 @@
 
 from __future__ import with_statement
 
-from threading import Thread, Condition
+from threading import Thread, Condition, Lock
 from collections import deque
+from weakref import WeakValueDictionary
 import logging
 
 from tile import Tile
@@ -63,9 +64,45 @@ class TileProvider(Thread):
         self.__tasks_available.release()
 
 
+    ## tiles which are currently loaded, indexed by their content key (see
+    ## `_content_key`), so that tiles with identical content can share a
+    ## single Tile object
+    __shared_tiles = WeakValueDictionary()
+    __shared_tiles_lock = Lock()
+
+    def _content_key(self, tile_id):
+        """Return a key identifying the content of the requested tile, such
+        that tiles with the same key are known to be identical, or None if
+        this is unknown.
+
+        Derived classes whose tiles may be shared (see
+        `TileStore.store_tile`) should override this.
+
+        _content_key(tuple<string,int,int,int>) -> object or None
+        """
+        return None
+
+
+    ## derived classes should set this to True if tiles may only become
+    ## shared once they have been loaded, in which case `_content_key` is
+    ## checked again afterwards (otherwise it is only checked once per load)
+    _shared_on_load = False
+
+    @property
+    def _keep_encoded(self):
+        """Whether the contents of the files that tiles are decoded from
+        should be kept with them (see `_load`), which is only worthwhile if
+        they can be restored from an l2 cache."""
+        return self.__tilecache.l2 is not None
+
+
     def _load(self, tile_id):
         """Load the requested tile, and return it as an `Image` object.
 
+        If `_keep_encoded` is True, then derived classes may also give the
+        contents of the file it was decoded from as the image's `encoded`
+        attribute.
+
         Returns None if the tile does not exist.
 
         _load(tuple<string,int,int,int>) -> Image or None
@@ -85,21 +122,58 @@ class TileProvider(Thread):
             tile_id = self.__tasks.pop()
             self.__tasks_available.release()
 
-            if tile_id not in self.__tilecache:
-                try:
-                    tile = self._load(tile_id)
-                except Exception:
-                    self._logger.exception("error loading tile")
-                    tile = None
+            if tile_id not in self.__tilecache and \
+               not self.__tilecache.restore(tile_id):
+                tile = self.__load_shared(tile_id)
 
                 if tile:
                     self._logger.debug("loaded %s", str(tile_id))
-                    self.__tilecache[tile_id] = Tile(tile)
+                    self.__tilecache[tile_id] = tile
                     del tile
                 else:
                     self._logger.debug("unavailable %s", str(tile_id))
                     self.__tilecache[tile_id] = None
 
+            ## compress the tiles discarded from the tilecache here, rather
+            ## than in the thread looking up tiles to paint
+            self.__tilecache.flush_evicted()
+
+
+    def __load_shared(self, tile_id):
+        """Load the requested tile, or reuse an identical tile which is
+        already loaded. Returns None if the tile is unavailable.
+
+        __load_shared(tuple<string,int,int,int>) -> Tile or None
+        """
+        try:
+            key = self._content_key(tile_id)
+            if key is not None:
+                with self.__shared_tiles_lock:
+                    tile = self.__shared_tiles.get(key)
+                if tile is not None:
+                    return tile
+
+            image = self._load(tile_id)
+            if not image:
+                return None
+
+            ## providers may keep the contents of the file the image was
+            ## decoded from, for restoring the tile if it is compressed
+            if self._keep_encoded:
+                tile = Tile(image, getattr(image, 'encoded', None))
+            else:
+                tile = Tile(image)
+            if key is None and self._shared_on_load:
+                ## the tile may only have been shared once it was loaded
+                key = self._content_key(tile_id)
+            if key is not None:
+                with self.__shared_tiles_lock:
+                    tile = self.__shared_tiles.setdefault(key, tile)
+            return tile
+        except Exception:
+            self._logger.exception("error loading tile")
+            return None
+
 
     def purge(self, media_id=None):
         """Purge all tasks for the given `media_id`. All tasks will be purged
@@ -20,34 +20,99 @@
 
 from __future__ import with_statement
 
-from threading import Thread
+from threading import Thread, Lock
 import os
 import math
 import logging
 import shutil
+import multiprocessing
+import sys
+import time
+import json
+from collections import deque
+
+import numpy
 
 import tilestore as TileStore
 import tile as Tile
+from tilewriter import TileWriter, save_tile
+import tilepack
+from tilepack import TilePackWriter
+from tilingstats import TilingStats
 
 class Tiler(Thread):
     """Tiler objects are used for tiling images.
 
-    Constructor: Tiler(string[, string[, string[, int]]])
+    Constructor:
+      Tiler(string[, string[, string[, int[, int[, int[, bool[, string[,
+            int[, bool[, bool]]]]]]]]]])
     """
-    def __init__(self, infile, media_id=None, filext='jpg', tilesize=256):
+    def __init__(self, infile, media_id=None, filext='jpg', tilesize=256,
+                 workers=1, max_memory=None, resume=False, downsample=None,
+                 writers=2, packed=False, raw=False):
         """Create a new Tiler for tiling the media given by `media_id` with the
         image given by `infile`.
 
-        If `media_id` is omitted, it will be set to `infile`.
+        If `media_id` is omitted, it will be set to `infile`. Derived classes
+        may also accept a file object for `infile` (in which case `media_id`
+        must be given), although such images will not be tiled in parallel.
 
         Tiles will be saved in the format indicated by `filext` and with the
         dimensions given by `tilesize`.
+
+        If `workers` > 1, then the image will be divided into bands which are
+        tiled in parallel by that many worker processes. Derived classes must
+        accept the same constructor arguments as Tiler for this to be
+        possible.
+
+        If `max_memory` is given, then the image will be tiled in bands small
+        enough that the image data held by the tiling process (including any
+        worker processes) is expected to occupy no more than that many bytes,
+        and fewer workers will be used if necessary. Bands narrower than the
+        full width of the image require `_seekable` to be True.
+
+        If `resume` is True, then a checkpoint will be recorded in the
+        TileStore as each band is completed, and the media directory will not
+        be deleted if an error occurs. A later Tiler for the same media with
+        `resume` set will then continue from the last checkpoint, provided the
+        image has the same dimensions. Checkpoints are removed once tiling has
+        completed.
+
+        If `downsample` is 'box' or 'lanczos', then tiles will be merged and
+        scaled by 1/2 for each tilelevel as arrays, using a 2x2 box filter or a
+        Lanczos (a=3) filter respectively. Otherwise Qt will be used to merge
+        and scale them.
+
+        If `writers` > 0, then tiles will be encoded and saved by that many
+        background threads (see `TileWriter`) whilst the next tiles are being
+        produced. Otherwise they will be saved as soon as they are produced.
+
+        If `packed` is True, then the tiles will be appended to a single pack
+        file (see `tilepack`) rather than being saved to a file each.
+
+        If `raw` is True, then each tilelevel will also be stored uncompressed
+        as a single plane of RGB pixels (see `TileStore.get_raw_level`), so
+        that tiles can be loaded from it without being decoded.
         """
         Thread.__init__(self)
 
         self._infile = infile
         self.__filext = filext
         self.__tilesize = tilesize
+        self.__workers = workers
+        self.__workers_used = 1
+        self.__max_memory = max_memory
+        self.__resume = resume
+
+        if downsample not in (None, 'box', 'lanczos'):
+            raise ValueError("unknown downsampling filter %r" % downsample)
+        self.__downsample = downsample
+        self.__writers = writers
+        self.__writer = None
+        self.__packed = packed
+        self.__pack = None
+        self.__raw = raw
+        self.__raw_levels = {}
 
         if media_id:
             self.__media_id = media_id
@@ -55,14 +120,38 @@ class Tiler(Thread):
             self.__media_id = infile
 
         self.__outpath = TileStore.get_media_path(self.__media_id)
+        self.__packfile = TileStore.get_pack_path(self.__media_id)
+        self.__partial_packfile = self.__packfile + ".part"
+        ## the file that tiles are appended to, which is a part file of
+        ## our own within worker processes (see `tilepack.start_part`)
+        self.__pack_target = self.__partial_packfile
+        self.__checkpoint_path = \
+            TileStore.get_checkpoint_path(self.__media_id)
 
         self.__progress = 0.0
+        ## progress is also made by the threads saving tiles
+        self.__progress_lock = Lock()
+
+        self.__peak_memory = None
+        self.__worker_peak_memory = {}
+
+        self.__stats = TilingStats()
+        self.__start_time = None
+        self.__end_time = None
 
         self.__logger = logging.getLogger(str(self))
 
+        if workers > 1 and not isinstance(infile, basestring):
+            ## worker processes must be able to open the image themselves
+            self.__logger.warning("unable to tile a file object in parallel")
+            self.__workers = 1
+
         self.error = None
 
 
+    ## derived classes should set this to True if they implement `_seek`
+    _seekable = False
+
     def _scanline(self):
         """Return string containing pixels of the next row.
 
@@ -71,34 +160,291 @@ class Tiler(Thread):
         pass
 
 
+    def _band(self, height, x=0, width=None):
+        """Return an array containing the pixels of the next `height` rows,
+        restricted to the `width` columns starting from column `x` (or the
+        rest of the row if `width` is None), with shape
+        (height, width, bytes_per_pixel).
+
+        Derived classes which are able to read several rows at once should
+        override this, otherwise it is assembled from calls to `_scanline`.
+        Seekable derived classes should avoid reading the columns outside of
+        the band where possible, as the memory budget (see `max_memory`)
+        only allows for the columns requested.
+
+        _band(int[, int[, int]]) -> numpy.ndarray
+        """
+        if width is None:
+            width = self._width - x
+
+        band = numpy.empty((height, width, self._bytes_per_pixel),
+            numpy.uint8)
+
+        rowbytes = self._width * self._bytes_per_pixel
+        start = x * self._bytes_per_pixel
+        for pixrow in xrange(height):
+            scanline = self._scanline()
+            if len(scanline) < rowbytes:
+                ## we've gone past the end of the file
+                raise IOError("less data in image than "
+                    "reported by the header")
+            band[pixrow].flat = numpy.frombuffer(scanline, numpy.uint8,
+                band[pixrow].nbytes, start)
+
+        return band
+
+
+    def _decode_memory(self):
+        """Return the number of bytes of memory that each process tiling the
+        image holds in order to read it, aside from the bands themselves.
+
+        Derived classes which decode the whole image into memory should
+        override this, so that it is included in the memory budget.
+
+        _decode_memory() -> int
+        """
+        return 0
+
+
+    def _seek(self, row):
+        """Move to the given pixel `row`, such that it will be the next row
+        returned by `_scanline` or `_band`.
+
+        Derived classes which are able to seek within the image should override
+        this and set `_seekable` to True.
+
+        _seek(int) -> None
+        """
+        pass
+
+
+    def __seek(self, row):
+        """Move to the given pixel `row`. If the image is not seekable, then
+        rows will be read and discarded to skip ahead to it.
+
+        __seek(int) -> None
+        """
+        if row == self.__nextrow:
+            return
+        elif self._seekable:
+            self._seek(row)
+        elif row > self.__nextrow:
+            while self.__nextrow < row:
+                height = min(self.__tilesize, row - self.__nextrow)
+                with self.__stats.timed('read'):
+                    band = self._band(height)
+                self.__stats.add('bytes_read', band.nbytes)
+                self.__nextrow += height
+        else:
+            raise IOError("unable to seek backwards within the image")
+
+        self.__nextrow = row
+
+
     def __savetile(self, tile, tilelevel, row, col):
         """Save the given tile to disk.
 
         __save(Tile, int, int, int) -> None
         """
         tile_id = (self.__media_id, tilelevel, row, col)
-        filename = TileStore.get_tile_path(
-            tile_id, True, self.__outpath, self.__filext)
-        tile.save(filename)
+        if self.__writer:
+            ## progress is made once the writer has saved the tile
+            self.__writer.save(tile, tile_id, self.__outpath, self.__filext)
+        else:
+            save_tile(tile, tile_id, self.__outpath, self.__filext,
+                self.__pack, self.__stats)
+            self.__tile_saved(tile_id)
+
+        if self.__raw:
+            with self.__stats.timed('write'):
+                plane = self.__raw_level(tilelevel)
+                array = self.__toarray(tile)
+                y = row * self.__tilesize
+                x = col * self.__tilesize
+                plane[y : y + array.shape[0], x : x + array.shape[1]] = array
+
+
+    def __tile_saved(self, tile_id):
+        """Record the progress made by saving the tile identified by
+        `tile_id`.
+
+        __tile_saved(tuple<string,int,int,int>) -> None
+        """
+        with self.__progress_lock:
+            percent = int(self.__progress*100)
+            self.__progress += 1.0/self.__numtiles
+            if int(self.__progress*100) != percent:
+                ## only log each percentage once, rather than for every tile
+                self.__logger.info("%3d%% tiled", int(self.__progress*100))
+
+
+    def __add_progress(self, progress):
+        """Add the given amount of progress, made by tiling a band of the
+        image elsewhere.
+
+        __add_progress(float) -> None
+        """
+        with self.__progress_lock:
+            self.__progress += progress
+
+
+    def __start_writer(self):
+        """Open the pack file and start the background threads for saving
+        tiles, if required.
+
+        __start_writer() -> None
+        """
+        if self.__packed:
+            self.__pack = TilePackWriter(self.__pack_target)
+        if self.__writers > 0:
+            self.__writer = TileWriter(self.__writers, pack=self.__pack,
+                stats=self.__stats, callback=self.__tile_saved)
+
+
+    def __flush_writer(self):
+        """Wait until all of the tiles produced so far have been saved.
+
+        __flush_writer() -> None
+        """
+        if self.__writer:
+            self.__writer.flush()
+        for plane in self.__raw_levels.itervalues():
+            plane.flush()
+
+
+    def __stop_writer(self):
+        """Stop the background threads for saving tiles, once they have dealt
+        with any outstanding tiles.
+
+        __stop_writer() -> None
+        """
+        if self.__writer:
+            self.__writer.close()
+            self.__writer = None
+        if self.__pack:
+            self.__pack.close()
+            self.__pack = None
+        for plane in self.__raw_levels.itervalues():
+            plane.flush()
+        self.__raw_levels = {}
+
+
+    def __start_pack(self):
+        """Prepare the pack file for the tiles to be appended to, if required,
+        keeping the tiles of any checkpointed bands. Otherwise remove any
+        pack file left from a previous tiling, so that it doesn't hide the
+        new tiles.
+
+        __start_pack() -> None
+        """
+        if not self.__packed:
+            if os.path.exists(self.__packfile):
+                os.unlink(self.__packfile)
+            return
+
+        if not os.path.isdir(self.__outpath):
+            os.makedirs(self.__outpath)
+        tilepack.start(self.__partial_packfile, bool(self.__checkpoints))
+
+
+    def __start_raw(self):
+        """Create the raw planes for each tilelevel, if required, keeping
+        those containing any checkpointed bands. Otherwise remove any raw
+        planes left from a previous tiling.
+
+        __start_raw() -> None
+        """
+        rawpath = os.path.dirname(TileStore.get_raw_path(self.__media_id, 0))
+
+        if not self.__raw:
+            shutil.rmtree(rawpath, ignore_errors=True)
+            return
+
+        if not os.path.isdir(rawpath):
+            os.makedirs(rawpath)
+
+        for tilelevel in xrange(self.__maxtilelevel+1):
+            filename = TileStore.get_raw_path(self.__media_id, tilelevel)
+            width, height = self.__calculate_level_size(tilelevel)
+            shape = (height, width, 3)
 
-        self.__progress += 1.0/self.__numtiles
-        self.__logger.info("%3d%% tiled", int(self.__progress*100))
+            if self.__checkpoints and os.path.exists(filename):
+                plane = numpy.lib.format.open_memmap(filename, 'r+')
+                if plane.shape == shape:
+                    self.__raw_levels[tilelevel] = plane
+                    continue
+                del plane
 
+            self.__raw_levels[tilelevel] = numpy.lib.format.open_memmap(
+                filename, 'w+', numpy.uint8, shape)
 
-    def __load_row_from_file(self, row):
-        """Load the requested row from the image file.
 
-        __load_row_from_file(int) -> list<Tile>
+    def __raw_level(self, tilelevel):
+        """Return the raw plane for the given tilelevel, opening the one
+        created by `__start_raw` if necessary (as within worker processes).
+
+        __raw_level(int) -> numpy.memmap
+        """
+        if tilelevel not in self.__raw_levels:
+            self.__raw_levels[tilelevel] = numpy.lib.format.open_memmap(
+                TileStore.get_raw_path(self.__media_id, tilelevel), 'r+')
+        return self.__raw_levels[tilelevel]
+
+
+    def __fromarray(self, array):
+        """Return the given array of pixels as a tile, in the form used for
+        merging and scaling (which is the array itself when downsampling with
+        arrays).
+
+        __fromarray(numpy.ndarray) -> Tile or numpy.ndarray
+        """
+        if self.__downsample:
+            return array
+        else:
+            return Tile.fromarray(array)
+
+
+    def __toarray(self, tile):
+        """Return the pixels of the given tile as an array, the reverse of
+        `__fromarray`.
+
+        __toarray(Tile or numpy.ndarray) -> numpy.ndarray
+        """
+        if self.__downsample:
+            return tile
+        else:
+            return tile.toarray()
+
+
+    def __sample_memory(self):
+        """Update the peak memory usage of this process.
+
+        __sample_memory() -> None
+        """
+        memory = _resident_memory()
+        if memory is not None:
+            self.__peak_memory = max(self.__peak_memory, memory)
+
+
+    def __load_row_from_file(self, row, col=0, numcols=None):
+        """Load the requested row from the image file, restricted to `numcols`
+        tiles starting from `col` (or the whole row if `numcols` is None).
+
+        __load_row_from_file(int[, int[, int]]) -> list<Tile>
 
         Precondition: calls to this function must take consecutive values for
-        row i.e. the first call must have row=0, then the next call must have
-        row=1, etc.
+        row i.e. the first call (since the last call to `__seek`) must be for
+        the first row, then the next call must be for the following row, etc.
         """
-        if row >= self.__numtiles_down_total:
+        if row >= self.__numtiles_down_total or \
+           col >= self.__numtiles_across_total:
             ## requested row does not exist
             return None
 
-        tiles = [''] * self.__numtiles_across_total
+        if numcols is None:
+            numcols = self.__numtiles_across_total - col
+        else:
+            numcols = min(numcols, self.__numtiles_across_total - col)
 
         if row == self.__numtiles_down_total-1:
             ## we're in the bottom row
@@ -106,29 +452,28 @@ class Tiler(Thread):
         else:
             tileheight = self.__tilesize
 
-        for pixrow in xrange(tileheight):
-            scanline = self._scanline()
-            if scanline == '':
-                ## we've gone past the end of the file
-                raise IOError("less data in image than "
-                    "reported by the header")
-            for i in xrange(self.__numtiles_across_total):
-                p = self._bytes_per_pixel * i * self.__tilesize
-                if i == self.__numtiles_across_total-1:
-                    ## last tile in row
-                    tiles[i] += scanline[p:]
-                else:
-                    tiles[i] += \
-                        scanline[p : p + self._bytes_per_pixel*self.__tilesize]
-
-        for i in xrange(self.__numtiles_across_total):
-            if i == self.__numtiles_across_total-1:
-                ## last tile in row
-                tiles[i] = Tile.fromstring(tiles[i],
-                    self.__right_tiles_width, tileheight)
-            else:
-                tiles[i] = Tile.fromstring(tiles[i],
-                    self.__tilesize, tileheight)
+        ## only read the columns beneath the requested tiles
+        left = col * self.__tilesize
+        width = min(numcols * self.__tilesize, self._width - left)
+
+        with self.__stats.timed('read'):
+            band = self._band(tileheight, left, width)
+        self.__stats.add('bytes_read', band.nbytes)
+        self.__nextrow += tileheight
+
+        ## the band is the largest thing held at once, so this is
+        ## representative of the peak memory usage (reading /proc for every
+        ## tile would be needlessly expensive)
+        self.__sample_memory()
+
+        with self.__stats.timed('assemble'):
+            tiles = []
+            for i in xrange(numcols):
+                ## each tile is a view onto the band, the right-most tile
+                ## being truncated to the width of the image by the slice
+                x = i * self.__tilesize
+                tiles.append(
+                    self.__fromarray(band[:, x : x + self.__tilesize]))
 
         return tiles
 
@@ -151,16 +496,22 @@ class Tiler(Thread):
             row_a.append(None)
             row_b.append(None)
 
-        tiles = []
-        while row_a:
-            tiles.append(Tile.merged(
-                row_a.pop(0), row_a.pop(0),
-                row_b.pop(0), row_b.pop(0)))
+        if self.__downsample:
+            merged = _merged
+        else:
+            merged = Tile.merged
+
+        with self.__stats.timed('downsample'):
+            tiles = []
+            while row_a:
+                tiles.append(merged(
+                    row_a.pop(0), row_a.pop(0),
+                    row_b.pop(0), row_b.pop(0)))
 
         return tiles
 
 
-    def __tiles(self, tilelevel=0, row=0):
+    def __tiles(self, tilelevel=0, row=0, col=0, numcols=None):
         """Recursive function which retrieves the tiles in the given row, saves
         them, scales each dimension by 1/2, and then returns them as a list.
 
@@ -169,15 +520,26 @@ class Tiler(Thread):
         requesting row 0 from tilelevel 0 will result in the entire image being
         tiled.
 
-        __tiles(int, int) -> list<Tile>
+        If `numcols` is given, then only that many tiles starting from `col`
+        will be retrieved. Otherwise the whole row is retrieved, and if it lies
+        in the bandlevel it will be tiled a band at a time.
+
+        __tiles(int, int[, int[, int]]) -> list<Tile>
         """
+        if numcols is None and tilelevel == self.__bandlevel:
+            return self.__load_row_from_bands(row)
+
         if tilelevel == self.__maxtilelevel:
-            tiles = self.__load_row_from_file(row)
+            tiles = self.__load_row_from_file(row, col, numcols)
         else:
             ## load the requested row by merging sub-tiles from
             ## tilelevel (tilelevel+1)
-            row_a = self.__tiles(tilelevel+1, row*2)
-            row_b = self.__tiles(tilelevel+1, row*2+1)
+            if numcols is not None:
+                subcols = 2 * numcols
+            else:
+                subcols = None
+            row_a = self.__tiles(tilelevel+1, row*2,   col*2, subcols)
+            row_b = self.__tiles(tilelevel+1, row*2+1, col*2, subcols)
             tiles = self.__mergerows(row_a, row_b)
 
         if not tiles:
@@ -185,12 +547,401 @@ class Tiler(Thread):
             return None
 
         for i in xrange(len(tiles)):
-            self.__savetile(tiles[i], tilelevel, row, i)
-            tiles[i] = tiles[i].resize(tiles[i].size[0]/2, tiles[i].size[1]/2)
+            self.__savetile(tiles[i], tilelevel, row, col+i)
+            with self.__stats.timed('downsample'):
+                if self.__downsample:
+                    tiles[i] = _halved(tiles[i], self.__downsample)
+                else:
+                    tiles[i] = tiles[i].resize(
+                        tiles[i].size[0]/2, tiles[i].size[1]/2)
 
         return tiles
 
 
+    def __load_band(self, tilelevel, row, col, numcols):
+        """Tile the band of the image lying beneath the `numcols` tiles
+        starting from (`row`,`col`) in `tilelevel`, and return those tiles
+        (scaled by 1/2 as returned by `__tiles`).
+
+        __load_band(int, int, int, int) -> list<Tile>
+
+        Precondition: either `_seekable` is True, or the band lies below the
+        last band to be loaded
+        """
+        tilescale = 2**(self.__maxtilelevel-tilelevel)
+        self.__seek(row * tilescale * self.__tilesize)
+        return self.__tiles(tilelevel, row, col, numcols)
+
+
+    def __load_row_from_bands(self, row):
+        """Load the requested row of the bandlevel by tiling each of the bands
+        beneath it, or by collecting the results of the worker processes that
+        have already done so.
+
+        __load_row_from_bands(int) -> list<Tile>
+
+        Precondition: calls to this function must take consecutive values for
+        row, as with `__load_row_from_file`.
+        """
+        if row >= self.__calculate_numrows(self.__bandlevel):
+            ## requested row does not exist
+            return None
+
+        numcols = self.__calculate_numcols(self.__bandlevel)
+        bandcols = self.__bandcols or numcols
+
+        tiles = []
+        for col in xrange(0, numcols, bandcols):
+            if (row, col) in self.__checkpoints:
+                arrays, progress = self.__load_checkpoint(row, col)
+                self.__add_progress(progress)
+                tiles.extend([self.__fromarray(array) for array in arrays])
+
+            elif self.__bands is None:
+                progress = self.__progress
+                band = self.__load_band(self.__bandlevel, row, col, bandcols)
+                if self.__resume:
+                    ## the tiles must be saved before the band is checkpointed
+                    self.__flush_writer()
+                    self.__save_checkpoint(row, col,
+                        [self.__toarray(tile) for tile in band],
+                        self.__progress - progress)
+                tiles.extend(band)
+
+            else:
+                pid, arrays, progress, peak_memory, stats = \
+                    self.__bands.next()
+
+                self.__add_progress(progress)
+                self.__stats.merge(stats)
+                self.__logger.info("%3d%% tiled", int(self.__progress*100))
+
+                if peak_memory is not None:
+                    self.__worker_peak_memory[pid] = max(peak_memory,
+                        self.__worker_peak_memory.get(pid, 0))
+
+                if self.__resume:
+                    self.__save_checkpoint(row, col, arrays, progress)
+                tiles.extend([self.__fromarray(array) for array in arrays])
+
+        self.__sample_memory()
+
+        return tiles
+
+
+    def _tile_band(self, tilelevel, row, col, numcols):
+        """Tile the band of the image lying beneath the `numcols` tiles
+        starting from (`row`,`col`) in `tilelevel`.
+
+        Returns a tuple containing the process ID, the pixels of those tiles
+        (scaled by 1/2 as returned by `__tiles`), the amount of progress made,
+        the peak memory usage of this process, and a snapshot of the time
+        spent in each stage of tiling the band (see `TilingStats.snapshot`).
+
+        This is called from within worker processes when tiling in parallel.
+
+        _tile_band(int, int, int, int)
+        -> tuple<int,list<numpy.ndarray>,float,int,dict>
+
+        Precondition: no rows have been read from the image yet
+        """
+        self.__prepare()
+        self.__logger = logging.getLogger("%s[band %d,%d]" % (self, row, col))
+
+        if self.__packed:
+            self.__pack_target = tilepack.start_part(self.__partial_packfile)
+        self.__start_writer()
+        try:
+            tiles = self.__load_band(tilelevel, row, col, numcols)
+            self.__flush_writer()
+        finally:
+            self.__stop_writer()
+
+        arrays = [self.__toarray(tile) for tile in tiles]
+        return os.getpid(), arrays, self.__progress, self.__peak_memory, \
+            self.__stats.snapshot()
+
+
+    def __checkpoint_plan(self):
+        """Return a dict describing how the image is being tiled, which must
+        match for checkpoints to be reused.
+
+        __checkpoint_plan() -> dict<string,string>
+        """
+        return {
+            'filext': str(self.__filext),
+            'tilesize': str(self.__tilesize),
+            'downsample': str(self.__downsample),
+            'packed': str(self.__packed),
+            'raw': str(self.__raw),
+            'width': str(self._width),
+            'height': str(self._height),
+            'bandlevel': str(self.__bandlevel),
+            'bandcols': str(self.__bandcols),
+        }
+
+
+    def __load_checkpoints(self):
+        """If there are checkpoints from a previous attempt at tiling this
+        media which match the current image, then adopt its bands and return
+        True. Otherwise return False.
+
+        __load_checkpoints() -> bool
+        """
+        try:
+            f = open(os.path.join(self.__checkpoint_path, "plan"), 'U')
+        except IOError:
+            return False
+
+        plan = {}
+        for line in f:
+            key, val = line.split()
+            plan[key] = val
+        f.close()
+
+        if plan.get('bandlevel') in (None, 'None') or \
+           plan.get('bandcols') not in ('None', '1') or \
+           (plan['bandcols'] == '1' and not self._seekable):
+            return False
+
+        self.__bandlevel = int(plan['bandlevel'])
+        if plan['bandcols'] == '1':
+            self.__bandcols = 1
+        if plan != self.__checkpoint_plan():
+            self.__bandlevel = self.__bandcols = None
+            return False
+
+        for filename in os.listdir(self.__checkpoint_path):
+            if filename.endswith('.npz') and not filename.startswith('tmp'):
+                row, col = filename[:-4].split('_')
+                self.__checkpoints.add((int(row), int(col)))
+
+        self.__logger.info("resuming from %d checkpointed bands",
+            len(self.__checkpoints))
+
+        return True
+
+
+    def __clear_checkpoints(self):
+        """Remove all checkpoints for this media.
+
+        __clear_checkpoints() -> None
+        """
+        shutil.rmtree(self.__checkpoint_path, ignore_errors=True)
+        self.__checkpoints = set()
+
+
+    def __start_checkpoints(self):
+        """Remove any stale checkpoints and record the current plan.
+
+        __start_checkpoints() -> None
+        """
+        self.__clear_checkpoints()
+        os.makedirs(self.__checkpoint_path)
+        f = open(os.path.join(self.__checkpoint_path, "plan"), 'w')
+        for key, val in self.__checkpoint_plan().iteritems():
+            f.write("%s\t%s\n" % (key, val))
+        f.close()
+
+
+    def __save_checkpoint(self, row, col, arrays, progress):
+        """Record that the band at (`row`,`col`) of the bandlevel has been
+        tiled, along with the given pixels of its scaled tiles and the
+        progress made.
+
+        __save_checkpoint(int, int, list<numpy.ndarray>, float) -> None
+        """
+        filename = os.path.join(self.__checkpoint_path,
+            "%06d_%06d.npz" % (row, col))
+        tmpfile = os.path.join(self.__checkpoint_path,
+            "tmp%06d_%06d.npz" % (row, col))
+
+        ## rename the completed file into place, so that an interrupted save
+        ## will never be mistaken for a checkpoint
+        numpy.savez(tmpfile, numpy.array(progress), *arrays)
+        os.rename(tmpfile, filename)
+
+
+    def __load_checkpoint(self, row, col):
+        """Load the pixels of the scaled tiles and the progress recorded for
+        the band at (`row`,`col`) of the bandlevel.
+
+        __load_checkpoint(int, int) -> tuple<list<numpy.ndarray>,float>
+        """
+        filename = os.path.join(self.__checkpoint_path,
+            "%06d_%06d.npz" % (row, col))
+        npz = numpy.load(filename)
+        try:
+            ## numpy.savez names positional arrays arr_0, arr_1, etc.
+            progress = float(npz['arr_0'])
+            arrays = [npz['arr_%d' % i] for i in xrange(1, len(npz.files))]
+        finally:
+            npz.close()
+
+        return arrays, progress
+
+
+    def __estimate_memory(self, width, toplevel, bottomlevel):
+        """Estimate the peak memory (in bytes) required to build tilelevels
+        `toplevel` to `bottomlevel` for a region of the image which is `width`
+        pixels wide in `bottomlevel`.
+
+        __estimate_memory(int, int, int) -> int
+        """
+        memory = 0
+        for tilelevel in xrange(toplevel, bottomlevel+1):
+            ## each tilelevel holds up to two rows of 32-bit tiles whilst the
+            ## tilelevel beneath it is being merged
+            memory += 2 * 4 * self.__tilesize * \
+                (width >> (bottomlevel-tilelevel))
+
+        if bottomlevel == self.__maxtilelevel:
+            ## the band of 24-bit pixels that the tiles are created from, and
+            ## the copy made of each tile
+            memory += 2 * 3 * self.__tilesize * width
+
+        return memory
+
+
+    def __estimate_bands(self, bandlevel, bandcols, workers):
+        """Estimate the peak memory (in bytes) required to tile the image in
+        bands from `bandlevel` which are `bandcols` tiles across (None for the
+        full width of the image), with `workers` of them being tiled
+        simultaneously.
+
+        __estimate_bands(int or None, int or None, int) -> int
+        """
+        tilelevel = bandlevel or 0
+        tilescale = 2**(self.__maxtilelevel - tilelevel)
+        if bandcols is None:
+            width = self._width
+        else:
+            width = min(self._width, bandcols * tilescale * self.__tilesize)
+
+        ## memory required for the bands being tiled simultaneously, plus
+        ## this process building the tilelevels above them
+        memory = workers * (self._decode_memory() +
+            self.__estimate_memory(width, tilelevel, self.__maxtilelevel))
+        if tilelevel > 0:
+            memory += self.__estimate_memory(
+                (self._width + 2*tilescale - 1) // (2*tilescale),
+                0, tilelevel-1)
+        return memory
+
+
+    def __plan_bands(self):
+        """Choose the bandlevel and the number of tiles across each band
+        (None for the full width of the image), and the number of worker
+        processes to use.
+
+        __plan_bands() -> None
+        """
+        if self.__resume and self.__load_checkpoints():
+            ## continue with the bands used by the previous attempt, if they
+            ## can be tiled within the memory budget (which may have changed)
+            workers = self.__workers
+            while self.__max_memory and workers > 1 and \
+                  self.__estimate_bands(self.__bandlevel, self.__bandcols,
+                      workers) > self.__max_memory:
+                workers -= 1
+            if not self.__max_memory or self.__estimate_bands(
+               self.__bandlevel, self.__bandcols, workers) \
+               <= self.__max_memory:
+                self.__workers_used = workers
+                return
+
+            self.__logger.info("checkpointed bands cannot be tiled within "
+                "%d bytes of memory, starting afresh", self.__max_memory)
+            self.__bandlevel = self.__bandcols = None
+            self.__checkpoints = set()
+
+        if self.__workers > 1:
+            ## keep all of the workers busy
+            numbands = 4 * self.__workers
+        elif self.__resume:
+            ## provide a reasonable number of checkpoints
+            numbands = 16
+        else:
+            numbands = None
+
+        if numbands:
+            ## choose the smallest tilelevel that provides enough bands, so as
+            ## to leave as little work as possible for this process
+            bandlevel = self.__maxtilelevel
+            for tilelevel in xrange(self.__maxtilelevel+1):
+                if self.__calculate_numrows(tilelevel) >= numbands:
+                    bandlevel = tilelevel
+                    break
+        else:
+            bandlevel = None
+
+        bandcols = None
+        workers = self.__workers
+
+        if self.__max_memory:
+            estimate = self.__estimate_bands
+            if estimate(bandlevel or 0, None, workers) > self.__max_memory:
+                if self._seekable:
+                    ## use square bands, as tall as will fit in memory
+                    bandcols = 1
+                    bandlevel = bandlevel or 0
+                    while bandlevel < self.__maxtilelevel and \
+                          estimate(bandlevel, 1, workers) > self.__max_memory:
+                        bandlevel += 1
+                    while workers > 1 and \
+                          estimate(bandlevel, 1, workers) > self.__max_memory:
+                        workers -= 1
+                    self.__logger.debug("using bands of a single tile "
+                        "from tilelevel %d to fit in memory", bandlevel)
+
+                if estimate(bandlevel or 0, bandcols, workers) \
+                   > self.__max_memory:
+                    self.__logger.warning("unable to tile within %d bytes "
+                        "of memory", self.__max_memory)
+
+        self.__bandlevel = bandlevel
+        self.__bandcols = bandcols
+        self.__workers_used = workers
+
+        if self.__resume:
+            self.__start_checkpoints()
+
+
+    def __tiles_parallel(self):
+        """Tile the image by distributing its bands amongst a pool of worker
+        processes, and then building the remaining tilelevels from their
+        results.
+
+        __tiles_parallel() -> None
+        """
+        numcols = self.__calculate_numcols(self.__bandlevel)
+        bandcols = self.__bandcols or numcols
+
+        tasks = [(type(self),
+                  (self._infile, self.__media_id, self.__filext,
+                   self.__tilesize, 1, None, False, self.__downsample,
+                   self.__writers, self.__packed, self.__raw),
+                  (self.__bandlevel, row, col, bandcols))
+                 for row in xrange(self.__calculate_numrows(self.__bandlevel))
+                 for col in xrange(0, numcols, bandcols)
+                 if (row, col) not in self.__checkpoints]
+
+        self.__logger.debug("tiling %d bands from tilelevel %d "
+            "with %d workers", len(tasks), self.__bandlevel,
+            self.__workers_used)
+
+        pool = multiprocessing.Pool(self.__workers_used)
+        try:
+            ## limit the number of finished bands waiting to be collected
+            self.__bands = _imap_bounded(pool, _tile_band, tasks,
+                2 * self.__workers_used)
+            self.__tiles()
+        finally:
+            self.__bands = None
+            pool.terminate()
+            pool.join()
+
+
     def __calculate_maxtilelevel(self):
         """Calculate the maxtilelevel, which is the smallest non-negative
         integer such that:
@@ -223,6 +974,43 @@ class Tiler(Thread):
             return maxtilelevel
 
 
+    def __calculate_numrows(self, tilelevel):
+        """Calculate the number of rows of tiles in the given tilelevel.
+
+        __calculate_numrows(int) -> int
+        """
+        real_tilesize = 2**(self.__maxtilelevel-tilelevel) * self.__tilesize
+        return (self._height+real_tilesize-1)//real_tilesize
+
+
+    def __calculate_numcols(self, tilelevel):
+        """Calculate the number of columns of tiles in the given tilelevel.
+
+        __calculate_numcols(int) -> int
+        """
+        real_tilesize = 2**(self.__maxtilelevel-tilelevel) * self.__tilesize
+        return (self._width+real_tilesize-1)//real_tilesize
+
+
+    def __calculate_level_size(self, tilelevel):
+        """Calculate the dimensions of the given tilelevel in pixels, as the
+        sum of the dimensions of its tiles.
+
+        __calculate_level_size(int) -> tuple<int,int>
+        """
+        def halved(length):
+            ## each tile is scaled by 1/2 (rounding down) before being merged
+            ## into the tilelevel above
+            numtiles = (length + self.__tilesize - 1) // self.__tilesize
+            last = length - (numtiles - 1) * self.__tilesize
+            return (numtiles - 1) * (self.__tilesize // 2) + last // 2
+
+        width, height = self._width, self._height
+        for level in xrange(self.__maxtilelevel, tilelevel, -1):
+            width, height = halved(width), halved(height)
+        return width, height
+
+
     def __calculate_numtiles(self):
         """Calculate the total number of tiles required.
 
@@ -246,14 +1034,11 @@ class Tiler(Thread):
         return numtiles
 
 
-    def run(self):
-        """Tile the image. If any errors are encountered then `self.error` will
-        be set to a string describing the error.
+    def __prepare(self):
+        """Calculate the dimensions of the tile pyramid.
 
-        run() -> None
+        __prepare() -> None
         """
-        self.__logger.debug("beginning tiling process")
-
         self.__maxtilelevel = self.__calculate_maxtilelevel()
         self.__numtiles = self.__calculate_numtiles()
 
@@ -268,14 +1053,68 @@ class Tiler(Thread):
         self.__right_tiles_width =   (self._width  - 1) % self.__tilesize + 1
         self.__bottom_tiles_height = (self._height - 1) % self.__tilesize + 1
 
+        self.__bandlevel = None
+        self.__bandcols = None
+        self.__bands = None
+        self.__workers_used = 1
+        self.__checkpoints = set()
+
+        ## the next pixel row to be read from the image
+        self.__nextrow = 0
+
+
+    def run(self):
+        """Tile the image. If any errors are encountered then `self.error` will
+        be set to a string describing the error.
+
+        run() -> None
+        """
+        self.__logger.debug("beginning tiling process")
+        self.__start_time = time.time()
+
+        self.__prepare()
+
+        ## any tiles which are replaced may be the last links to their blobs
+        retiling = TileStore.deduplicate and os.path.exists(self.__outpath)
+
         try:
-            with TileStore.disk_lock:
-                ## recursively tile the image
-                self.__tiles()
+            with TileStore.disk_access(self.__media_id):
+                ## the pack file and raw planes are about to be replaced
+                ## (which requires them to be closed on Windows)
+                TileStore.close_media(self.__media_id)
+
+                self.__plan_bands()
+                self.__start_pack()
+                self.__start_raw()
+                self.__start_writer()
+                try:
+                    if self.__workers_used > 1:
+                        self.__tiles_parallel()
+                    else:
+                        ## recursively tile the image
+                        self.__tiles()
+
+                    ## all of the tiles must be on disk before the metadata
+                    ## marks the media as tiled
+                    self.__flush_writer()
+                finally:
+                    self.__stop_writer()
+
+                if self.__packed:
+                    tilepack.finish(self.__partial_packfile, self.__packfile)
+                TileStore.close_media(self.__media_id)
         except Exception, e:
             self.error = str(e)
-            outpath = TileStore.get_media_path(self.__media_id)
-            shutil.rmtree(outpath, ignore_errors=True)
+            if self.__resume:
+                self.__logger.error("tiling failed, keeping checkpoints: %s",
+                    self.error)
+            else:
+                outpath = TileStore.get_media_path(self.__media_id)
+                shutil.rmtree(outpath, ignore_errors=True)
+                TileStore.invalidate(self.__media_id)
+                if TileStore.deduplicate:
+                    TileStore.clean_blobs()
+            TileStore.close_media(self.__media_id)
         else:
             TileStore.write_metadata(self.__media_id,
                 filext=self.__filext,
@@ -284,9 +1123,21 @@ class Tiler(Thread):
                 width=self._width,
                 height=self._height,
             )
+            self.__clear_checkpoints()
+            if retiling:
+                TileStore.clean_blobs()
 
         self.__progress = 1.0
+        self.__end_time = time.time()
         self.__logger.debug("tiling complete")
+        if self.peak_memory is not None:
+            self.__logger.debug("peak memory usage %.1fMB",
+                self.peak_memory * 1e-6)
+
+        stats = self.stats
+        self.__logger.debug("tiled %d tiles in %.2fs (%.1f tiles/s, %.1fMB/s)",
+            stats['tiles'], stats['elapsed'], stats['tiles_per_second'],
+            stats['bytes_per_second'] * 1e-6)
 
 
     @property
@@ -297,9 +1148,210 @@ class Tiler(Thread):
         return self.__progress
 
 
+    @property
+    def peak_memory(self):
+        """The peak resident memory (in bytes) of this process observed whilst
+        tiling, plus that of each of the worker processes. This will be None
+        if memory usage cannot be determined on this platform.
+
+        Note that as pages shared between this process and the workers are
+        counted for each of them, this is an overestimate when tiling in
+        parallel.
+        """
+        if self.__peak_memory is None:
+            return None
+        return self.__peak_memory + sum(self.__worker_peak_memory.values())
+
+
+    @property
+    def stats(self):
+        """Timing and throughput of the tiling so far, as a dict containing:
+
+        'elapsed'           wall-clock time since tiling began (seconds)
+        'stages'            dict of the time spent in each of
+                            `tilingstats.stages` (seconds)
+        'tiles'             number of tiles saved
+        'bytes_read'        number of bytes of pixels read from the image
+        'bytes_written'     number of bytes of encoded tiles saved
+        'tiles_per_second'  tiles saved per second of elapsed time
+        'bytes_per_second'  bytes of pixels read per second of elapsed time
+
+        Stage times are summed over all of the threads and worker processes
+        involved, so may add up to more than the elapsed time. Tiles restored
+        from checkpoints are not included.
+        """
+        stats = self.__stats.snapshot()
+
+        if self.__start_time is None:
+            elapsed = 0.0
+        elif self.__end_time is None:
+            elapsed = time.time() - self.__start_time
+        else:
+            elapsed = self.__end_time - self.__start_time
+        stats['elapsed'] = elapsed
+
+        if elapsed > 0:
+            stats['tiles_per_second'] = stats['tiles'] / elapsed
+            stats['bytes_per_second'] = stats['bytes_read'] / elapsed
+        else:
+            stats['tiles_per_second'] = stats['bytes_per_second'] = 0.0
+
+        return stats
+
+
+    def write_report(self, filename):
+        """Write a JSON report of the tiling to `filename`, containing the
+        media_id, the dimensions of the image, the number of workers used, the
+        peak memory usage, and `stats`.
+
+        write_report(string) -> None
+        """
+        report = self.stats
+        report.update({
+            'media_id': self.__media_id,
+            'width': self._width,
+            'height': self._height,
+            'workers': self.__workers_used,
+            'peak_memory': self.peak_memory,
+            'error': self.error,
+        })
+
+        f = open(filename, 'w')
+        try:
+            json.dump(report, f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+
+
     def __str__(self):
         return "Tiler(%s)" % self._infile
 
 
     def __repr__(self):
         return "Tiler(%s)" % repr(self._infile)
+
+
+
+def _tile_band(task):
+    """Create a tiler of the given class and use it to tile a single band of
+    the image. This is the entry point for worker processes.
+
+    _tile_band(tuple<type,tuple,tuple<int,int,int,int> >)
+    -> tuple<int,list<numpy.ndarray>,float,int,dict>
+    """
+    cls, args, band = task
+    return cls(*args)._tile_band(*band)
+
+
+def _merged(a1, a2, a3, a4):
+    """Merge the given arrays of pixels into a single array, in the same layout
+    as `Tile.merged`.
+
+    `a1` must be an array, but any or all of `a2`,`a3`,`a4` may be None, in
+    which case they will be ignored.
+
+    _merged(numpy.ndarray, numpy.ndarray or None, numpy.ndarray or None,
+            numpy.ndarray or None) -> numpy.ndarray
+    """
+    h1, w1 = a1.shape[:2]
+    height, width = h1, w1
+    if a2 is not None: width  += a2.shape[1]
+    if a3 is not None: height += a3.shape[0]
+
+    ## pixels not covered by any of the arrays are left black, as with Tile
+    if a2 is None or a3 is None or a4 is None:
+        merged = numpy.zeros((height, width, 3), numpy.uint8)
+    else:
+        merged = numpy.empty((height, width, 3), numpy.uint8)
+
+    merged[:h1, :w1] = a1
+    if a2 is not None: merged[:a2.shape[0], w1:] = a2
+    if a3 is not None: merged[h1:, :a3.shape[1]] = a3
+    if a4 is not None: merged[h1:h1+a4.shape[0], w1:w1+a4.shape[1]] = a4
+
+    return merged
+
+
+## weights of the 12 taps of a Lanczos (a=3) filter scaling by 1/2, from the
+## pixel 5 before the first pixel of each 2x2 block to 6 after it
+_lanczos_x = (numpy.arange(12) - 5.5) / 2.0
+_lanczos_weights = numpy.sinc(_lanczos_x) * numpy.sinc(_lanczos_x / 3.0)
+_lanczos_weights /= _lanczos_weights.sum()
+del _lanczos_x
+
+def _halved(array, downsample='box'):
+    """Scale the given array of pixels by 1/2 in each dimension (rounding
+    down) using the given filter, either 'box' or 'lanczos'.
+
+    The box filter averages each 2x2 block of pixels. The Lanczos filter is
+    applied separably, with the edge pixels of the array being repeated.
+
+    _halved(numpy.ndarray[, string]) -> numpy.ndarray
+    """
+    height = array.shape[0] // 2
+    width = array.shape[1] // 2
+
+    if downsample == 'box':
+        array = array[:2*height, :2*width].astype(numpy.uint16)
+        total = array[0::2, 0::2] + array[0::2, 1::2] + \
+                array[1::2, 0::2] + array[1::2, 1::2] + 2
+        return (total >> 2).astype(numpy.uint8)
+
+    array = array.astype(numpy.float32)
+    for axis, size in ((0, height), (1, width)):
+        array = array.swapaxes(0, axis)
+        padded = numpy.concatenate((array[:1].repeat(5, 0), array,
+                                    array[-1:].repeat(6, 0)))
+        array = numpy.zeros((size,) + array.shape[1:], numpy.float32)
+        for i, weight in enumerate(_lanczos_weights):
+            array += weight * padded[i : i + 2*size : 2]
+        array = array.swapaxes(0, axis)
+
+    return numpy.clip(array + 0.5, 0, 255).astype(numpy.uint8)
+
+
+def _imap_bounded(pool, func, iterable, maxpending):
+    """Equivalent to `pool.imap(func, iterable)`, except that no more than
+    `maxpending` tasks will be submitted to the pool ahead of the results
+    being consumed.
+
+    _imap_bounded(multiprocessing.Pool, function, iterable, int) -> iterator
+    """
+    pending = deque()
+    for arg in iterable:
+        pending.append(pool.apply_async(func, (arg,)))
+        if len(pending) >= maxpending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def _resident_memory():
+    """Return the resident memory (in bytes) of the current process, or None
+    if this cannot be determined.
+
+    On platforms without /proc the peak resident memory over the lifetime of
+    the process is returned instead.
+
+    _resident_memory() -> int or None
+    """
+    try:
+        f = open('/proc/self/statm')
+        try:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        finally:
+            f.close()
+    except (EnvironmentError, ValueError, AttributeError):
+        pass
+
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        ## Mac OS X reports this in bytes rather than kilobytes
+        return maxrss
+    else:
+        return maxrss * 1024
@@ -18,9 +18,20 @@
 
 """Module for managing the disk-based tile storage facility."""
 
+from __future__ import with_statement
+
 import os
+import stat
+import time
 import hashlib
-from threading import RLock
+import thread
+import sqlite3
+from threading import Lock, RLock, BoundedSemaphore, local
+from contextlib import contextmanager
+
+import numpy
+
+from tilepack import TilePack
 
 ## set the default tilestore directory, this can be overridden if required
 if 'APPDATA' in os.environ:
@@ -30,23 +41,535 @@ else:
     ## Unix
     tile_dir = os.path.join(os.path.expanduser('~'), ".pyzui", "tilestore")
 
-## threads which intend performing disk-access-intensive activities should
-## acquire this lock first to reduce stress on the disk
-disk_lock = RLock()
-
+## whether tiles with identical content should share a single file (requires
+## hard links, so has no effect on platforms without them), at the cost of
+## hashing each tile and linking it to the shared file
+deduplicate = False
+
+## how media is identified within the tilestore:
+##   'path'     by its media_id, so its tiles are only found at the same path
+##   'content'  local files by a hash of their contents, so that copies of a
+##              file share tiles, and moving a file doesn't require re-tiling
+##   'sampled'  as 'content', but hashing only the size and modification
+##              time of the file and evenly spaced samples of it, which is
+##              much faster for large files (but copies only share tiles if
+##              they keep the modification time)
+media_identity = 'path'
+
+## number and size (in bytes) of the samples hashed by 'sampled' identities
+identity_samples = 16
+identity_sample_size = 64 * 1024
+
+__identities = None
+__identities_lock = Lock()
+
+## the directory containing the tiles of each media_id, which is remembered
+## (along with the `tile_dir` and `media_identity` it was found with) until
+## `close_media` is called for it
+__media_paths = {}
+
+## the catalog of tiled media and its metadata, indexed by the name of the
+## directory containing its tiles, which is loaded from the tilestore in bulk
+## and then kept in memory
+__catalog = {}
+__catalog_db = None
+__catalog_dir = None
+__catalog_lock = RLock()
+
+## True for each media_id which has been tiled, or the time at which it was
+## last found not to have been, and the metadata of each media_id
+__tiled = {}
 __metadata = {}
 
+## number of seconds for which media found not to have been tiled is
+## remembered as such, after which the tilestore is checked again (in case
+## it has since been tiled by another process, such as pretile.py)
+untiled_ttl = 5.0
+
+## the open TilePacks indexed by the path of the pack file, or None where
+## there is no pack file
+__packs = {}
+__packs_lock = Lock()
+
+## the memory-mapped raw planes indexed by the path of their file, or None
+## where there is no such file
+__raw_levels = {}
+__raw_levels_lock = Lock()
+
+__media_locks = {}
+__media_locks_lock = Lock()
+__disk_semaphore = None
+__disk_access_depth = local()
+
+def set_disk_concurrency(n):
+    """Limit the number of threads which may be within `disk_access` at once to
+    `n`, to reduce stress on the disk. There will be no limit if `n` is None or
+    <= 0 (the default).
+
+    Threads which are already within `disk_access` are not affected.
+
+    set_disk_concurrency(int or None) -> None
+    """
+    global __disk_semaphore
+    if n > 0:
+        __disk_semaphore = BoundedSemaphore(n)
+    else:
+        __disk_semaphore = None
+
+
+@contextmanager
+def disk_access(media_id):
+    """Return a context manager which should be held by threads performing
+    disk-access-intensive activities (such as conversion or tiling) for the
+    media identified by `media_id`.
+
+    Only one thread may hold it for any given media (or any media stored in
+    the same place, see `get_media_path`) at a time, and the total number of
+    threads holding it is limited by `set_disk_concurrency`. It is reentrant
+    for the same media.
+
+    disk_access(string) -> context manager
+    """
+    ## media with the same contents may be stored in the same place
+    media_path = get_media_path(media_id)
+    with __media_locks_lock:
+        if media_path not in __media_locks:
+            __media_locks[media_path] = RLock()
+        media_lock = __media_locks[media_path]
+
+    ## acquire the media lock first, so that a thread waiting for another to
+    ## finish with the same media doesn't prevent other media using the disk
+    with media_lock:
+        ## a thread only occupies a single slot of the semaphore, no matter
+        ## how deeply it nests calls to disk_access
+        depth = getattr(__disk_access_depth, 'depth', 0)
+        if depth == 0:
+            semaphore = __disk_semaphore
+        else:
+            semaphore = None
+        if semaphore:
+            semaphore.acquire()
+        __disk_access_depth.depth = depth + 1
+        try:
+            yield
+        finally:
+            __disk_access_depth.depth = depth
+            if semaphore:
+                semaphore.release()
+
+
+def __hash_contents(filename, size, mtime):
+    """Return the hash identifying the contents of the given file (which is
+    `size` bytes long and was last modified at `mtime`) according to
+    `media_identity`.
+
+    __hash_contents(string, int, float) -> string
+    """
+    h = hashlib.sha1()
+    f = open(filename, 'rb')
+    try:
+        if media_identity == 'sampled' and \
+           size > identity_samples * identity_sample_size:
+            ## the samples alone could miss a modification of the file
+            h.update("%d %r\n" % (size, mtime))
+            for i in xrange(identity_samples):
+                f.seek(i * (size - identity_sample_size) /
+                    (identity_samples - 1))
+                h.update(f.read(identity_sample_size))
+        else:
+            while True:
+                data = f.read(1024 * 1024)
+                if not data:
+                    break
+                h.update(data)
+    finally:
+        f.close()
+    return h.hexdigest()
+
+
+def __load_identities():
+    """Load the identities of the media whose contents have already been
+    hashed from the tilestore, if they haven't been loaded yet.
+
+    Precondition: __identities_lock is held
+
+    __load_identities() -> None
+    """
+    global __identities
+    if __identities is not None:
+        return
+
+    __identities = {}
+    try:
+        f = open(os.path.join(tile_dir, "identities"), 'rb')
+    except IOError:
+        return
+    try:
+        for line in f:
+            try:
+                mode, size, mtime, identity, media_id = \
+                    line.rstrip('\n').split('\t', 4)
+                __identities[media_id] = \
+                    (mode, long(size), float(mtime), identity)
+            except ValueError:
+                ## ignore lines which were only partially written
+                pass
+    finally:
+        f.close()
+
+
+def __stat_file(media_id):
+    """Return the result of stat for the local file identified by
+    `media_id`, or None if it is not a regular local file.
+
+    __stat_file(string) -> stat_result or None
+    """
+    try:
+        st = os.stat(media_id)
+    except (OSError, TypeError):
+        return None
+    if not stat.S_ISREG(st.st_mode):
+        return None
+    return st
+
+
+def identity_known(media_id):
+    """Return True iff `get_media_path` can find the media identified by
+    `media_id` without hashing its contents, because `media_identity` is
+    'path', it is not a local file, or its hash has already been computed.
+
+    Hashing a large file takes a while, so threads which mustn't block (such
+    as the GUI) should check this first.
+
+    identity_known(string) -> bool
+    """
+    cached = __media_paths.get(media_id)
+    if media_identity == 'path' or \
+       (cached and cached[:2] == (tile_dir, media_identity)):
+        return True
+
+    st = __stat_file(media_id)
+    if st is None:
+        return True
+
+    with __identities_lock:
+        __load_identities()
+        entry = __identities.get(media_id)
+        return bool(entry) and \
+            entry[:3] == (media_identity, st.st_size, st.st_mtime)
+
+
+def get_media_identity(media_id):
+    """Return the hash of the contents of the media identified by `media_id`,
+    as determined by `media_identity`, or None if it is not a local file or
+    `media_identity` is 'path'.
+
+    Hashes are remembered in the tilestore, and are only recomputed if the
+    size or modification time of the file changes.
+
+    get_media_identity(string) -> string or None
+    """
+    if media_identity == 'path':
+        return None
+
+    st = __stat_file(media_id)
+    if st is None:
+        return None
+
+    key = (media_identity, st.st_size, st.st_mtime)
+    with __identities_lock:
+        __load_identities()
+        entry = __identities.get(media_id)
+        if entry and entry[:3] == key:
+            return entry[3]
+
+    identity = __hash_contents(media_id, st.st_size, st.st_mtime)
+
+    with __identities_lock:
+        __identities[media_id] = key + (identity,)
+        if '\n' not in media_id:
+            try:
+                if not os.path.exists(tile_dir):
+                    os.makedirs(tile_dir)
+                f = open(os.path.join(tile_dir, "identities"), 'ab')
+                try:
+                    f.write("%s\t%d\t%r\t%s\t%s\n" % (key + (identity,
+                        media_id)))
+                finally:
+                    f.close()
+            except EnvironmentError:
+                ## the identity will just have to be recomputed next time
+                pass
+
+    return identity
+
+
 def get_media_path(media_id):
     """Return the path to the directory containing the tiles for the media
     identified by `media_id`.
 
+    Unless `media_identity` is 'path', local files are stored according to
+    their contents (see `get_media_identity`), so that tiles are reused
+    wherever the same contents have already been tiled. Media which was tiled
+    according to its media_id before this was enabled is still found there.
+
+    The path is remembered, so the file is only examined again (e.g. in case
+    it has been modified) once `close_media` has been called for it.
+
     get_media_path(string) -> string
     """
-    media_hash = hashlib.sha1(media_id).hexdigest()
-    media_dir = os.path.join(tile_dir, media_hash)
+    cached = __media_paths.get(media_id)
+    if cached and cached[:2] == (tile_dir, media_identity):
+        return cached[2]
+
+    path_dir = os.path.join(tile_dir, hashlib.sha1(media_id).hexdigest())
+
+    identity = get_media_identity(media_id)
+    if identity is None:
+        media_dir = path_dir
+    else:
+        media_dir = os.path.join(tile_dir, identity)
+        if not os.path.exists(os.path.join(media_dir, "metadata")) and \
+           os.path.exists(os.path.join(path_dir, "metadata")):
+            media_dir = path_dir
+
+    __media_paths[media_id] = (tile_dir, media_identity, media_dir)
     return media_dir
 
 
+def get_checkpoint_path(media_id):
+    """Return the path to the directory containing the tiling checkpoints for
+    the media identified by `media_id`.
+
+    get_checkpoint_path(string) -> string
+    """
+    return os.path.join(get_media_path(media_id), "checkpoint")
+
+
+def get_blob_path(content_hash, filext):
+    """Return the path to the file shared by all tiles in the format indicated
+    by `filext` whose content is identified by `content_hash`.
+
+    get_blob_path(string, string) -> string
+    """
+    return os.path.join(tile_dir, "blobs", content_hash[:2],
+        "%s.%s" % (content_hash, filext))
+
+
+def store_tile(filename, content_hash, filext, save):
+    """Store the tile whose content is identified by `content_hash` at
+    `filename`, where `save` is a function which writes the tile to the path
+    it is given.
+
+    If `deduplicate` is set, then `filename` will be a hard link to a blob
+    shared by all tiles with the same content, so that each distinct tile is
+    only saved once.
+
+    store_tile(string, string, string, function) -> None
+    """
+    if not deduplicate or not hasattr(os, 'link'):
+        save(filename)
+        return
+
+    ## suffix for temporary files which is unique to this thread, and keeps
+    ## the file extension so that the format can still be determined from it
+    suffix = ".%d.%d.tmp.%s" % (os.getpid(), thread.get_ident(), filext)
+
+    blob = get_blob_path(content_hash, filext)
+    while True:
+        if not os.path.exists(blob):
+            try:
+                os.makedirs(os.path.dirname(blob))
+            except OSError:
+                if not os.path.isdir(os.path.dirname(blob)):
+                    raise
+            save(blob + suffix)
+            try:
+                ## linking fails if another thread or process has saved the
+                ## same blob in the meantime, in which case theirs is kept so
+                ## that tiles already linked to it stay shared
+                os.link(blob + suffix, blob)
+            except OSError:
+                if not os.path.exists(blob):
+                    raise
+            finally:
+                os.unlink(blob + suffix)
+
+        try:
+            if os.path.exists(filename) and os.path.samefile(blob, filename):
+                ## renaming a link over another link to the same file does
+                ## nothing
+                return
+            os.link(blob, filename + suffix)
+        except OSError:
+            if os.path.exists(blob):
+                raise
+            ## the blob was removed by `clean_blobs` before the tile was
+            ## linked to it, so save it again
+            continue
+        break
+    os.rename(filename + suffix, filename)
+
+
+def deduplicate_file(filename, filext):
+    """Replace the tile saved at `filename` with a link to the blob shared
+    by all tiles with the same (encoded) content, as per `store_tile`.
+
+    deduplicate_file(string, string) -> None
+    """
+    f = open(filename, 'rb')
+    try:
+        content_hash = hashlib.sha1(f.read()).hexdigest()
+    finally:
+        f.close()
+
+    store_tile(filename, content_hash, filext,
+        lambda path: os.link(filename, path))
+
+
+def get_content_key(filename):
+    """Return a key which is shared by all tiles stored as links to the same
+    blob as `filename`, or None if the tile at `filename` is not shared.
+
+    get_content_key(string) -> tuple<int,int> or None
+    """
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+
+    if st.st_nlink > 1:
+        return (st.st_dev, st.st_ino)
+    else:
+        return None
+
+
+def clean_blobs():
+    """Remove any blobs which are no longer linked to by any tiles, such as
+    after the tiles of a media have been removed or replaced.
+
+    This walks all of the blobs in the tilestore, so should not be called
+    more often than necessary.
+
+    clean_blobs() -> None
+    """
+    for dirpath, dirnames, filenames in \
+        os.walk(os.path.join(tile_dir, "blobs")):
+        for filename in filenames:
+            filename = os.path.join(dirpath, filename)
+            try:
+                if os.stat(filename).st_nlink == 1:
+                    os.unlink(filename)
+            except OSError:
+                pass
+
+
+def get_pack_path(media_id):
+    """Return the path to the pack file containing the tiles for the media
+    identified by `media_id`, if they have been stored in a single file rather
+    than in a file each (see `tilepack`).
+
+    get_pack_path(string) -> string
+    """
+    return os.path.join(get_media_path(media_id), "tiles.pack")
+
+
+def get_pack(media_id):
+    """Return the TilePack containing the tiles for the media identified by
+    `media_id`, or None if they are stored in a file each.
+
+    The pack file is kept open (and its absence remembered) until
+    `close_media` is called.
+
+    get_pack(string) -> TilePack or None
+    """
+    path = get_pack_path(media_id)
+    with __packs_lock:
+        if path not in __packs:
+            try:
+                __packs[path] = TilePack(path)
+            except IOError:
+                ## remember that there is no pack, rather than trying to open
+                ## it again for every tile
+                __packs[path] = None
+        return __packs[path]
+
+
+def close_media(media_id=None):
+    """Close the pack file and raw planes held open for the media identified
+    by `media_id` (or for all media if it is omitted), and forget whether
+    there are any, so that they will be opened again the next time they are
+    needed. Where the media is stored (see `get_media_path`) is also
+    forgotten.
+
+    This must be called whenever they may have changed or been removed, such
+    as when the media is tiled.
+
+    close_media([string]) -> None
+    """
+    with __packs_lock:
+        if media_id is None:
+            packs = __packs.values()
+            __packs.clear()
+        else:
+            packs = [__packs.pop(get_pack_path(media_id), None)]
+    for pack in packs:
+        if pack:
+            pack.close()
+
+    ## the planes are unmapped once they are no longer referenced (by any
+    ## tiles loaded from them)
+    with __raw_levels_lock:
+        if media_id is None:
+            __raw_levels.clear()
+        else:
+            rawpath = os.path.dirname(get_raw_path(media_id, 0))
+            for path in __raw_levels.keys():
+                if os.path.dirname(path) == rawpath:
+                    del __raw_levels[path]
+
+    if media_id is None:
+        __media_paths.clear()
+    else:
+        __media_paths.pop(media_id, None)
+
+
+def get_raw_path(media_id, tilelevel):
+    """Return the path to the file containing the raw plane of pixels for the
+    given tilelevel of the media identified by `media_id`.
+
+    get_raw_path(string, int) -> string
+    """
+    return os.path.join(get_media_path(media_id), "raw",
+        "%02d.npy" % tilelevel)
+
+
+def get_raw_level(media_id, tilelevel):
+    """Return the given tilelevel of the media identified by `media_id` as a
+    read-only memory-mapped array of RGB pixels with shape (height, width, 3),
+    or None if the media has not been tiled with raw planes.
+
+    The tile at (row,col) occupies the region of the array starting from
+    (row*tilesize, col*tilesize), and is tilesize pixels in each dimension
+    unless it lies on the bottom or right edge of the array.
+
+    The plane is kept mapped (and its absence remembered) until `close_media`
+    is called.
+
+    get_raw_level(string, int) -> numpy.memmap or None
+    """
+    path = get_raw_path(media_id, tilelevel)
+    with __raw_levels_lock:
+        if path not in __raw_levels:
+            try:
+                __raw_levels[path] = numpy.load(path, 'r')
+            except (IOError, ValueError):
+                ## remember that there is no plane, rather than trying to
+                ## load it again for every tile
+                __raw_levels[path] = None
+        return __raw_levels[path]
+
+
 def get_tile_path(tile_id, mkdirp=False, prefix=None, filext=None):
     """Return the path to the tile identified by `tile_id`.
 
@@ -78,7 +601,12 @@ def get_tile_path(tile_id, mkdirp=False, prefix=None, filext=None):
 
     if mkdirp and not os.path.exists(filename):
         ## create parent directories
-        os.makedirs(filename)
+        try:
+            os.makedirs(filename)
+        except OSError:
+            ## they may have just been created by another process
+            if not os.path.isdir(filename):
+                raise
 
     filename = os.path.join(
         filename, "%02d_%06d_%06d.%s" % (tilelevel, row, col, filext))
@@ -86,22 +614,13 @@ def get_tile_path(tile_id, mkdirp=False, prefix=None, filext=None):
     return filename
 
 
-def load_metadata(media_id):
-    """Load metadata from disk for the given `media_id`, and return a bool
-    indicating whether the load was successful.
+def __parse_metadata(lines):
+    """Return the metadata given by the lines of a metadata file.
 
-    load_metadata(string) -> bool
+    __parse_metadata(iterable<string>) -> dict
     """
-    path = get_media_path(media_id)
-
-    try:
-        f = open(os.path.join(path, "metadata"), 'U')
-    except IOError:
-        return False
-
-    __metadata[media_id] = {}
-
-    for line in f:
+    metadata = {}
+    for line in lines:
         key, val, val_type = line.split()
 
         try:
@@ -112,9 +631,112 @@ def load_metadata(media_id):
         except Exception:
             pass
         else:
-            __metadata[media_id][key] = val
+            metadata[key] = val
+    return metadata
 
-    f.close()
+
+def __format_metadata(metadata):
+    """Return the contents of a metadata file for the given metadata.
+
+    __format_metadata(dict) -> string
+    """
+    return ''.join(["%s\t%s\t%s\n" % (key, str(val), type(val).__name__)
+                    for key, val in metadata.iteritems()])
+
+
+def __open_catalog():
+    """Load the catalog of the current `tile_dir` if it hasn't already been
+    loaded, creating it if necessary.
+
+    If the catalog can't be opened then it is only kept in memory, as the
+    metadata files remain the authoritative record of what has been tiled.
+
+    Precondition: __catalog_lock is held
+
+    __open_catalog() -> None
+    """
+    global __catalog_db, __catalog_dir
+    if __catalog_dir == tile_dir:
+        return
+
+    __catalog_dir = tile_dir
+    __catalog_db = None
+    __catalog.clear()
+    __tiled.clear()
+    __metadata.clear()
+
+    try:
+        if not os.path.exists(tile_dir):
+            os.makedirs(tile_dir)
+        db = sqlite3.connect(os.path.join(tile_dir, "catalog.db"),
+            timeout=30, check_same_thread=False)
+        db.text_factory = str
+        db.execute("CREATE TABLE IF NOT EXISTS media "
+            "(path TEXT PRIMARY KEY, metadata TEXT NOT NULL)")
+        db.commit()
+        for path, metadata in db.execute("SELECT path, metadata FROM media"):
+            __catalog[path] = __parse_metadata(metadata.splitlines())
+    except (sqlite3.Error, EnvironmentError):
+        return
+    __catalog_db = db
+
+
+def __catalog_store(name, metadata):
+    """Record in the catalog that the media stored in the directory `name`
+    has been tiled with the given metadata, or that it hasn't been tiled if
+    `metadata` is None.
+
+    Precondition: __catalog_lock is held
+
+    __catalog_store(string, dict or None) -> None
+    """
+    if metadata is None:
+        __catalog.pop(name, None)
+    else:
+        __catalog[name] = metadata
+
+    if __catalog_db is None:
+        return
+    try:
+        if metadata is None:
+            __catalog_db.execute("DELETE FROM media WHERE path = ?", (name,))
+        else:
+            __catalog_db.execute("INSERT OR REPLACE INTO media "
+                "(path, metadata) VALUES (?, ?)",
+                (name, __format_metadata(metadata)))
+        __catalog_db.commit()
+    except sqlite3.Error:
+        ## it will be added back from the metadata file next time
+        pass
+
+
+def load_metadata(media_id):
+    """Load metadata for the given `media_id` from the catalog, or otherwise
+    from disk, and return a bool indicating whether the load was successful.
+
+    load_metadata(string) -> bool
+    """
+    path = get_media_path(media_id)
+    name = os.path.basename(path)
+
+    with __catalog_lock:
+        __open_catalog()
+        if name in __catalog:
+            __metadata[media_id] = __catalog[name]
+            return True
+
+    try:
+        f = open(os.path.join(path, "metadata"), 'U')
+    except IOError:
+        return False
+    try:
+        metadata = __parse_metadata(f)
+    finally:
+        f.close()
+
+    with __catalog_lock:
+        __catalog_store(name, metadata)
+        __metadata[media_id] = metadata
 
     return True
 
@@ -131,24 +753,89 @@ def get_metadata(media_id, key):
 
 
 def write_metadata(media_id, **kwargs):
-    """Write the metadata given in `kwargs` for the given `media_id`.
+    """Write the metadata given in `kwargs` for the given `media_id`, marking
+    it as tiled.
 
     write_metadata(string, metadata_key=metadata_val, ...) -> None
     """
     path = get_media_path(media_id)
     f = open(os.path.join(path, "metadata"), 'w')
-    for key,val in kwargs.iteritems():
-        f.write("%s\t%s\t%s\n"
-            % (key, str(val), type(val).__name__))
+    f.write(__format_metadata(kwargs))
     f.close()
 
+    with __catalog_lock:
+        __open_catalog()
+        __catalog_store(os.path.basename(path), kwargs)
+
+        ## other media may be stored in the same place (see
+        ## `get_media_path`), so forget everything that may now be stale
+        for other in __tiled.keys():
+            if __tiled[other] is not True:
+                del __tiled[other]
+        __metadata.clear()
+        __tiled[media_id] = True
+
+
+def invalidate(media_id):
+    """Forget that the media identified by `media_id` has been tiled, such as
+    after its tiles have been removed.
+
+    invalidate(string) -> None
+    """
+    path = get_media_path(media_id)
+    with __catalog_lock:
+        __open_catalog()
+        __catalog_store(os.path.basename(path), None)
+        __tiled.clear()
+        __metadata.clear()
+
 
 def tiled(media_id):
     """Return True iff the media identified by `media_id` has been tiled
-    i.e. iff both a metadata file and the (0,0,0) tile exist.
+    i.e. iff both a metadata file and either the (0,0,0) tile or a pack file
+    exist.
+
+    The result is remembered (and media is looked up in the catalog before
+    the disk), so this is cheap to call repeatedly. Media which hasn't been
+    tiled is checked for again after `untiled_ttl` seconds.
 
     tiled(string) -> bool
     """
+    with __catalog_lock:
+        __open_catalog()
+        checked = __tiled.get(media_id)
+        if checked is True:
+            return True
+        elif checked is not None and time.time() - checked < untiled_ttl:
+            return False
+
     path = get_media_path(media_id)
-    return os.path.exists(os.path.join(path, "metadata")) and \
-           os.path.exists(get_tile_path((media_id, 0, 0, 0)))
+    name = os.path.basename(path)
+
+    with __catalog_lock:
+        in_catalog = name in __catalog
+
+    ## the catalog saves reading the metadata, but the tiles may have been
+    ## removed (or be in the middle of being replaced) since it was written
+    result = os.path.exists(os.path.join(path, "metadata")) and \
+             (os.path.exists(get_pack_path(media_id)) or
+              os.path.exists(get_tile_path((media_id, 0, 0, 0))))
+    if in_catalog:
+        if not result:
+            with __catalog_lock:
+                __catalog_store(name, None)
+    else:
+        with __catalog_lock:
+            if result and name not in __catalog:
+                ## add media tiled before the catalog existed
+                load_metadata(media_id)
+            elif not result and name in __catalog:
+                ## the metadata was loaded to find the (0,0,0) tile
+                __catalog_store(name, None)
+
+    with __catalog_lock:
+        if result:
+            __tiled[media_id] = True
+        else:
+            __tiled[media_id] = time.time()
+    return result
@@ -0,0 +1,198 @@
+## PyZUI 0.1 - Python Zooming User Interface
+## Copyright (C) 2009  David Roberts <d@vidr.cc>
+##
+## This program is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License
+## as published by the Free Software Foundation; either version 2
+## of the License, or (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+## 02110-1301, USA.
+
+"""Pool of threads for encoding and saving tiles in the background."""
+
+import sys
+import time
+from threading import Thread
+from Queue import Queue
+
+import numpy
+
+import tilestore as TileStore
+import tile as Tile
+
+def _write_file(filename, data):
+    """Write the string `data` to the file `filename`.
+
+    _write_file(string, string) -> None
+    """
+    f = open(filename, 'wb')
+    try:
+        f.write(data)
+    finally:
+        f.close()
+
+
+def save_tile(tile, tile_id, prefix=None, filext=None, pack=None,
+              stats=None):
+    """Save the given tile (or array of RGB pixels) to the TileStore as the
+    tile identified by `tile_id`. See `TileStore.get_tile_path` for `prefix`
+    and `filext`.
+
+    If `pack` is given, then the tile will be appended to it rather than being
+    saved to a file of its own.
+
+    If `stats` is given, then the time spent encoding and writing the tile
+    will be added to it.
+
+    save_tile(Tile or numpy.ndarray, tuple<string,int,int,int>[, string[,
+              string[, TilePackWriter[, TilingStats]]]]) -> None
+    """
+    start = time.time()
+
+    if isinstance(tile, numpy.ndarray):
+        tile = Tile.fromarray(tile)
+
+    if filext is None:
+        filext = TileStore.get_metadata(tile_id[0], 'filext')
+
+    data = tile.encode(filext)
+    if not pack and TileStore.deduplicate:
+        content_hash = tile.digest()
+
+    encoded = time.time()
+
+    if pack:
+        pack.write(tile_id, data)
+    else:
+        filename = TileStore.get_tile_path(tile_id, True, prefix, filext)
+        if TileStore.deduplicate:
+            TileStore.store_tile(filename, content_hash, filext,
+                lambda path: _write_file(path, data))
+        else:
+            _write_file(filename, data)
+
+    if stats:
+        stats.add_time('encode', encoded - start)
+        stats.add_time('write', time.time() - encoded)
+        stats.add('tiles')
+        stats.add('bytes_written', len(data))
+
+
+class TileWriter(object):
+    """TileWriter objects are used for encoding and saving tiles to the
+    TileStore in a pool of background threads, so that the thread producing
+    the tiles doesn't have to wait for the disk.
+
+    No more than `maxpending` tiles (4 per thread by default) will be queued
+    at once, after which `save` will block until the threads catch up.
+
+    If `pack` is given, then the tiles will be appended to it rather than being
+    saved to a file each. If `stats` is given, then the time spent encoding
+    and writing the tiles will be added to it. If `callback` is given, then
+    it will be called (from one of the threads) with the tile_id of each tile
+    once it has been saved.
+
+    Constructor:
+      TileWriter(int[, int[, TilePackWriter[, TilingStats[, function]]]])
+    """
+    def __init__(self, numthreads, maxpending=None, pack=None, stats=None,
+                 callback=None):
+        if maxpending is None:
+            maxpending = 4 * numthreads
+
+        self.__pack = pack
+        self.__stats = stats
+        self.__callback = callback
+
+        self.__queue = Queue(maxpending)
+        self.__error = None
+
+        self.__threads = []
+        for i in xrange(numthreads):
+            thread = Thread(target=self.__run)
+            thread.setDaemon(True)
+            thread.start()
+            self.__threads.append(thread)
+
+
+    def __run(self):
+        """Save tiles from the queue until told to stop.
+
+        __run() -> None
+        """
+        while True:
+            job = self.__queue.get()
+            try:
+                if job is None:
+                    return
+                elif self.__error is None:
+                    ## once an error has occurred the remaining tiles are
+                    ## discarded
+                    tile, tile_id, prefix, filext = job
+                    save_tile(tile, tile_id, prefix, filext, self.__pack,
+                        self.__stats)
+                    if self.__callback:
+                        self.__callback(tile_id)
+            except Exception:
+                if self.__error is None:
+                    ## keep the traceback, so that it can be re-raised from
+                    ## the thread that queued the tile
+                    self.__error = sys.exc_info()
+            finally:
+                self.__queue.task_done()
+
+
+    def __check_error(self):
+        """Raise the first error encountered by any of the threads.
+
+        __check_error() -> None
+        """
+        if self.__error is not None:
+            raise self.__error[0], self.__error[1], self.__error[2]
+
+
+    def save(self, tile, tile_id, prefix=None, filext=None):
+        """Queue the given tile (or array of RGB pixels) to be saved to the
+        TileStore as the tile identified by `tile_id`. See
+        `TileStore.get_tile_path` for `prefix` and `filext`.
+
+        Raises the first error encountered by a previously queued tile, if
+        any.
+
+        save(Tile or numpy.ndarray, tuple<string,int,int,int>[, string[,
+             string]]) -> None
+        """
+        self.__check_error()
+        self.__queue.put((tile, tile_id, prefix, filext))
+
+
+    def flush(self):
+        """Wait until all of the queued tiles have been saved.
+
+        Raises the first error encountered by any of the queued tiles, if any.
+
+        flush() -> None
+        """
+        self.__queue.join()
+        self.__check_error()
+
+
+    def close(self):
+        """Wait until all of the queued tiles have been dealt with, and then
+        stop the threads. Any errors are ignored.
+
+        close() -> None
+        """
+        for thread in self.__threads:
+            self.__queue.put(None)
+        for thread in self.__threads:
+            thread.join()
+        self.__threads = []
@@ -0,0 +1,300 @@
+## PyZUI 0.1 - Python Zooming User Interface
+## Copyright (C) 2009  David Roberts <d@vidr.cc>
+##
+## This program is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License
+## as published by the Free Software Foundation; either version 2
+## of the License, or (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+## 02110-1301, USA.
+
+"""Threaded job for converting and tiling media."""
+
+from threading import Thread
+import tempfile
+import os
+import time
+import logging
+
+from PyQt4 import QtGui
+
+from ppm import PPMTiler
+import imagetiler
+from imagetiler import ImageTiler
+from webkitconverter import WebKitConverter
+from pdfconverter import PDFConverter
+from magickconverter import MagickConverter
+
+class TilingJob(Thread):
+    """TilingJob objects are used for converting media into a form which can
+    be tiled (where necessary) and then tiling it. They are run by the
+    ConversionManager on behalf of TiledMediaObjects, but don't require a GUI.
+
+    Constructor: TilingJob(string[, dict])
+    """
+    def __init__(self, media_id, tiler_options={}):
+        """Create a new TilingJob for the media given by `media_id`.
+
+        `tiler_options` are passed to the Tiler as keyword arguments. If they
+        do not include `filext`, then tiles will be saved as JPEG for JPEG
+        media and PNG otherwise.
+        """
+        Thread.__init__(self)
+
+        self.__media_id = media_id
+        self.__tiler_options = dict(tiler_options)
+
+        self.__tmpfile = None
+        self.__converter = None
+        self.__tiler = None
+        self.__streaming = False
+
+        self.__start_time = None
+        self.__end_time = None
+
+        self.__logger = logging.getLogger(str(self))
+
+        self.error = None
+
+
+    ## whether media converted by ImageMagick should be piped directly into
+    ## the tiler, rather than being written to a temporary file first
+    stream_conversion = True
+
+    def __is_webpage(self):
+        """Return True iff the media is a webpage to be rendered by a
+        WebKitConverter.
+
+        __is_webpage() -> bool
+        """
+        lower = self.__media_id.lower()
+        return self.__media_id.startswith('http://') or \
+            lower.endswith('.html') or lower.endswith('.htm')
+
+
+    def __get_tmpfile(self):
+        """Return the temporary file used as the destination of the
+        conversion, creating it if necessary.
+
+        __get_tmpfile() -> string
+        """
+        if self.__tmpfile is None:
+            fd, self.__tmpfile = tempfile.mkstemp('.ppm')
+            os.close(fd)
+        return self.__tmpfile
+
+
+    def begin_conversion(self):
+        """Begin converting the media if it is a webpage, which (when there
+        is a GUI) must be started from the thread owning the QApplication.
+
+        This should be called from that thread before the job is run, and
+        does nothing for other media. Otherwise the webpage will be converted
+        once the job is run.
+
+        begin_conversion() -> None
+        """
+        if self.__is_webpage() and self.__converter is None:
+            self.__converter = WebKitConverter(
+                self.__media_id, self.__get_tmpfile())
+            self.__converter.start()
+
+
+    def __convert(self, tmpfile):
+        """Convert the media if necessary, and return the image to be tiled
+        (a filename or a file object) along with the class of Tiler to tile it
+        with. `tmpfile` is used as the destination of the conversion.
+
+        Raises `IOError` if the conversion fails.
+
+        __convert(string) -> tuple<string or file,type>
+        """
+        media_id = self.__media_id
+        lower = media_id.lower()
+
+        if self.__is_webpage():
+            if self.__converter is None and \
+               QtGui.QApplication.instance() is None:
+                ## WebKit needs a QApplication (and so a display), which
+                ## can't be created here from a thread other than the main one
+                raise IOError("webpages can only be converted whilst "
+                    "the GUI is running")
+            self.begin_conversion()
+            ## the conversion may be handled by Qt rather than by a thread of
+            ## its own, so it can't be joined
+            self.__converter.wait()
+            if self.__converter.error:
+                raise IOError(self.__converter.error)
+            return self.__check_output(tmpfile)
+        elif lower.endswith('.pdf'):
+            self.__converter = PDFConverter(media_id, tmpfile)
+        elif lower.endswith('.ppm'):
+            ## assume media_id is a local PPM file
+            return media_id, PPMTiler
+        elif imagetiler.supported(media_id,
+                self.__tiler_options.get('max_memory')):
+            ## the image can be decoded without converting it to PPM
+            return media_id, ImageTiler
+        elif self.stream_conversion:
+            ## tile the PPM as it is produced by the converter
+            self.__converter = MagickConverter(media_id, None)
+            self.__streaming = True
+            self.__converter.start()
+            infile = self.__converter.output()
+            if infile is None:
+                raise IOError(self.__converter.error)
+            return infile, PPMTiler
+        else:
+            self.__converter = MagickConverter(media_id, tmpfile)
+
+        self.__converter.run()
+        if self.__converter.error:
+            raise IOError(self.__converter.error)
+        return self.__check_output(tmpfile)
+
+
+    def __check_output(self, tmpfile):
+        """Check that the conversion produced an image in `tmpfile`, and
+        return it along with the class of Tiler to tile it with.
+
+        Raises `IOError` if there is no image.
+
+        __check_output(string) -> tuple<string,type>
+        """
+        if not os.path.exists(tmpfile) or os.path.getsize(tmpfile) == 0:
+            raise IOError("there was a problem converting "
+                "and/or loading the input file")
+        return tmpfile, PPMTiler
+
+
+    def run(self):
+        """Convert and tile the media. If any errors are encountered then
+        `self.error` will be set to a string describing the error.
+
+        run() -> None
+        """
+        self.__start_time = time.time()
+
+        tmpfile = self.__get_tmpfile()
+
+        try:
+            try:
+                infile, tiler_class = self.__convert(tmpfile)
+
+                options = dict(self.__tiler_options)
+                if 'filext' not in options:
+                    if self.__media_id.lower().endswith('.jpg'):
+                        options['filext'] = 'jpg'
+                    else:
+                        options['filext'] = 'png'
+
+                self.__tiler = tiler_class(infile, self.__media_id, **options)
+                self.__tiler.run()
+
+                if self.__streaming:
+                    self.__converter.join()
+                    if self.__converter.error:
+                        raise IOError(self.__converter.error)
+                if self.__tiler.error:
+                    raise IOError("an error ocurred during the tiling "
+                        "process: %s" % self.__tiler.error)
+            except Exception, e:
+                self.error = str(e)
+                self.__logger.error(self.error)
+        finally:
+            self.__finish()
+
+
+    def skip(self):
+        """Finish the job without converting or tiling the media, such as
+        when it turns out to have been tiled already. Any conversion begun
+        by `begin_conversion` is waited for, and its output discarded.
+
+        skip() -> None
+        """
+        self.__start_time = time.time()
+        try:
+            if self.__converter is not None:
+                ## the webpage can't be abandoned part of the way through
+                self.__converter.wait()
+        finally:
+            self.__finish()
+
+
+    def __finish(self):
+        """Remove the temporary file used for the conversion (if any), and
+        mark the job as finished.
+
+        __finish() -> None
+        """
+        if self.__tmpfile is not None:
+            try:
+                os.unlink(self.__tmpfile)
+            except:
+                self.__logger.exception("unable to unlink temporary file "
+                    "'%s'" % self.__tmpfile)
+        self.__end_time = time.time()
+
+
+    @property
+    def media_id(self):
+        """The media being tiled."""
+        return self.__media_id
+
+
+    @property
+    def progress(self):
+        """Progress of the job ranging from 0.0 to 1.0, with conversion and
+        tiling each accounting for half of it (unless the media didn't need
+        converting, or was streamed into the tiler as it was converted).
+        """
+        if self.__end_time is not None:
+            return 1.0
+        elif self.__converter is None and self.__tiler is None:
+            return 0.0
+        elif self.__converter is None:
+            return self.__tiler.progress
+        elif self.__tiler is None:
+            return 0.5 * self.__converter.progress
+        elif self.__streaming:
+            ## the tiler consumes the output of the converter as it goes
+            return self.__tiler.progress
+        else:
+            return 0.5 * (self.__converter.progress + self.__tiler.progress)
+
+
+    @property
+    def elapsed(self):
+        """Wall-clock time (in seconds) that the job has been running for."""
+        if self.__start_time is None:
+            return 0.0
+        elif self.__end_time is None:
+            return time.time() - self.__start_time
+        else:
+            return self.__end_time - self.__start_time
+
+
+    @property
+    def stats(self):
+        """Timing and throughput of the tiling (see `Tiler.stats`), or None if
+        tiling has not begun.
+        """
+        if self.__tiler is None:
+            return None
+        return self.__tiler.stats
+
+
+    def __str__(self):
+        return "TilingJob(%s)" % self.__media_id
+
+
+    def __repr__(self):
+        return "TilingJob(%s)" % repr(self.__media_id)
@@ -0,0 +1,101 @@
+## PyZUI 0.1 - Python Zooming User Interface
+## Copyright (C) 2009  David Roberts <d@vidr.cc>
+##
+## This program is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License
+## as published by the Free Software Foundation; either version 2
+## of the License, or (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+## 02110-1301, USA.
+
+"""Accumulator for the time spent in each stage of tiling."""
+
+from __future__ import with_statement
+
+import time
+from threading import Lock
+from contextlib import contextmanager
+
+## the stages of tiling which are timed, in the order in which they occur:
+##   read        reading rows of pixels from the image
+##   assemble    dividing the rows into tiles
+##   downsample  merging and scaling tiles for the next tilelevel
+##   encode      encoding tiles in the format they are saved in
+##   write       writing encoded tiles (and raw planes) to disk
+stages = ('read', 'assemble', 'downsample', 'encode', 'write')
+
+## the quantities which are counted
+counters = ('tiles', 'bytes_read', 'bytes_written')
+
+class TilingStats(object):
+    """TilingStats objects are used for accumulating the time spent in each
+    stage of tiling, along with the number of tiles and bytes processed, from
+    any number of threads.
+
+    Constructor: TilingStats()
+    """
+    def __init__(self):
+        self.__lock = Lock()
+        self.__times = dict.fromkeys(stages, 0.0)
+        self.__counts = dict.fromkeys(counters, 0)
+
+
+    def add_time(self, stage, seconds):
+        """Add the given number of `seconds` to the time spent in `stage`.
+
+        add_time(string, float) -> None
+        """
+        with self.__lock:
+            self.__times[stage] += seconds
+
+
+    def add(self, counter, n=1):
+        """Add `n` to the given `counter`.
+
+        add(string[, int]) -> None
+        """
+        with self.__lock:
+            self.__counts[counter] += n
+
+
+    @contextmanager
+    def timed(self, stage):
+        """Context manager which adds the time spent within it to `stage`."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.time() - start)
+
+
+    def merge(self, snapshot):
+        """Add the times and counts from a `snapshot` of another TilingStats
+        (such as from a worker process) to these.
+
+        merge(dict) -> None
+        """
+        with self.__lock:
+            for stage, seconds in snapshot['stages'].iteritems():
+                self.__times[stage] += seconds
+            for counter in counters:
+                self.__counts[counter] += snapshot[counter]
+
+
+    def snapshot(self):
+        """Return the current times and counts as a dict, with the time spent
+        in each stage (in seconds) under 'stages'.
+
+        snapshot() -> dict
+        """
+        with self.__lock:
+            snapshot = dict(self.__counts)
+            snapshot['stages'] = dict(self.__times)
+        return snapshot
@@ -22,6 +22,7 @@ import os
 import sys
 import logging
 import time
+from threading import Event
 
 from PyQt4 import QtCore, QtGui, QtWebKit, QtSvg
 
@@ -41,6 +42,8 @@ class WebKitConverter(Converter):
     def __init__(self, infile, outfile):
         Converter.__init__(self, infile, outfile)
 
+        self.__finished = Event()
+
 
     def start(self):
         """If a global QApplication has already been instantiated, then this
@@ -132,13 +135,24 @@ class WebKitConverter(Converter):
             try:
                 os.unlink(self._outfile)
             except:
-                self.__logger.exception("unable to unlink temporary file "
+                self._logger.exception("unable to unlink temporary file "
                     "'%s'" % self._outfile)
 
         if self.__qapp is not None:
             self.__qapp.exit()
 
         self._progress = 1.0
+        self.__finished.set()
+
+
+    def wait(self):
+        """Block until the page has been rendered (or failed to load), which
+        may be from another thread than the one running the conversion when
+        it is handled by Qt.
+
+        wait() -> None
+        """
+        self.__finished.wait()
 
 
     def __load_progress(self, progress):
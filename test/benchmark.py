@@ -40,6 +40,7 @@ import pyzui.tilemanager as TileManager
 import pyzui.tilestore as TileStore
 from pyzui.magickconverter import MagickConverter
 from pyzui.ppm import PPMTiler, read_ppm_header
+import pyzui.tilingstats as tilingstats
 from pyzui.qzui import QZUI
 import pyzui.scene as Scene
 from pyzui.tiledmediaobject import TiledMediaObject
@@ -87,18 +88,21 @@ def benchmark(filename, ppmfile):
     t.run()
     end_time = time.time()
 
-    ## in general, python doesn't necessarily return allocated memory to the OS
-    ## (see <http://effbot.org/pyfaq/
-    ## why-doesnt-python-release-the-memory-when-i-delete-a-large-object.htm>)
-    ## so the current memory usage is likely to be approximately equal to the
-    ## peak memory usage during tiling
-    ## however, it would probably be better to periodically check memory usage
-    ## while the tiler is running and maintain a max value
-    end_mem = mem()
-
-    print "Done: took %.2fs consuming %.2fMB RAM" % \
-        ((end_time - start_time), (end_mem - base_mem) * 1e-3)
-    del t
+    ## the tiler samples its memory usage as it goes, so this is the peak
+    ## memory usage during tiling (unless it can't be determined)
+    if t.peak_memory is None:
+        print "Done: took %.2fs" % (end_time - start_time)
+    else:
+        peak_mem = t.peak_memory * 1e-3
+        print "Done: took %.2fs consuming %.2fMB RAM" % \
+            ((end_time - start_time), (peak_mem - base_mem) * 1e-3)
+
+    stats = t.stats
+    print "Throughput: %.1f tiles/s, %.2fMB/s" % \
+        (stats['tiles_per_second'], stats['bytes_per_second'] * 1e-6)
+    for stage in tilingstats.stages:
+        print "  %-10s %.2fs" % (stage, stats['stages'][stage])
+    del t, stats
 
     ## zooming
     viewport_w = 800
@@ -145,6 +149,16 @@ def benchmark(filename, ppmfile):
         (num_frames, (end_time - start_time),
         num_frames / (end_time - start_time))
 
+    for name, stats in sorted(TileManager.get_cache_stats().iteritems()):
+        lookups = stats['hits'] + stats['misses']
+        if lookups:
+            hit_rate = 100.0 * stats['hits'] / lookups
+        else:
+            hit_rate = 0.0
+        print "Tile cache (%s): %.1f%% hits, %d tiles, %.2fMB, " \
+            "evictions %s" % (name, hit_rate, stats['tiles'],
+            stats['bytes'] * 1e-6, stats['evictions'])
+
 
 def main():
     TileManager.init()
@@ -0,0 +1,102 @@
+#!/usr/bin/python
+## PyZUI 0.1 - Python Zooming User Interface
+## Copyright (C) 2009  David Roberts <d@vidr.cc>
+##
+## This program is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License
+## as published by the Free Software Foundation; either version 2
+## of the License, or (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+## 02110-1301, USA.
+
+"""
+Benchmark merging and downsampling tiles with Qt against the array-based
+filters, and optionally the tiling of a given PPM image with each of them
+USAGE
+  benchmark_downsample.py [image.ppm]
+"""
+
+import sys
+import os
+import tempfile
+import time
+import shutil
+
+sys.path.append(os.path.abspath(
+    os.path.join(os.path.dirname(__file__), '..')))
+
+import numpy
+from PyQt4 import QtGui
+
+import pyzui.tilestore as TileStore
+import pyzui.tile as Tile
+from pyzui.tiler import _merged, _halved
+from pyzui.ppm import PPMTiler
+
+filters = (None, 'box', 'lanczos')
+
+def merge_and_halve(tiles, downsample):
+    """Merge the 4 given arrays into a single tile and scale it by 1/2, in the
+    same way as the Tiler does with the given `downsample` filter.
+    """
+    if downsample:
+        return _halved(_merged(*tiles), downsample)
+    else:
+        tile = Tile.merged(*[Tile.fromarray(a) for a in tiles])
+        return tile.resize(tile.size[0]/2, tile.size[1]/2)
+
+
+def benchmark_tiles(tilesize=256, repeat=100):
+    print "Merging and halving %d blocks of 4 %dx%d tiles" % \
+        (repeat, tilesize, tilesize)
+
+    tiles = [numpy.random.randint(0, 256, (tilesize, tilesize, 3)).astype(
+        numpy.uint8) for i in xrange(4)]
+
+    for downsample in filters:
+        print "%-8s" % (downsample or 'qt'),
+        sys.stdout.flush()
+        start_time = time.time()
+        for i in xrange(repeat):
+            merge_and_halve(tiles, downsample)
+        end_time = time.time()
+        print "took %.2fs, %.2fms per tile" % ((end_time - start_time),
+            (end_time - start_time) * 1e3 / repeat)
+
+
+def benchmark_tiler(ppmfile):
+    print "Tiling %s" % os.path.basename(ppmfile)
+
+    for downsample in filters:
+        TileStore.tile_dir = tempfile.mkdtemp()
+        try:
+            t = PPMTiler(ppmfile, downsample=downsample)
+            print "%-8s" % (downsample or 'qt'),
+            sys.stdout.flush()
+            start_time = time.time()
+            t.run()
+            end_time = time.time()
+            if t.error:
+                print "failed: %s" % t.error
+            else:
+                print "took %.2fs" % (end_time - start_time)
+            del t
+        finally:
+            shutil.rmtree(TileStore.tile_dir, ignore_errors=True)
+
+
+def main():
+    app = QtGui.QApplication(sys.argv)
+
+    benchmark_tiles()
+    if len(sys.argv) > 1:
+        benchmark_tiler(os.path.abspath(sys.argv[1]))
+if __name__ == '__main__': main()
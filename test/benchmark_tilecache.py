@@ -0,0 +1,75 @@
+#!/usr/bin/python
+## PyZUI 0.1 - Python Zooming User Interface
+## Copyright (C) 2009  David Roberts <d@vidr.cc>
+##
+## This program is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License
+## as published by the Free Software Foundation; either version 2
+## of the License, or (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+## 02110-1301, USA.
+
+"""
+Benchmark the cost of cache hits and evictions in the TileCache as the number
+of cached tiles grows, which should stay roughly constant
+USAGE
+  benchmark_tilecache.py
+"""
+
+import sys
+import os
+import time
+import random
+
+sys.path.append(os.path.abspath(
+    os.path.join(os.path.dirname(__file__), '..')))
+
+from pyzui.tilecache import TileCache
+
+sizes = (100, 1000, 10000, 100000)
+
+def benchmark_hits(size, repeat=100000):
+    tilecache = TileCache(size, maxage=3600)
+    tile_ids = [('media', 1, row, 0) for row in xrange(size)]
+    for tile_id in tile_ids:
+        tilecache[tile_id] = tile_id
+
+    random.seed(0)
+    accesses = [random.choice(tile_ids) for i in xrange(repeat)]
+
+    start_time = time.time()
+    for tile_id in accesses:
+        tilecache[tile_id]
+    end_time = time.time()
+
+    return (end_time - start_time) * 1e6 / repeat
+
+
+def benchmark_evictions(size, repeat=100000):
+    tilecache = TileCache(size, maxage=3600)
+    for row in xrange(size):
+        tilecache[('media', 1, row, 0)] = row
+
+    ## every insertion beyond the maximum size evicts the oldest tile
+    start_time = time.time()
+    for row in xrange(size, size + repeat):
+        tilecache[('media', 1, row, 0)] = row
+    end_time = time.time()
+
+    return (end_time - start_time) * 1e6 / repeat
+
+
+def main():
+    print "%8s %12s %12s" % ("tiles", "us per hit", "us per evict")
+    for size in sizes:
+        print "%8d %12.2f %12.2f" % (size, benchmark_hits(size),
+            benchmark_evictions(size))
+if __name__ == '__main__': main()